@@ -1,15 +1,32 @@
 import os
 import shutil
 import json
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, request, jsonify, render_template
 from flask_cors import CORS, cross_origin
-from moviepy.editor import VideoFileClip
+from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
 import threading
 import time
 
+import ffmpeg_tools
+import media_probe
+import progress_events
+import metrics
+import cpu_budget
+import job_lanes
+import worker_warmup
+from result_cache import ResultCache, make_cache_key, save_and_hash, directory_size, rebase_result
+from storage_janitor import SessionIndex, EVICTABLE_STATES
+import chunked_upload
+from zip_stream import stream_zip, record_crc
+from fragment_delivery import send_fragment
+
 # --- Celery Configuration ---
-from celery import Celery
+from celery import Celery, chord, states
+from celery.result import ResultSet, allow_join_result
+from celery.utils import uuid
 
 # Configuración de Celery
 # Asegúrate de que Redis está corriendo en el servidor (localhost:6379 es el default)
@@ -17,15 +34,33 @@ from celery import Celery
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
 
+RESULT_EXPIRES = 3600 # Los resultados de las tareas expiran después de 1 hora
+
 celery_app = Celery('video_splitter_tasks', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
 celery_app.conf.update(
-    result_expires=3600, # Los resultados de las tareas expiran después de 1 hora
+    result_expires=RESULT_EXPIRES,
     task_acks_late=True, # Solo acusa recibo de la tarea cuando se completa
-    task_reject_on_worker_timeout=True # Rechaza la tarea si el worker timeout
+    task_reject_on_worker_timeout=True, # Rechaza la tarea si el worker timeout
+    # Una cola por carril de prioridad (ver job_lanes.py); lo que no se enruta va al carril estándar
+    task_queues=job_lanes.celery_queues(),
+    task_default_queue=job_lanes.queue_name(job_lanes.DEFAULT_LANE),
+    # Cada proceso reserva solo la tarea que ejecuta: un trabajo largo no retiene otros ya reservados detrás de él
+    worker_prefetch_multiplier=1
 )
+# Tiempo en cola, duración y resultado de cada tarea (ver metrics.py)
+metrics.connect_celery_signals()
+# Hilos por codificación = núcleos // codificaciones simultáneas en la máquina (ver cpu_budget.py)
+cpu_budget.connect_celery_signals()
+# Los workers precargan el motor de medios al arrancar; el proceso web nunca lo importa (ver worker_warmup.py)
+worker_warmup.connect_celery_signals()
 
 # --- Flask App Configuration ---
 app = Flask(__name__)
+# Detrás de Nginx u otro proxy, remote_addr es la IP del proxy: con TRUSTED_PROXY_COUNT > 0 se toma de
+# X-Forwarded-For (solo los saltos que añaden esos proxies de confianza, no lo que envíe el cliente)
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
 # Configuración CORS para permitir solicitudes desde el frontend (ajusta si es necesario)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
@@ -37,78 +72,760 @@ FRAGMENT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frag
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['FRAGMENT_FOLDER'] = FRAGMENT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024 # Límite de 500 MB para subidas (ajusta según necesites)
+# Las subidas por partes (/api/uploads) no tienen ese límite: MAX_CONTENT_LENGTH solo aplica a cada parte.
+# MAX_UPLOAD_BYTES limita el tamaño total de esas subidas (0 = sin límite).
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', '0'))
+# Segundos sin recibir datos antes de dar por abandonada una subida que ya se está dividiendo
+UPLOAD_STALL_TIMEOUT = int(os.environ.get('UPLOAD_STALL_TIMEOUT', RESULT_EXPIRES))
+GROWING_UPLOAD_POLL_INTERVAL = 2 # segundos
+# Envío por lotes (/api/batch_split): máximo de videos por petición y carpeta del servidor desde la que se pueden
+# importar videos por ruta (sin subirlos). Sin BATCH_IMPORT_FOLDER solo se aceptan archivos subidos.
+BATCH_MAX_JOBS = int(os.environ.get('BATCH_MAX_JOBS', '50'))
+BATCH_IMPORT_FOLDER = os.environ.get('BATCH_IMPORT_FOLDER')
 
 # Crea las carpetas si no existen
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(FRAGMENT_FOLDER, exist_ok=True)
 
+# Caché de resultados: si el mismo video se vuelve a subir con los mismos ajustes, se reutilizan los fragmentos
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024)) # 10 GB por defecto
+result_cache = ResultCache(FRAGMENT_FOLDER, RESULT_CACHE_MAX_BYTES)
+
+# Índice de sesiones y limpieza de uploads/ y fragments/ (ver storage_janitor.py)
+# Las sesiones sin accesos durante RESULT_EXPIRES se borran; además el total no puede pasar de STORAGE_MAX_BYTES.
+STORAGE_MAX_BYTES = int(os.environ.get('STORAGE_MAX_BYTES', 20 * 1024 * 1024 * 1024)) # 20 GB por defecto (0 = sin límite)
+STORAGE_MIN_FREE_BYTES = int(os.environ.get('STORAGE_MIN_FREE_BYTES', 1024 * 1024 * 1024)) # espacio libre mínimo en disco
+# Bytes de fragmentos que se reservan por cada byte subido al admitir una subida
+ADMISSION_OUTPUT_FACTOR = float(os.environ.get('ADMISSION_OUTPUT_FACTOR', '1.0'))
+STORAGE_JANITOR_INTERVAL = int(os.environ.get('STORAGE_JANITOR_INTERVAL', 300)) # segundos entre barridos
+# Una sesión 'processing' se da por perdida (pasa a 'failed' y se borra al caducar) si su tarea:
+#   - lleva QUEUED_JOB_TIMEOUT en la cola de Celery sin que ningún worker la empiece. El tiempo retenido en la
+#     lista de espera de su carril no cuenta: empieza a contar cuando el trabajo sale de ella (dispatch_held_job).
+#   - lleva PROCESSING_JOB_TIMEOUT desde que un worker la empezó (worker caído a mitad de trabajo, chord perdido).
+QUEUED_JOB_TIMEOUT = int(os.environ.get('QUEUED_JOB_TIMEOUT', 24 * 3600))
+PROCESSING_JOB_TIMEOUT = int(os.environ.get('PROCESSING_JOB_TIMEOUT', 12 * 3600))
+session_index = SessionIndex(UPLOAD_FOLDER, FRAGMENT_FOLDER, STORAGE_MAX_BYTES, STORAGE_MIN_FREE_BYTES,
+                             on_remove=result_cache.forget_session)
+
+# Ajustes de codificación que forman parte de la clave de la caché
+CODEC_SETTINGS = {'video_codec': 'libx264', 'audio_codec': 'aac'}
+
+
+def split_cache_key(content_hash, chunk_duration, split_mode, speed_profile, renditions=None):
+    # El perfil (preset y CRF) cambia los fragmentos recodificados; en modo copy no se codifica nada.
+    # Los hilos no forman parte de la clave: no cambian el resultado de forma apreciable.
+    codec_settings = dict(CODEC_SETTINGS)
+    if split_mode != 'copy':
+        codec_settings.update(ffmpeg_tools.SPEED_PROFILES[speed_profile], speed_profile=speed_profile)
+    if renditions:
+        codec_settings['renditions'] = renditions
+    return make_cache_key(content_hash, chunk_duration, split_mode, codec_settings)
+
+
+# Poster y sprite sheet de cada fragmento (ver add_fragment_previews); '0' para no generarlos
+FRAGMENT_PREVIEWS = os.environ.get('FRAGMENT_PREVIEWS', '1') not in ('0', 'false', 'no')
+
+# Número de fragmentos que codifica cada subtarea del chord. Cada subtarea decodifica su grupo en una sola
+# pasada, así que grupos grandes = menos arranques de decodificación, pero menos paralelismo.
+# 0 (por defecto) = automático: tantos grupos como ENCODE_PARALLELISM, de modo que el número de pasadas
+# de decodificación no crece con el número de fragmentos.
+FRAGMENTS_PER_SUBTASK = int(os.environ.get('FRAGMENTS_PER_SUBTASK', '0'))
+ENCODE_PARALLELISM = int(os.environ.get('ENCODE_PARALLELISM', os.cpu_count() or 1))
+
+
+def record_session_result(session_id, result):
+    """Actualiza el índice de sesiones con el resultado final de una división (tamaños reales, sin reserva)."""
+    upload_bytes = directory_size(os.path.join(UPLOAD_FOLDER, session_id))
+    if result.get('status') == 'success':
+        session_index.mark_done(session_id, directory_size(os.path.join(FRAGMENT_FOLDER, session_id)), upload_bytes)
+    else:
+        # El original se conserva tras un fallo; el barrido lo borra cuando caduque
+        session_index.update(session_id, state='failed', upload_bytes=upload_bytes, fragment_bytes=0, reserved_bytes=0)
+
+
+def store_result(cache_key, result):
+    """Guarda el resultado en la caché y marca como terminadas las sesiones de los envíos enganchados al trabajo."""
+    for follower_session_id, new_bytes in result_cache.store(cache_key, result).items():
+        session_index.mark_done(follower_session_id, new_bytes)
+
+
+def dispatch_split_job(job):
+    """
+    Envía un trabajo ({'task_id', 'session_id', 'args', 'kwargs'} y opcionalmente 'task', el nombre de la tarea;
+    por defecto process_video_task) a la cola del carril indicado en kwargs['lane'].
+    """
+    task = celery_app.tasks[job['task']] if job.get('task') else process_video_task
+    return task.apply_async(args=job['args'], kwargs=job['kwargs'], task_id=job['task_id'],
+                            **job_lanes.task_options(job['kwargs'].get('lane')))
+
+
+def dispatch_held_job(job):
+    """Lanza un trabajo que esperaba en la lista de su carril: su tiempo en cola (QUEUED_JOB_TIMEOUT) empieza ahora."""
+    if job.get('session_id'):
+        session_index.update(job['session_id'], queued_at=time.time())
+    return dispatch_split_job(job)
+
+
+def finish_split_job(task_id, result, lane=None, client_id=None):
+    """
+    Final de un trabajo (con éxito o no): publica el evento final y libera la plaza del cliente en su carril.
+    Si el cliente tenía trabajos retenidos en ese carril, lanza el siguiente.
+    """
+    progress_events.job_finished(task_id, result_status(result))
+    if lane:
+        next_job = job_lanes.release(lane, client_id)
+        if next_job:
+            dispatch_held_job(next_job)
+
+
+def fragment_entry(session_id, index, rendition=None):
+    # Construye la URL pública para el fragmento
+    # Esto asume que tu Nginx/Flask sirve /fragments/<session_id>/<filename>
+    # Los fragmentos de cada rendition van en su propio subdirectorio: fragments/<session_id>/<rendition>/
+    fragment_name = f"{rendition}/fragment_{index}.mp4" if rendition else f"fragment_{index}.mp4"
+    entry = {"name": fragment_name, "url": f"/fragments/{session_id}/{fragment_name}"}
+    if rendition:
+        entry["rendition"] = rendition
+    return entry
+
+
+def finish_fragment(entry, session_id, duration, split_mode=None, **log_fields):
+    """
+    Pasos de un fragmento recién escrito: guarda su CRC-32 para el ZIP de descarga (ver zip_stream.py, mientras
+    el archivo sigue en la caché de páginas) y genera sus previsualizaciones.
+    """
+    try:
+        record_crc(os.path.join(FRAGMENT_FOLDER, session_id, entry["name"]))
+    except OSError as e:
+        print(f"No se pudo calcular el CRC de {entry['name']} (sesión {session_id}): {e}")
+    return add_fragment_previews(entry, session_id, duration, split_mode, **log_fields)
+
+
+def add_fragment_previews(entry, session_id, duration, split_mode=None, **log_fields):
+    """
+    Genera el poster y el sprite sheet de un fragmento ya escrito (ffmpeg_tools.fragment_previews) y añade sus URLs
+    a su entrada, para que la página de resultados cargue unos KB por fragmento en lugar del MP4.
+    Se sirven por /fragments/ igual que los fragmentos (inmutables, caché larga). Un fallo no rompe la división.
+    """
+    if not FRAGMENT_PREVIEWS:
+        return entry
+    base_name = entry["name"][:-len(".mp4")]
+    base_path = os.path.join(FRAGMENT_FOLDER, session_id, base_name)
+    try:
+        with metrics.stage('previews', split_mode, session_id=session_id, fragment=entry["name"], **log_fields):
+            sprite = ffmpeg_tools.fragment_previews(base_path + ".mp4", base_path + ".poster.jpg", base_path + ".sprite.jpg", duration)
+    except Exception as e:
+        print(f"No se pudieron generar las previsualizaciones de {entry['name']} (sesión {session_id}): {e}")
+        return entry
+    base_url = f"/fragments/{session_id}/{base_name}"
+    return dict(entry, poster_url=f"{base_url}.poster.jpg", sprite=dict(sprite, url=f"{base_url}.sprite.jpg"))
+
+
+def plan_rendition_groups(media_info, renditions):
+    """
+    Reparte un trabajo con renditions en grupos consecutivos [{'start', 'end', 'outputs': [...]}, ...].
+    Cada grupo es una subtarea que decodifica su rango una vez para todas las renditions, así que los grupos
+    solo pueden empezar en un borde común a todas (p. ej. con fragmentos de 10 s y de 15 s, cada 30 s):
+    así ningún fragmento queda partido entre dos subtareas.
+    """
+    duration = media_info['duration']
+    cuts = {r['name']: media_probe.plan_cuts(media_info, r['chunk_duration'], 'reencode') for r in renditions}
+    common = set.intersection(*({round(start, 6) for start, _ in rendition_cuts[1:]} for rendition_cuts in cuts.values()))
+    points = [0.0] + sorted(common) + [duration]
+    spans_per_group = -(-(len(points) - 1) // ENCODE_PARALLELISM)
+    points = points[:-1:spans_per_group] + [duration]
+
+    groups = []
+    for group_start, group_end in zip(points[:-1], points[1:]):
+        outputs = []
+        for rendition in renditions:
+            fragments = [[i + 1, start, end] for i, (start, end) in enumerate(cuts[rendition['name']])
+                         if start >= group_start - ffmpeg_tools.TIMESTAMP_EPSILON and end <= group_end + ffmpeg_tools.TIMESTAMP_EPSILON]
+            outputs.append({'rendition': rendition, 'fragments': fragments})
+        groups.append({'start': group_start, 'end': group_end, 'outputs': outputs})
+    return groups
+
+
+def copy_split_fragments(task, video_path, chunk_duration, session_id, output_dir):
+    """
+    Modo 'copy': los cortes se mueven al keyframe más cercano y todo se hace en una sola pasada de copia.
+    Es trabajo de disco, no de CPU, así que no vale la pena repartirlo entre workers.
+    """
+    with metrics.stage('plan', 'copy', task_id=task.request.id, session_id=session_id):
+        media_info = media_probe.get_media_info(video_path, with_keyframes=True)
+        cuts = media_probe.plan_cuts(media_info, chunk_duration, 'copy')
+    task.update_state(state='PROGRESS', meta={'status': f'Copying {len(cuts)} fragments (no re-encode)', 'progress': '0.00%', 'session_id': session_id})
+    copy_started = time.perf_counter()
+    with metrics.stage('copy_split', 'copy', task_id=task.request.id, session_id=session_id, fragments=len(cuts)):
+        ffmpeg_tools.copy_split(video_path, cuts, os.path.join(output_dir, "fragment_%d.mp4"), start_number=1)
+    metrics.fragment_encoded('copy', media_info['duration'], time.perf_counter() - copy_started,
+                             (media_info['video'] or {}).get('fps'), task_id=task.request.id, session_id=session_id, fragments=len(cuts))
+    return [finish_fragment(fragment_entry(session_id, i + 1), session_id, end - start, 'copy', task_id=task.request.id)
+            for i, (start, end) in enumerate(cuts)]
+
 
 # --- Helper Function for Video Splitting Logic (now a Celery task) ---
 # Esta es la función que realmente hace el trabajo pesado
 @celery_app.task(bind=True) # bind=True permite acceder al objeto de la tarea (self)
-def process_video_task(self, video_path, chunk_duration, session_id):
+def process_video_task(self, video_path, chunk_duration, session_id, split_mode=ffmpeg_tools.DEFAULT_SPLIT_MODE, cache_key=None,
+                       speed_profile=ffmpeg_tools.DEFAULT_SPEED_PROFILE, renditions=None, lane=None, client_id=None):
     """
-    Función que realiza la división de video.
-    Se ejecuta como una tarea de Celery en segundo plano.
+    Planificador de la división de video. Se ejecuta como una tarea de Celery en segundo plano.
+    Calcula la lista de cortes y se reemplaza por un chord: una subtarea encode_fragments_task por cada
+    grupo consecutivo de fragmentos (repartidas entre todos los workers) y collect_fragments_task
+    para juntar los resultados. El chord hereda el task_id, así que get_task_status no cambia para el cliente.
+    split_mode: 'reencode' (una pasada de ffmpeg por grupo), 'copy' (corte en keyframes sin recodificar) o 'exact' (solo recodifica los bordes).
+    cache_key: si se indica, el resultado final se guarda en la caché de resultados con esa clave.
+    speed_profile: perfil de libx264 (ver ffmpeg_tools.SPEED_PROFILES); los hilos los decide cada worker.
+    renditions: salidas normalizadas (ver ffmpeg_tools.normalize_renditions); todas salen de una sola decodificación
+    por grupo (encode_renditions_task) y el resultado las lista por separado. Sustituyen a la salida normal: para
+    conservarla hay que pedir una rendition sin tamaño ni aspecto. Solo con split_mode 'reencode'.
+    lane, client_id: carril de prioridad y cliente (ver job_lanes.py); las subtareas van a la cola del mismo carril.
     """
     current_session_fragment_dir = os.path.join(FRAGMENT_FOLDER, session_id)
+    session_index.mark_started(session_id)
     try:
         # Asegúrate de que los directorios de salida existen
         os.makedirs(current_session_fragment_dir, exist_ok=True)
 
-        clip = VideoFileClip(video_path)
-        total_duration = clip.duration
-        
         # Opcional: Actualizar el estado de la tarea para seguimiento de progreso
-        self.update_state(state='PROGRESS', meta={'status': 'Starting video processing', 'session_id': session_id})
+        self.update_state(state='PROGRESS', meta={'status': 'Planning video cuts', 'session_id': session_id})
+
+        if split_mode == 'copy':
+            fragments_info = copy_split_fragments(self, video_path, chunk_duration, session_id, current_session_fragment_dir)
+            media_probe.remove_with_sidecar(video_path)
+            result = {"status": "success", "message": "Video processed successfully", "fragments": fragments_info, "session_id": session_id,
+                      "speed_profile": None} # copy no codifica
+            if cache_key:
+                store_result(cache_key, result)
+            record_session_result(session_id, result)
+            finish_split_job(self.request.id, result, lane, client_id)
+            return result
+
+        # Las cabeceras se leyeron al recibir la subida; los keyframes (solo modo exact) se leen aquí la primera vez
+        with metrics.stage('plan', split_mode, task_id=self.request.id, session_id=session_id):
+            media_info = media_probe.get_media_info(video_path, with_keyframes=split_mode == 'exact')
+            cuts = media_probe.plan_cuts(media_info, chunk_duration, split_mode)
+            if renditions:
+                groups = plan_rendition_groups(media_info, renditions)
+        fps = media_info['video']['fps']
+        video_stream = media_info['video']
+        keyframes = media_info['keyframes'] if split_mode == 'exact' else []
+
+        header = []
+        if renditions:
+            total_fragments = sum(len(output['fragments']) for group in groups for output in group['outputs'])
+            for group in groups:
+                header.append(encode_renditions_task.s(video_path, session_id, group, fps, progress_task_id=self.request.id,
+                                                       speed_profile=speed_profile).set(task_id=uuid(), **job_lanes.task_options(lane)))
+        else:
+            fragments = [[i + 1, start, end] for i, (start, end) in enumerate(cuts)]
+            total_fragments = len(fragments)
+            batch_size = FRAGMENTS_PER_SUBTASK or -(-len(fragments) // ENCODE_PARALLELISM)
+            batches = [fragments[i:i + batch_size] for i in range(0, len(fragments), batch_size)]
+            for batch in batches:
+                # Cada subtarea solo necesita los keyframes de su propio rango
+                batch_keyframes = [k for k in keyframes if batch[0][1] <= k <= batch[-1][2]]
+                header.append(encode_fragments_task.s(video_path, session_id, batch, split_mode, fps, batch_keyframes, video_stream,
+                                                      progress_task_id=self.request.id, speed_profile=speed_profile).set(task_id=uuid(),
+                                                                                                                         **job_lanes.task_options(lane)))
+        subtask_ids = [signature.id for signature in header]
+
+        status = f'Dispatched {total_fragments} fragments in {len(header)} subtasks'
+        self.update_state(state='PROGRESS', meta={
+            'status': status,
+            'progress': '0.00%',
+            'session_id': session_id,
+            'subtask_ids': subtask_ids,
+            'total_fragments': total_fragments
+        })
+        progress_events.job_started(self.request.id, session_id, total_fragments, status)
+
+    except Exception as e:
+        # Limpiar el directorio de fragmentos de la sesión actual si hay un error
+        if os.path.exists(current_session_fragment_dir):
+            shutil.rmtree(current_session_fragment_dir)
 
+        # Registrar el error completo para depuración
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"Error during video processing task for session {session_id}: {e}\n{error_trace}")
+        if cache_key:
+            result_cache.release_inflight(cache_key)
+
+        # Actualizar el estado de la tarea a FAILURE y devolver el error
+        self.update_state(state='FAILURE', meta={'status': 'Processing failed', 'error': str(e), 'trace': error_trace, 'session_id': session_id})
+        result = {"status": "error", "message": str(e), "session_id": session_id, "traceback": error_trace}
+        record_session_result(session_id, result)
+        finish_split_job(self.request.id, result, lane, client_id)
+        return result
+
+    workflow = chord(header, collect_fragments_task.s(video_path, session_id, cache_key, progress_task_id=self.request.id,
+                                                      speed_profile=speed_profile, renditions=renditions, lane=lane,
+                                                      client_id=client_id).set(**job_lanes.task_options(lane)))
+    if self.request.is_eager:
+        # En modo eager (pruebas locales) no hay workers: el chord se ejecuta aquí mismo
+        with allow_join_result():
+            return workflow.apply().get()
+    # Fuera del try: replace() lanza Ignore para terminar esta tarea y no debe tratarse como error
+    return self.replace(workflow)
+
+
+@celery_app.task(bind=True)
+def encode_fragments_task(self, video_path, session_id, fragments, split_mode, fps=None, keyframes=None, video_stream=None, progress_task_id=None,
+                          speed_profile=ffmpeg_tools.DEFAULT_SPEED_PROFILE):
+    """
+    Subtarea del chord: codifica un grupo de fragmentos [[índice, inicio, fin], ...] del mismo video.
+    Nunca lanza excepciones; devuelve un diccionario con 'status' para que collect_fragments_task siempre se ejecute.
+    video_stream: códec, pix_fmt, perfil y nivel del video para el modo exact (ver ffmpeg_tools.exact_segment).
+    progress_task_id: tarea del cliente en cuyo canal se publica cada fragmento terminado.
+    """
+    current_session_fragment_dir = os.path.join(FRAGMENT_FOLDER, session_id)
+    # Los hilos dependen del worker que ejecuta la subtarea, no del que la planificó.
+    # Con previsualizaciones, un keyframe por miniatura del sprite (ver ffmpeg_tools.preview_keyint)
+    keyint = ffmpeg_tools.preview_keyint(fps, max(end - start for _, start, end in fragments)) if FRAGMENT_PREVIEWS else None
+    encoding = ffmpeg_tools.encoding_options(speed_profile, cpu_budget.threads_per_encode(), keyint)
+    try:
+        os.makedirs(current_session_fragment_dir, exist_ok=True)
         fragments_info = []
-        for i, start_time in enumerate(range(0, int(total_duration), chunk_duration)):
-            end_time = min(start_time + chunk_duration, total_duration)
-            if start_time >= end_time:
-                break
+        last_done = [time.time()]
+
+        def fragment_finished(index, start_time, end_time):
+            entry = fragment_entry(session_id, index)
+            now = time.time()
+            metrics.fragment_encoded(split_mode, end_time - start_time, now - last_done[0], fps,
+                                     task_id=self.request.id, session_id=session_id, fragment=entry["name"])
+            entry = finish_fragment(entry, session_id, end_time - start_time, split_mode, task_id=self.request.id)
+            fragments_info.append(dict(entry, index=index))
+            if progress_task_id:
+                progress_events.fragment_done(progress_task_id, session_id, entry["name"], end_time - start_time,
+                                              now - last_done[0], fps)
+            last_done[0] = now
+
+        if split_mode == 'reencode':
+            # Los fragmentos del grupo son consecutivos: se decodifican una sola vez, en orden, con un único ffmpeg
+            def on_segment(filename):
+                fragment_finished(*fragments[len(fragments_info)])
 
-            fragment_name = f"fragment_{i + 1}.mp4"
-            output_path = os.path.join(current_session_fragment_dir, fragment_name)
+            with metrics.stage('encode_split', split_mode, task_id=self.request.id, session_id=session_id, fragments=len(fragments)):
+                ffmpeg_tools.encode_split(video_path, [(start, end) for _, start, end in fragments],
+                                          os.path.join(current_session_fragment_dir, "fragment_%d.mp4"),
+                                          start_number=fragments[0][0], on_segment=on_segment, encoding=encoding)
+        else:
+            for index, start_time, end_time in fragments:
+                output_path = os.path.join(current_session_fragment_dir, fragment_entry(session_id, index)["name"])
+                with metrics.stage('exact_segment', split_mode, task_id=self.request.id, session_id=session_id):
+                    ffmpeg_tools.exact_segment(video_path, start_time, end_time, output_path, keyframes or [], video_stream, encoding)
+                fragment_finished(index, start_time, end_time)
 
-            subclip = clip.subclip(start_time, end_time)
-            subclip.write_videofile(output_path, codec="libx264", audio_codec="aac", fps=clip.fps)
-            
-            # Construye la URL pública para el fragmento
-            # Esto asume que tu Nginx/Flask sirve /fragments/<session_id>/<filename>
-            public_url = f"/fragments/{session_id}/{fragment_name}"
-            fragments_info.append({"name": fragment_name, "url": public_url}) # Cambiado a 'url'
+        return {"status": "success", "fragments": fragments_info, "encoder_threads": encoding['threads']}
 
-            # Opcional: Actualizar el estado de la tarea con progreso
-            progress_percent = (i + 1) / (total_duration / chunk_duration) * 100
-            self.update_state(state='PROGRESS', meta={
-                'status': f'Processing fragment {i+1} of {int(total_duration / chunk_duration) + 1}',
-                'progress': f'{progress_percent:.2f}%',
-                'session_id': session_id
-            })
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"Error encoding fragments {[f[0] for f in fragments]} for session {session_id}: {e}\n{error_trace}")
+        return {"status": "error", "message": str(e), "traceback": error_trace}
+
+
+@celery_app.task(bind=True)
+def encode_renditions_task(self, video_path, session_id, group, fps=None, progress_task_id=None,
+                           speed_profile=ffmpeg_tools.DEFAULT_SPEED_PROFILE):
+    """
+    Subtarea del chord para trabajos con renditions: decodifica el rango [group['start'], group['end']) una sola vez
+    y escribe los fragmentos de todas las renditions (ver plan_rendition_groups). Mismo contrato que encode_fragments_task.
+    """
+    current_session_fragment_dir = os.path.join(FRAGMENT_FOLDER, session_id)
+    encoding = ffmpeg_tools.encoding_options(speed_profile, cpu_budget.threads_per_encode())
+    try:
+        outputs = []
+        pending = {} # rendition -> fragmentos del grupo que aún no se cerraron, en orden
+        for output in group['outputs']:
+            name = output['rendition']['name']
+            if not output['fragments']:
+                continue
+            os.makedirs(os.path.join(current_session_fragment_dir, name), exist_ok=True)
+            pending[name] = list(output['fragments'])
+            outputs.append({'rendition': output['rendition'],
+                            'cuts': [(start, end) for _, start, end in output['fragments']],
+                            'output_pattern': os.path.join(current_session_fragment_dir, name, "fragment_%d.mp4"),
+                            'start_number': output['fragments'][0][0],
+                            # Cada rendition tiene su duración de fragmento: su propio keyframe por miniatura del sprite
+                            'keyint': ffmpeg_tools.preview_keyint(fps, output['rendition']['chunk_duration']) if FRAGMENT_PREVIEWS else None})
+
+        fragments_info = []
+        last_done = [time.time()]
+
+        def on_segment(rendition_name, filename):
+            index, start_time, end_time = pending[rendition_name].pop(0)
+            entry = fragment_entry(session_id, index, rendition_name)
+            now = time.time()
+            # Las renditions se codifican a la vez: el tiempo entre fragmentos es compartido, no por rendition
+            metrics.fragment_encoded('reencode', end_time - start_time, now - last_done[0], fps,
+                                     task_id=self.request.id, session_id=session_id, fragment=entry["name"])
+            entry = finish_fragment(entry, session_id, end_time - start_time, 'reencode', task_id=self.request.id)
+            fragments_info.append(dict(entry, index=index))
+            if progress_task_id:
+                progress_events.fragment_done(progress_task_id, session_id, entry["name"], end_time - start_time,
+                                              now - last_done[0], fps)
+            last_done[0] = now
+
+        with metrics.stage('encode_renditions', 'reencode', task_id=self.request.id, session_id=session_id,
+                           renditions=len(outputs)):
+            ffmpeg_tools.encode_renditions(video_path, group['start'], group['end'], outputs, on_segment=on_segment, encoding=encoding)
+
+        return {"status": "success", "fragments": fragments_info, "encoder_threads": encoding['threads']}
+
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(f"Error encoding renditions {group['start']}-{group['end']}s for session {session_id}: {e}\n{error_trace}")
+        return {"status": "error", "message": str(e), "traceback": error_trace}
+
+
+@celery_app.task
+def collect_fragments_task(results, video_path, session_id, cache_key=None, progress_task_id=None, speed_profile=None, renditions=None,
+                           lane=None, client_id=None):
+    """
+    Callback del chord: junta los fragmentos de todas las subtareas en el mismo formato
+    que devolvía process_video_task, que es lo que get_task_status espera.
+    Con renditions, 'fragments' las incluye todas (cada una con su clave 'rendition') y 'renditions'
+    lista los ajustes y los fragmentos de cada una por separado.
+    """
+    current_session_fragment_dir = os.path.join(FRAGMENT_FOLDER, session_id)
+    errors = [result for result in results if result.get('status') != 'success']
+    if errors:
+        # Limpiar el directorio de fragmentos de la sesión actual si hay un error
+        if os.path.exists(current_session_fragment_dir):
+            shutil.rmtree(current_session_fragment_dir)
+        if cache_key:
+            result_cache.release_inflight(cache_key)
+        result = {"status": "error", "message": errors[0].get('message'), "session_id": session_id, "traceback": errors[0].get('traceback')}
+        record_session_result(session_id, result)
+        if progress_task_id:
+            finish_split_job(progress_task_id, result, lane, client_id)
+        return result
+
+    rendition_order = {r['name']: position for position, r in enumerate(renditions or [])}
+    fragments = sorted((f for result in results for f in result['fragments']),
+                       key=lambda f: (rendition_order.get(f.get('rendition'), 0), f['index']))
+    fragments_info = [{key: value for key, value in f.items() if key != 'index'} for f in fragments]
+
+    # Limpiar el archivo subido original (y su índice de probing) después de procesar
+    media_probe.remove_with_sidecar(video_path)
+
+    # Retorna el resultado final que Celery almacenará y el frontend recuperará.
+    # El perfil y los hilos quedan registrados para comparar el rendimiento por perfil (benchmark.py)
+    result = {"status": "success", "message": "Video processed successfully", "fragments": fragments_info, "session_id": session_id,
+              "speed_profile": speed_profile, "encoder_threads": max(r.get('encoder_threads') or 0 for r in results) or None}
+    if renditions:
+        result["renditions"] = [dict(rendition, fragments=[f for f in fragments_info if f['rendition'] == rendition['name']])
+                                for rendition in renditions]
+    if cache_key:
+        store_result(cache_key, result)
+    record_session_result(session_id, result)
+    if progress_task_id:
+        finish_split_job(progress_task_id, result, lane, client_id)
+    return result
+
+
+def cut_fragment(video_path, start_time, end_time, output_path, split_mode, keyframes, video_stream, encoding=None):
+    """Corta un solo fragmento con ffmpeg según el modo de división."""
+    if split_mode == 'copy':
+        ffmpeg_tools.copy_segment(video_path, start_time, end_time, output_path)
+    elif split_mode == 'exact':
+        ffmpeg_tools.exact_segment(video_path, start_time, end_time, output_path, keyframes, video_stream, encoding)
+    else:
+        ffmpeg_tools.encode_segment(video_path, start_time, end_time, output_path, encoding)
+
+
+@celery_app.task(bind=True)
+def process_growing_upload_task(self, session_id, lane=None, client_id=None):
+    """
+    Divide un video mientras todavía se está subiendo por partes (contenedores de STREAMABLE_EXTENSIONS).
+    Cada fragmento se corta en cuanto hay en disco un keyframe posterior a su final; cuando la subida se
+    confirma (commit) se procesa lo que falta. Así el tiempo de subida y el de codificación se solapan.
+    lane, client_id: carril (job_lanes.STREAMING_LANE) y cliente; al terminar se libera su plaza.
+    """
+    session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
+    current_session_fragment_dir = os.path.join(FRAGMENT_FOLDER, session_id)
+    session_index.mark_started(session_id)
+    try:
+        # Dentro del try: si el trabajo estuvo retenido, la subida pudo borrarse antes de que empezara
+        state = chunked_upload.read_state(session_upload_dir)
+        if state is None:
+            raise RuntimeError("Upload was removed before processing started")
+        video_path = state['video_path']
+        chunk_duration = state['chunk_duration']
+        split_mode = state['split_mode']
+        speed_profile = state.get('speed_profile') or ffmpeg_tools.DEFAULT_SPEED_PROFILE
+        encoding = ffmpeg_tools.encoding_options(speed_profile, cpu_budget.threads_per_encode())
+        os.makedirs(current_session_fragment_dir, exist_ok=True)
+        self.update_state(state='PROGRESS', meta={'status': 'Waiting for upload data', 'session_id': session_id})
+        # El total de fragmentos no se conoce hasta que termina la subida
+        progress_events.job_started(self.request.id, session_id, 0, 'Waiting for upload data')
+
+        fragments_info = []
+        keyframes = []
+        video_stream = None
+        total_duration = None
+        start_time = 0.0
+        last_size = -1
+        last_growth = time.time()
+
+        while True:
+            # Primero el estado y después el tamaño: si ya estaba confirmada, el archivo está completo
+            state = chunked_upload.read_state(session_upload_dir)
+            if state is None:
+                raise RuntimeError("Upload was removed before processing finished")
+            size = chunked_upload.current_offset(video_path)
+            if size != last_size:
+                # Solo se leen los paquetes nuevos, desde el último keyframe conocido
+                keyframes = sorted(set(keyframes + ffmpeg_tools.probe_keyframes(video_path, start_time=keyframes[-1] if keyframes else None)))
+                if video_stream is None and keyframes:
+                    video_stream = ffmpeg_tools.probe_video_stream(video_path)
+                    if FRAGMENT_PREVIEWS and video_stream:
+                        # Un keyframe por miniatura del sprite en los fragmentos recodificados (ver ffmpeg_tools.preview_keyint)
+                        fps = media_probe.parse_rate(video_stream.get('avg_frame_rate'))
+                        encoding = dict(encoding, keyint=ffmpeg_tools.preview_keyint(fps, chunk_duration))
+                last_size = size
+                last_growth = time.time()
+            elif not state['committed'] and time.time() - last_growth > UPLOAD_STALL_TIMEOUT:
+                raise RuntimeError("Upload stalled: no data received in time")
 
-        clip.close() # Cierra el clip para liberar recursos
+            if state['committed'] and total_duration is None:
+                total_duration = ffmpeg_tools.probe_duration(video_path)
+
+            while total_duration is None or start_time < total_duration - ffmpeg_tools.TIMESTAMP_EPSILON:
+                end_time = ffmpeg_tools.next_cut(start_time, chunk_duration, keyframes, split_mode, total_duration)
+                if end_time is None:
+                    break # Faltan datos para cerrar este fragmento
+
+                entry = fragment_entry(session_id, len(fragments_info) + 1)
+                encode_started = time.time()
+                with metrics.stage('cut_fragment', split_mode, task_id=self.request.id, session_id=session_id, fragment=entry["name"]):
+                    cut_fragment(video_path, start_time, end_time, os.path.join(current_session_fragment_dir, entry["name"]),
+                                 split_mode, keyframes, video_stream, encoding)
+                metrics.fragment_encoded(split_mode, end_time - start_time, time.time() - encode_started,
+                                         task_id=self.request.id, session_id=session_id, fragment=entry["name"])
+                fragments_info.append(finish_fragment(entry, session_id, end_time - start_time, split_mode,
+                                                            task_id=self.request.id))
+                progress_events.fragment_done(self.request.id, session_id, entry["name"], end_time - start_time, time.time() - encode_started)
+                start_time = end_time
+
+                # Mientras no se conoce la duración total, el avance de la subida es la mejor estimación
+                if total_duration:
+                    progress_percent = start_time / total_duration * 100
+                elif state.get('total_size'):
+                    progress_percent = size / state['total_size'] * 100
+                else:
+                    progress_percent = 0
+                self.update_state(state='PROGRESS', meta={
+                    'status': f'Processed fragment {len(fragments_info)}' + ('' if total_duration else ' while uploading'),
+                    'progress': f'{progress_percent:.2f}%',
+                    'session_id': session_id
+                })
+
+            if total_duration is not None:
+                break
+            time.sleep(GROWING_UPLOAD_POLL_INTERVAL)
 
-        # Limpiar el archivo subido original después de procesar
         if os.path.exists(video_path):
             os.remove(video_path)
 
-        # Retorna el resultado final que Celery almacenará y el frontend recuperará
-        return {"status": "success", "message": "Video processed successfully", "fragments": fragments_info, "session_id": session_id}
+        result = {"status": "success", "message": "Video processed successfully", "fragments": fragments_info, "session_id": session_id,
+                  "speed_profile": None if split_mode == 'copy' else speed_profile,
+                  "encoder_threads": None if split_mode == 'copy' else encoding['threads']}
+        cache_key = chunked_upload.read_state(session_upload_dir).get('cache_key')
+        if cache_key:
+            store_result(cache_key, result)
+        record_session_result(session_id, result)
+        finish_split_job(self.request.id, result, lane, client_id)
+        return result
 
     except Exception as e:
-        # Limpiar el directorio de fragmentos de la sesión actual si hay un error
         if os.path.exists(current_session_fragment_dir):
             shutil.rmtree(current_session_fragment_dir)
-        
-        # Registrar el error completo para depuración
+
         import traceback
         error_trace = traceback.format_exc()
-        print(f"Error during video processing task for session {session_id}: {e}\n{error_trace}")
-        
-        # Actualizar el estado de la tarea a FAILURE y devolver el error
+        print(f"Error during streaming upload task for session {session_id}: {e}\n{error_trace}")
+        cache_key = (chunked_upload.read_state(session_upload_dir) or {}).get('cache_key')
+        if cache_key:
+            result_cache.release_inflight(cache_key)
+
         self.update_state(state='FAILURE', meta={'status': 'Processing failed', 'error': str(e), 'trace': error_trace, 'session_id': session_id})
-        return {"status": "error", "message": str(e), "session_id": session_id, "traceback": error_trace}
+        result = {"status": "error", "message": str(e), "session_id": session_id, "traceback": error_trace}
+        record_session_result(session_id, result)
+        finish_split_job(self.request.id, result, lane, client_id)
+        return result
+
+
+def parse_split_options(values):
+    """Valida chunkDuration, splitMode y speedProfile. Devuelve (chunk_duration, split_mode, speed_profile, respuesta_de_error)."""
+    try:
+        chunk_duration = int(values.get('chunkDuration', '60')) # Default 60 segundos
+        if chunk_duration <= 0:
+            return None, None, None, (jsonify({"error": "Chunk duration must be a positive integer"}), 400)
+    except (ValueError, TypeError):
+        return None, None, None, (jsonify({"error": "Invalid chunk duration. Must be an integer."}), 400)
+
+    split_mode = values.get('splitMode', ffmpeg_tools.DEFAULT_SPLIT_MODE)
+    if split_mode not in ffmpeg_tools.SPLIT_MODES:
+        return None, None, None, (jsonify({"error": f"Invalid split mode. Must be one of: {', '.join(ffmpeg_tools.SPLIT_MODES)}"}), 400)
+
+    speed_profile = values.get('speedProfile') or ffmpeg_tools.DEFAULT_SPEED_PROFILE
+    if speed_profile not in ffmpeg_tools.SPEED_PROFILES:
+        return None, None, None, (jsonify({"error": f"Invalid speed profile. Must be one of: {', '.join(ffmpeg_tools.SPEED_PROFILES)}"}), 400)
+    return chunk_duration, split_mode, speed_profile, None
+
+
+def parse_renditions(values, chunk_duration, split_mode):
+    """
+    Valida el parámetro opcional renditions (lista JSON, o texto JSON en un formulario multipart).
+    Devuelve (renditions_normalizadas_o_None, respuesta_de_error).
+    """
+    specs = values.get('renditions')
+    if specs in (None, '', []):
+        return None, None
+    if isinstance(specs, str):
+        try:
+            specs = json.loads(specs)
+        except ValueError:
+            return None, (jsonify({"error": "renditions must be a JSON list"}), 400)
+    if split_mode != 'reencode':
+        # copy no puede cambiar resolución ni bitrate, y exact copia el video entre los bordes
+        return None, (jsonify({"error": "Renditions require splitMode 'reencode'"}), 400)
+    try:
+        return ffmpeg_tools.normalize_renditions(specs, chunk_duration), None
+    except ValueError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+
+
+def admit_session(session_id, upload_bytes):
+    """Reserva espacio para la subida y sus fragmentos; False si no cabe en el presupuesto de almacenamiento."""
+    upload_bytes = upload_bytes or 0
+    return session_index.admit(session_id, int(upload_bytes * (1 + ADMISSION_OUTPUT_FACTOR)))
+
+
+def insufficient_storage_response():
+    return jsonify({"error": "Not enough storage available to accept this upload. Try again later."}), 507
+
+
+def request_client_id():
+    """
+    Cliente para el reparto justo entre carriles: la IP de la petición (ver TRUSTED_PROXY_COUNT).
+    No se usa ninguna cabecera que envíe el propio cliente: cambiándola en cada envío tendría plazas sin límite.
+    """
+    return request.remote_addr or 'anonymous'
+
+
+def cached_split_response(cache_key, session_id):
+    """
+    Si el resultado está en la caché, lo enlaza en la sesión del cliente y devuelve la respuesta; si no, None.
+    Los enlaces duros no ocupan espacio nuevo: la sesión solo cuenta los bytes que hubo que copiar.
+    """
+    cached_result = result_cache.lookup(cache_key)
+    if cached_result is None:
+        return None
+    result, new_bytes = result_cache.clone_into(cached_result, session_id)
+    if result is None:
+        return None
+    shutil.rmtree(os.path.join(UPLOAD_FOLDER, session_id), ignore_errors=True)
+    session_index.touch(cached_result['session_id'])
+    session_index.mark_done(session_id, new_bytes)
+    return jsonify({
+        "message": "Video already processed, returning cached fragments",
+        "cached": True,
+        "state": "SUCCESS",
+        "fragments": result.get('fragments', []),
+        "renditions": result.get('renditions'),
+        "session_id": session_id
+    }), 200
+
+
+def submit_split_job(session_id, video_path, content_hash, chunk_duration, split_mode, speed_profile=ffmpeg_tools.DEFAULT_SPEED_PROFILE,
+                     renditions=None, client_id=None):
+    """
+    Encola la división de un video ya guardado en uploads/<session_id>/, pasando antes por la caché de
+    resultados y por la deduplicación de trabajos en curso. Devuelve la respuesta para el cliente.
+    El trabajo va al carril que corresponde a su coste estimado; si el cliente ya tiene el máximo de trabajos
+    en ese carril, queda retenido hasta que termine uno de ellos (ver job_lanes.py).
+    """
+    session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
+
+    # Si ya procesamos este mismo video con los mismos ajustes, devolvemos los fragmentos existentes,
+    # enlazados en la sesión de este cliente (su limpieza no toca los fragmentos de la caché)
+    cache_key = split_cache_key(content_hash, chunk_duration, split_mode, speed_profile, renditions)
+    cached_response = cached_split_response(cache_key, session_id)
+    if cached_response:
+        return cached_response
+
+    # Probing al recibir la subida: solo cabeceras (el índice de keyframes lo genera el worker si el modo lo necesita)
+    try:
+        with metrics.stage('probe', split_mode, session_id=session_id):
+            media_info = media_probe.get_media_info(video_path)
+        media_error = media_probe.validate_media(media_info)
+    except Exception as e:
+        media_error = f"Could not read the uploaded video: {e}"
+    if media_error:
+        shutil.rmtree(session_upload_dir, ignore_errors=True)
+        session_index.forget(session_id)
+        return jsonify({"error": media_error}), 400
+    # Estimación con cortes exactos: en modo copy los bordes se mueven a keyframes, pero el número apenas cambia
+    if renditions:
+        estimated_fragments = sum(len(media_probe.plan_cuts(media_info, r['chunk_duration'], 'reencode')) for r in renditions)
+    else:
+        estimated_fragments = len(media_probe.plan_cuts(media_info, chunk_duration, 'reencode'))
+
+    # Si hay un trabajo idéntico en curso, nos enganchamos a él en lugar de lanzar otro
+    task_id = uuid()
+    owner_task_id, owner_session_id, _ = result_cache.claim_inflight(cache_key, task_id, session_id)
+    if owner_task_id != task_id:
+        # El cliente recibe su propia sesión y un task_id seguidor: al terminar el trabajo se le enlazan los fragmentos
+        if not is_owner_lost(owner_task_id, owner_session_id):
+            if result_cache.add_follower(cache_key, owner_task_id, task_id, session_id):
+                shutil.rmtree(session_upload_dir, ignore_errors=True)
+                session_index.update(session_id, state='processing', task_id=task_id, upload_bytes=0, reserved_bytes=0,
+                                     queued_at=time.time(), started_at=None)
+                return jsonify({
+                    "message": "An identical video is already being processed",
+                    "deduplicated": True,
+                    "task_id": task_id,
+                    "session_id": session_id,
+                    "status_url": f"/api/task_status/{task_id}"
+                }), 202
+            # El trabajo terminó entre ambas consultas: su resultado ya está en la caché
+            cached_response = cached_split_response(cache_key, session_id)
+            if cached_response:
+                return cached_response
+        # El trabajo registrado terminó o se perdió sin limpiar su entrada: lo reemplazamos
+        result_cache.release_inflight(cache_key, owner_task_id)
+        result_cache.claim_inflight(cache_key, task_id, session_id)
+
+    # Enviar la tarea de procesamiento a Celery, a la cola de su carril (o retenerla si el cliente ya tiene el máximo)
+    lane = job_lanes.lane_for_cost(job_lanes.estimate_cost(media_info['duration'], split_mode, renditions))
+    args = (video_path, chunk_duration, session_id, split_mode)
+    kwargs = {'cache_key': cache_key, 'speed_profile': speed_profile, 'renditions': renditions, 'lane': lane, 'client_id': client_id}
+    job = {'task_id': task_id, 'session_id': session_id, 'args': args, 'kwargs': kwargs}
+    # Antes de enviarla: un worker rápido puede marcarla empezada (o terminada) antes de que volvamos de apply_async
+    session_index.mark_queued(session_id, task_id, directory_size(session_upload_dir))
+    waiting_position = job_lanes.acquire(lane, client_id, job)
+    if not waiting_position:
+        dispatch_split_job(job)
+    
+    # Devolver el ID de la tarea inmediatamente al cliente
+    return jsonify({
+        "message": "Video processing started successfully" if not waiting_position else "Video queued behind your other jobs",
+        "task_id": task_id,
+        "session_id": session_id, # Enviamos el session_id desde el inicio
+        "status_url": f"/api/task_status/{task_id}", # URL para chequear estado
+        "duration": media_info['duration'],
+        "estimated_fragments": estimated_fragments,
+        "speed_profile": None if split_mode == 'copy' else speed_profile,
+        "renditions": [r['name'] for r in renditions] if renditions else None,
+        "lane": lane,
+        "waiting_position": waiting_position # trabajos retenidos de este cliente por delante en el carril (0 = ya en cola)
+    }), 202 # Código 202 Accepted significa que la solicitud fue aceptada para procesamiento
 
 
 # --- Flask Routes ---
@@ -123,54 +840,347 @@ def index():
 @app.route('/api/split_video', methods=['POST'])
 @cross_origin()
 def split_video_endpoint():
+    # Control de admisión antes de leer el cuerpo: si no hay sitio ni liberando sesiones viejas, se rechaza
+    session_id = datetime.now().strftime("%Y%m%d%H%M%S%f") # Generar ID de sesión único (con microsegundos para mayor unicidad)
+    if not admit_session(session_id, request.content_length):
+        return insufficient_storage_response()
+
     if 'video' not in request.files:
+        session_index.forget(session_id)
         return jsonify({"error": "No video file provided"}), 400
 
     video_file = request.files['video']
-    chunk_duration_str = request.form.get('chunkDuration', '60') # Default 60 segundos
 
     if video_file.filename == '':
+        session_index.forget(session_id)
         return jsonify({"error": "No selected file"}), 400
 
-    session_id = datetime.now().strftime("%Y%m%d%H%M%S%f") # Generar ID de sesión único (con microsegundos para mayor unicidad)
+    chunk_duration, split_mode, speed_profile, error_response = parse_split_options(request.form)
+    if not error_response:
+        renditions, error_response = parse_renditions(request.form, chunk_duration, split_mode)
+    if error_response:
+        session_index.forget(session_id)
+        return error_response
+
     session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
     os.makedirs(session_upload_dir, exist_ok=True)
     
     # Guarda el archivo temporalmente antes de pasarlo a la tarea
     video_filename = video_file.filename
     video_path = os.path.join(session_upload_dir, video_filename)
-    video_file.save(video_path)
+    with metrics.stage('upload_save', split_mode, session_id=session_id):
+        content_hash = save_and_hash(video_file, video_path) # Calcula el hash mientras guarda, sin releer el archivo
+
+    return submit_split_job(session_id, video_path, content_hash, chunk_duration, split_mode, speed_profile, renditions,
+                            request_client_id())
+
+
+# --- Subidas por partes (reanudables) ---
+# 1. POST /api/uploads                 -> crea la subida (filename, size, chunkDuration, splitMode, speedProfile, renditions)
+# 2. PATCH /api/uploads/<id>           -> añade bytes; cabecera Upload-Offset con el offset actual
+# 3. HEAD|GET /api/uploads/<id>        -> consulta el offset para reanudar tras un corte
+# 4. POST /api/uploads/<id>/commit     -> termina la subida y encola la división
+# Para contenedores "streamables" (.ts, .mkv, ...) la división empieza en el paso 1 (salvo con renditions).
 
+def get_upload_or_error(upload_id):
+    if not upload_id or ".." in upload_id or "/" in upload_id:
+        return None, None, (jsonify({"error": "Invalid upload ID."}), 400)
+    session_upload_dir = os.path.join(UPLOAD_FOLDER, upload_id)
+    state = chunked_upload.read_state(session_upload_dir)
+    if state is None:
+        return None, None, (jsonify({"error": "Upload not found"}), 404)
+    return session_upload_dir, state, None
+
+
+@app.route('/api/uploads', methods=['POST'])
+@cross_origin()
+def init_chunked_upload():
+    values = request.get_json(silent=True) or request.form
+    filename = secure_filename(values.get('filename', ''))
+    if not filename:
+        return jsonify({"error": "No filename provided"}), 400
+
+    # El tamaño es obligatorio: es lo que se reserva al admitir la subida y el límite de lo que se acepta en los PATCH
     try:
-        chunk_duration = int(chunk_duration_str)
-        if chunk_duration <= 0:
-            return jsonify({"error": "Chunk duration must be a positive integer"}), 400
+        total_size = int(values.get('size'))
+    except (ValueError, TypeError):
+        return jsonify({"error": "Missing or invalid size. Declare the total upload size in bytes."}), 400
+    if total_size <= 0:
+        return jsonify({"error": "Invalid size. Must be a positive integer."}), 400
+    if MAX_UPLOAD_BYTES and total_size > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"File too large. Maximum is {MAX_UPLOAD_BYTES} bytes."}), 413
+
+    chunk_duration, split_mode, speed_profile, error_response = parse_split_options(values)
+    if not error_response:
+        renditions, error_response = parse_renditions(values, chunk_duration, split_mode)
+    if error_response:
+        return error_response
+
+    session_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    if not admit_session(session_id, total_size):
+        return insufficient_storage_response()
+    session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
+    client_id = request_client_id()
+    state = chunked_upload.create_upload(session_upload_dir, filename, total_size, chunk_duration, split_mode, speed_profile,
+                                         renditions, client_id)
+
+    response = {
+        "message": "Upload created",
+        "upload_id": session_id,
+        "session_id": session_id,
+        "upload_url": f"/api/uploads/{session_id}",
+        "offset": 0,
+        "streaming": state['streaming']
+    }
+    if state['streaming']:
+        # El contenedor se puede leer mientras crece: la división empieza ya, en el carril de subidas en streaming
+        # y con el mismo límite de trabajos por cliente que el resto (si no hay plaza, espera como los demás)
+        task_id = uuid()
+        lane = job_lanes.STREAMING_LANE
+        job = {'task_id': task_id, 'session_id': session_id, 'task': process_growing_upload_task.name, 'args': (session_id,),
+               'kwargs': {'lane': lane, 'client_id': client_id}}
+        # Estado e índice antes de enviarla, como en submit_split_job: la tarea los lee y los actualiza al empezar
+        chunked_upload.update_state(session_upload_dir, task_id=task_id)
+        session_index.mark_queued(session_id, task_id)
+        waiting_position = job_lanes.acquire(lane, client_id, job)
+        if not waiting_position:
+            dispatch_split_job(job)
+        response.update({"task_id": task_id, "status_url": f"/api/task_status/{task_id}", "lane": lane,
+                         "waiting_position": waiting_position})
+    return jsonify(response), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+@cross_origin()
+def get_chunked_upload(upload_id):
+    session_upload_dir, state, error_response = get_upload_or_error(upload_id)
+    if error_response:
+        return error_response
+    offset = chunked_upload.current_offset(state['video_path'])
+    response = jsonify({
+        "upload_id": upload_id,
+        "offset": offset,
+        "size": state['total_size'],
+        "committed": state['committed'],
+        "task_id": state['task_id']
+    })
+    response.headers['Upload-Offset'] = str(offset)
+    return response
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@cross_origin()
+def append_chunked_upload(upload_id):
+    session_upload_dir, state, error_response = get_upload_or_error(upload_id)
+    if error_response:
+        return error_response
+    if state['committed']:
+        return jsonify({"error": "Upload already committed"}), 409
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
     except ValueError:
-        return jsonify({"error": "Invalid chunk duration. Must be an integer."}), 400
+        return jsonify({"error": "Missing or invalid Upload-Offset header"}), 400
 
-    # Enviar la tarea de procesamiento a Celery
-    task = process_video_task.delay(video_path, chunk_duration, session_id)
-    
-    # Devolver el ID de la tarea inmediatamente al cliente
-    return jsonify({
-        "message": "Video processing started successfully",
-        "task_id": task.id,
-        "session_id": session_id, # Enviamos el session_id desde el inicio
-        "status_url": f"/api/task_status/{task.id}" # URL para chequear estado
-    }), 202 # Código 202 Accepted significa que la solicitud fue aceptada para procesamiento
+    # Subidas creadas antes de exigir el tamaño: como mucho MAX_UPLOAD_BYTES
+    limit = state['total_size'] or MAX_UPLOAD_BYTES
+    if not limit:
+        return jsonify({"error": "Upload has no declared size. Create it again with its size."}), 409
+    # Rechazo temprano si la cabecera ya lo dice; el límite real se aplica a los bytes escritos
+    if offset + (request.content_length or 0) > limit:
+        return jsonify({"error": "Chunk exceeds the declared upload size"}), 413
 
-    # En caso de error inesperado al guardar o llamar a Celery
-    return jsonify({"error": "An unexpected error occurred."}), 500
+    # request.stream se lee por bloques directamente al archivo: memoria constante
+    try:
+        with metrics.stage('upload_chunk', state['split_mode'], session_id=upload_id, offset=offset):
+            ok, new_offset = chunked_upload.append_chunk(state['video_path'], offset, request.stream, limit)
+    except chunked_upload.UploadTooLarge:
+        return jsonify({"error": "Chunk exceeds the declared upload size"}), 413
+    if not ok:
+        response = jsonify({"error": "Offset mismatch. Resume from the returned offset.", "offset": new_offset})
+        response.headers['Upload-Offset'] = str(new_offset)
+        return response, 409
 
+    session_index.touch(upload_id)
+    response = jsonify({"upload_id": upload_id, "offset": new_offset})
+    response.headers['Upload-Offset'] = str(new_offset)
+    return response
 
-@app.route('/api/task_status/<task_id>', methods=['GET'])
+
+@app.route('/api/uploads/<upload_id>/commit', methods=['POST'])
 @cross_origin()
-def get_task_status(task_id):
+def commit_chunked_upload(upload_id):
+    session_upload_dir, state, error_response = get_upload_or_error(upload_id)
+    if error_response:
+        return error_response
+    if state['committed']:
+        return jsonify({"error": "Upload already committed", "task_id": state['task_id']}), 409
+
+    video_path = state['video_path']
+    offset = chunked_upload.current_offset(video_path)
+    if state['total_size'] is not None and offset != state['total_size']:
+        return jsonify({"error": "Upload incomplete", "offset": offset, "size": state['total_size']}), 409
+
+    content_hash = chunked_upload.hash_file(video_path)
+    speed_profile = state.get('speed_profile') or ffmpeg_tools.DEFAULT_SPEED_PROFILE
+
+    if state['streaming']:
+        # La división ya está en marcha: registramos la clave para que otros envíos idénticos se enganchen
+        cache_key = split_cache_key(content_hash, state['chunk_duration'], state['split_mode'], speed_profile)
+        result_cache.claim_inflight(cache_key, state['task_id'], upload_id)
+        chunked_upload.update_state(session_upload_dir, committed=True, cache_key=cache_key)
+        return jsonify({
+            "message": "Upload committed, processing already in progress",
+            "task_id": state['task_id'],
+            "session_id": upload_id,
+            "status_url": f"/api/task_status/{state['task_id']}"
+        }), 202
+
+    response, status_code = submit_split_job(upload_id, video_path, content_hash, state['chunk_duration'], state['split_mode'], speed_profile,
+                                             state.get('renditions'), state.get('client_id') or request_client_id())
+    if status_code == 202 and os.path.isdir(session_upload_dir):
+        chunked_upload.update_state(session_upload_dir, committed=True, task_id=response.get_json()['task_id'])
+    return response, status_code
+
+
+def import_video(source_path, video_path):
+    """Trae un video de BATCH_IMPORT_FOLDER a la sesión: enlace duro si es el mismo disco (instantáneo), si no, copia."""
+    try:
+        os.link(source_path, video_path)
+    except OSError:
+        shutil.copyfile(source_path, video_path)
+    return chunked_upload.hash_file(video_path)
+
+
+def submit_batch_item(source, options, client_id):
+    """Un video de /api/batch_split: source es un FileStorage o una ruta relativa a BATCH_IMPORT_FOLDER."""
+    chunk_duration, split_mode, speed_profile, renditions = options
+    if isinstance(source, str):
+        source_path = safe_join(BATCH_IMPORT_FOLDER, source)
+        if source_path is None or not os.path.isfile(source_path):
+            return jsonify({"error": "File not found in the import folder"}), 404
+        filename = secure_filename(os.path.basename(source_path))
+        size = os.path.getsize(source_path)
+    else:
+        filename = secure_filename(source.filename)
+        source.stream.seek(0, os.SEEK_END)
+        size = source.stream.tell()
+        source.stream.seek(0)
+    if not filename:
+        return jsonify({"error": "Invalid filename"}), 400
+
+    session_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    if not admit_session(session_id, size):
+        return insufficient_storage_response()
+    session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
+    os.makedirs(session_upload_dir, exist_ok=True)
+    video_path = os.path.join(session_upload_dir, filename)
+    with metrics.stage('upload_save', split_mode, session_id=session_id):
+        content_hash = import_video(source_path, video_path) if isinstance(source, str) else save_and_hash(source, video_path)
+    return submit_split_job(session_id, video_path, content_hash, chunk_duration, split_mode, speed_profile, renditions, client_id)
+
+
+@app.route('/api/batch_split', methods=['POST'])
+@cross_origin()
+def batch_split_endpoint():
     """
-    Ruta para que el frontend pueda consultar el estado de una tarea de Celery.
+    Encola varios videos en una sola petición, con las mismas opciones (chunkDuration, splitMode, speedProfile, renditions):
+      - multipart con varios archivos en el campo 'videos', o
+      - JSON {"paths": ["carpeta/video.mp4", ...], ...} con rutas relativas a BATCH_IMPORT_FOLDER.
+    Cada video es un trabajo independiente (task_id y session_id propios) que pasa por la caché, la deduplicación,
+    la admisión y su carril de prioridad. Devuelve un resultado por video, en el mismo orden que la petición.
+    """
+    json_body = request.get_json(silent=True) # solo lee el cuerpo si es JSON
+    if isinstance(json_body, dict):
+        return submit_batch(json_body, server_import=True)
+
+    # Como split_video_endpoint: admisión antes de leer el cuerpo multipart, que al parsearse escribe todos los
+    # archivos en disco. La reserva cubre esas copias temporales hasta que termina la petición; cada video
+    # reserva además su propio espacio al pasar a su sesión.
+    reservation_id = f"batch_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    if not session_index.admit(reservation_id, request.content_length or 0):
+        return insufficient_storage_response()
+    try:
+        return submit_batch(request.form, server_import=False)
+    finally:
+        session_index.forget(reservation_id)
+
+
+def submit_batch(values, server_import):
+    """Resto de batch_split_endpoint, una vez admitido el cuerpo: valida las opciones y encola cada video."""
+    chunk_duration, split_mode, speed_profile, error_response = parse_split_options(values)
+    if not error_response:
+        renditions, error_response = parse_renditions(values, chunk_duration, split_mode)
+    if error_response:
+        return error_response
+
+    if server_import:
+        if not BATCH_IMPORT_FOLDER:
+            return jsonify({"error": "Server-side imports are disabled (BATCH_IMPORT_FOLDER is not set)"}), 403
+        sources = values.get('paths')
+        if not isinstance(sources, list) or not sources or not all(isinstance(path, str) for path in sources):
+            return jsonify({"error": "paths must be a non-empty list of strings"}), 400
+    else:
+        sources = [video_file for video_file in request.files.getlist('videos') if video_file.filename]
+        if not sources:
+            return jsonify({"error": "No video files provided"}), 400
+    if len(sources) > BATCH_MAX_JOBS:
+        return jsonify({"error": f"At most {BATCH_MAX_JOBS} videos per batch"}), 400
+
+    client_id = request_client_id()
+    options = (chunk_duration, split_mode, speed_profile, renditions)
+    jobs = []
+    for source in sources:
+        try:
+            response, status_code = submit_batch_item(source, options, client_id)
+            job = dict(response.get_json(), status_code=status_code)
+        except Exception as e:
+            # Un video que falla no impide encolar el resto del lote
+            print(f"Error submitting batch item {source}: {e}")
+            job = {"error": str(e), "status_code": 500}
+        job['source'] = source if isinstance(source, str) else source.filename
+        jobs.append(job)
+    return jsonify({"jobs": jobs, "submitted": sum(1 for job in jobs if job['status_code'] in (200, 202))}), 200
+
+
+MAX_BATCH_STATUS_IDS = 100
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def result_status(result_data):
     """
+    Convierte el diccionario devuelto por una tarea en la respuesta de /api/task_status.
+    Las tareas no lanzan excepciones: un resultado con status 'error' se informa como FAILURE.
+    """
+    if result_data.get('status') == 'error':
+        return {
+            'state': 'FAILURE',
+            'status': 'Processing failed',
+            'error': result_data.get('message', 'Unknown error'),
+            'traceback': result_data.get('traceback', 'No traceback available'),
+            'session_id': result_data.get('session_id')
+        }
+    return {
+        'state': 'SUCCESS',
+        'status': result_data.get('message', 'Task completed!'),
+        'fragments': result_data.get('fragments', []),
+        'session_id': result_data.get('session_id'),
+        'speed_profile': result_data.get('speed_profile'),
+        'renditions': result_data.get('renditions')
+    }
+
+
+def build_task_status(task_id):
+    """
+    Estado actual de una tarea de Celery en el formato que espera el frontend.
+    Para un envío enganchado a un trabajo idéntico es el estado de ese trabajo, con las URLs de su propia sesión.
+    """
+    follower = result_cache.follower(task_id)
+    if follower:
+        return rebase_result(build_task_status(follower['owner_task_id']), follower['session_id'], follower['owner_session_id'])
+
     task = celery_app.AsyncResult(task_id)
-    
+
     if task.state == 'PENDING':
         # Para PENDING, Celery solo tiene la información básica.
         response = {
@@ -186,54 +1196,238 @@ def get_task_status(task_id):
             'progress': task.info.get('progress', '0%'),
             'session_id': task.info.get('session_id') # session_id se envía en el meta de PROGRESS
         }
+        # El último evento publicado por los workers ya trae el avance por fragmento (una sola lectura de Redis)
+        event = progress_events.last_event(task_id)
+        if event and event.get('state') == 'PROGRESS':
+            response.update({key: value for key, value in event.items() if key != 'state'})
+        else:
+            # Si el planificador ya lanzó el chord, el progreso sale de cuántas subtareas terminaron
+            subtask_ids = task.info.get('subtask_ids')
+            if subtask_ids:
+                finished = ResultSet([celery_app.AsyncResult(subtask_id) for subtask_id in subtask_ids]).completed_count()
+                response['status'] = f'Encoded {finished} of {len(subtask_ids)} subtasks ({task.info.get("total_fragments")} fragments)'
+                response['progress'] = f'{finished / len(subtask_ids) * 100:.2f}%'
     elif task.state == 'SUCCESS':
         # task.result es el valor retornado por la función de la tarea (process_video_task)
-        result_data = task.result # Esto es el diccionario devuelto por process_video_task
-        response = {
-            'state': task.state,
-            'status': result_data.get('message', 'Task completed!'),
-            'fragments': result_data.get('fragments', []),
-            'session_id': result_data.get('session_id') # Asegura que el session_id se obtiene del resultado final
-        }
+        response = result_status(task.result)
     elif task.state == 'FAILURE':
         # task.info contiene los metadatos del error
+        info = task.info if isinstance(task.info, dict) else {'error': str(task.info)}
         response = {
             'state': task.state,
-            'status': task.info.get('status', 'Task failed!'),
-            'error': task.info.get('error', 'Unknown error'),
-            'traceback': task.info.get('traceback', 'No traceback available'),
-            'session_id': task.info.get('session_id')
+            'status': info.get('status', 'Task failed!'),
+            'error': info.get('error', 'Unknown error'),
+            'traceback': info.get('traceback', 'No traceback available'),
+            'session_id': info.get('session_id')
         }
     else: # Si el estado es desconocido o REVOKED, RETRY, etc.
         response = {
             'state': task.state,
             'status': 'Unknown task state or task revoked/retrying.',
-            'info': task.info # Incluir toda la info para depuración
+            'info': str(task.info) # Incluir toda la info para depuración
         }
-    return jsonify(response)
+    return response
+
+
+@app.route('/api/task_status/<task_id>', methods=['GET'])
+@cross_origin()
+def get_task_status(task_id):
+    """
+    Ruta para que el frontend pueda consultar el estado de una tarea de Celery.
+    """
+    return jsonify(build_task_status(task_id))
+
+
+@app.route('/api/task_status', methods=['POST'])
+@cross_origin()
+def get_task_status_batch():
+    """
+    Estado de varias tareas en una sola petición: {"task_ids": ["...", ...]}.
+    Evita que un cliente con muchos trabajos abra una petición de polling por cada uno.
+    """
+    data = request.get_json(silent=True) or {}
+    task_ids = data.get('task_ids')
+    if not isinstance(task_ids, list) or not task_ids:
+        return jsonify({"error": "task_ids must be a non-empty list"}), 400
+    if len(task_ids) > MAX_BATCH_STATUS_IDS:
+        return jsonify({"error": f"At most {MAX_BATCH_STATUS_IDS} task_ids per request"}), 400
+    return jsonify({str(task_id): build_task_status(str(task_id)) for task_id in task_ids})
+
+
+@app.route('/api/task_events/<task_id>', methods=['GET'])
+@cross_origin()
+def task_events(task_id):
+    """
+    Server-Sent Events con el progreso de una tarea: cada fragmento terminado, fps de codificación y ETA.
+    Los workers publican en Redis (progress_events) y aquí solo se reenvía, sin consultar Celery en cada evento.
+    Cada conexión ocupa un hilo mientras dura; en producción usar workers de gunicorn con hilos o gevent.
+    """
+    # Un envío enganchado escucha los eventos del trabajo que produce su resultado
+    follower = result_cache.follower(task_id)
+
+    def generate():
+        pubsub = progress_events.get_client().pubsub(ignore_subscribe_messages=True)
+        try:
+            # Suscribirse antes de leer el estado actual para no perder eventos entre ambos pasos
+            pubsub.subscribe(progress_events.channel_name(follower['owner_task_id'] if follower else task_id))
+            status = build_task_status(task_id)
+            yield f"data: {json.dumps(status)}\n\n"
+            if status['state'] in states.READY_STATES:
+                return
+
+            while True:
+                message = pubsub.get_message(timeout=SSE_KEEPALIVE_SECONDS)
+                if message is None:
+                    # Sin eventos: comprobar que la tarea no terminó sin publicar (p. ej. worker caído) y mantener viva la conexión
+                    status = build_task_status(task_id)
+                    if status['state'] in states.READY_STATES:
+                        yield f"data: {json.dumps(status)}\n\n"
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                payload = message['data'].decode('utf-8') if isinstance(message['data'], bytes) else message['data']
+                if follower:
+                    payload = json.dumps(rebase_result(json.loads(payload), follower['session_id'], follower['owner_session_id']))
+                yield f"data: {payload}\n\n"
+                if json.loads(payload).get('final'):
+                    return
+        finally:
+            pubsub.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # que Nginx no acumule los eventos
+    })
+
+
+def is_task_lost(task_id, queued_at, started_at):
+    """
+    Para el barrido: la tarea de una sesión 'processing' terminó sin actualizar el índice, ningún worker la
+    empezó en QUEUED_JOB_TIMEOUT o un worker la empezó hace más de PROCESSING_JOB_TIMEOUT y no terminó.
+    PENDING no basta: Celery también lo usa para las tareas que siguen en cola.
+    Un trabajo retenido en la lista de espera de su carril no está perdido (caduca con esa lista).
+    """
+    follower = result_cache.follower(task_id) if task_id else None
+    if follower:
+        # Sesión enganchada a otro trabajo: sigue viva mientras lo esté ese trabajo
+        return is_owner_lost(follower['owner_task_id'], follower['owner_session_id'])
+    if task_id and celery_app.AsyncResult(task_id).state in states.READY_STATES:
+        return True
+    if task_id and job_lanes.is_held(task_id):
+        return False
+    if started_at is None:
+        return time.time() - queued_at > QUEUED_JOB_TIMEOUT
+    return time.time() - started_at > PROCESSING_JOB_TIMEOUT
+
+
+def is_owner_lost(task_id, session_id):
+    """
+    Para la deduplicación: el trabajo registrado como productor de un resultado ya no lo va a entregar.
+    Se decide igual que en el barrido, con la fila de su sesión: uno retenido en su carril o en cola sigue vivo
+    aunque lleve más de RESULT_EXPIRES en PENDING.
+    """
+    owner = session_index.get(session_id)
+    if owner is None or owner['state'] in EVICTABLE_STATES:
+        return True
+    if owner['state'] != 'processing':
+        # Todavía subiendo o entre el registro y el encolado
+        return False
+    return is_task_lost(task_id, owner['queued_at'] or owner['created_at'], owner['started_at'])
+
+
+@celery_app.task
+def storage_janitor_task():
+    """
+    Barrido periódico de uploads/ y fragments/ (lo programa celery beat cada STORAGE_JANITOR_INTERVAL segundos):
+    borra sesiones caducadas según RESULT_EXPIRES, subidas abandonadas y, si hace falta, las menos usadas
+    hasta volver a STORAGE_MAX_BYTES. También lanza los trabajos retenidos en un carril que nadie iba a liberar.
+    Requiere un proceso `celery -A app.celery_app beat`.
+    """
+    # Trabajos retenidos cuyo cliente perdió su plaza sin liberarla: se lanzan antes de decidir qué sesiones se perdieron
+    for job in job_lanes.claim_orphaned():
+        dispatch_held_job(job)
+    summary = session_index.sweep(RESULT_EXPIRES, UPLOAD_STALL_TIMEOUT, is_task_lost)
+    metrics.log_event('storage_sweep', removed=len(summary['removed']), freed_bytes=summary['freed_bytes'],
+                      usage_bytes=summary['usage_bytes'])
+    return {'removed': len(summary['removed']), 'freed_bytes': summary['freed_bytes'], 'usage_bytes': summary['usage_bytes']}
+
+
+celery_app.conf.beat_schedule = {
+    'storage-janitor': {'task': storage_janitor_task.name, 'schedule': STORAGE_JANITOR_INTERVAL},
+}
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas del pipeline en formato Prometheus (agregadas de todos los workers en Redis)."""
+    metrics.flush()
+    metrics.redis_roundtrip('web')
+    metrics.flush()
+    try:
+        body = metrics.render()
+    except Exception as e:
+        return jsonify({"error": f"Metrics backend unavailable: {e}"}), 503
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/fragments/<session_id>/<path:filename>')
 @cross_origin()
 def download_fragment(session_id, filename):
-    safe_path = os.path.join(FRAGMENT_FOLDER, session_id)
     # Seguridad básica: Asegúrate de que el filename no intente acceder a rutas superiores
-    if ".." in filename or filename.startswith('/'):
+    if ".." in filename or filename.startswith('/') or ".." in session_id:
         return jsonify({"error": "Invalid filename"}), 400
-    
-    full_file_path = os.path.join(safe_path, filename)
-    
-    if not os.path.exists(full_file_path):
-        return jsonify({"error": "Session or fragment not found"}), 404
-    
+
+    # Último acceso para la limpieza LRU (como mucho una escritura por minuto y sesión)
+    session_index.touch(session_id)
     try:
-        # send_from_directory automáticamente maneja los encabezados para descarga
-        return send_from_directory(safe_path, filename, as_attachment=False) # as_attachment=False para permitir previsualización
+        # Range, ETag/304 y caché larga; con FRAGMENT_SENDFILE_MODE los bytes los envía el proxy
+        return send_fragment(FRAGMENT_FOLDER, f"{session_id}/{filename}", as_attachment=False, immutable=True) # as_attachment=False para permitir previsualización
     except Exception as e:
         print(f"Error serving fragment {filename} for session {session_id}: {e}")
         return jsonify({"error": "Could not serve file."}), 500
 
 
+@app.route('/api/download_all/<session_id>', methods=['GET', 'POST'])
+@cross_origin()
+def download_all_session_fragments(session_id):
+    """
+    Descarga todos los fragmentos de una sesión en un ZIP generado al vuelo.
+    Opcionalmente, un POST con {"filenames": [...]} limita la descarga a esos fragmentos.
+    """
+    if not session_id or ".." in session_id or "/" in session_id:
+        return jsonify({"error": "Invalid session ID."}), 400
+
+    session_fragment_path = os.path.join(FRAGMENT_FOLDER, session_id)
+    if not os.path.isdir(session_fragment_path):
+        return jsonify({"error": "Session not found"}), 404
+
+    data = request.get_json(silent=True) or {}
+    if isinstance(data.get('filenames'), list):
+        # Los fragmentos de una rendition se piden como "<rendition>/fragment_N.mp4"
+        filenames = ['/'.join(filter(None, (secure_filename(part) for part in str(name).split('/')))) for name in data['filenames']]
+    else:
+        # Orden natural: fragment_2 antes que fragment_10; las renditions, cada una en su carpeta dentro del ZIP
+        filenames = []
+        for entry in sorted(os.scandir(session_fragment_path), key=lambda entry: entry.name):
+            if entry.is_dir():
+                filenames += [f"{entry.name}/{name}" for name in os.listdir(entry.path) if name.endswith('.mp4')]
+            elif entry.name.endswith('.mp4'):
+                filenames.append(entry.name)
+        filenames.sort(key=lambda name: (os.path.dirname(name), len(name), name))
+
+    files = [(name, os.path.join(session_fragment_path, name)) for name in filenames
+             if os.path.isfile(os.path.join(session_fragment_path, name))]
+    if not files:
+        return jsonify({"error": "No fragments found for this session"}), 404
+
+    session_index.touch(session_id)
+    return Response(
+        stream_zip(files),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=fragments_{session_id}.zip'}
+    )
+
+
 # Ruta para limpiar archivos de una sesión específica
 @app.route('/api/cleanup/<session_id>', methods=['POST'])
 @cross_origin()
@@ -246,6 +1440,8 @@ def cleanup_session(session_id):
     session_fragment_path = os.path.join(FRAGMENT_FOLDER, session_id)
     
     deleted_paths = []
+    result_cache.forget_session(session_id)
+    session_index.forget(session_id)
     
     if os.path.exists(session_upload_path):
         shutil.rmtree(session_upload_path)
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from datetime import datetime
+
+# --- Benchmark del pipeline de división ---
+# Genera videos sintéticos deterministas con las fuentes lavfi de ffmpeg (testsrc2 + tono senoidal)
+# y divide cada uno con todos los modos, por dos caminos:
+#   inprocess -> split_video_worker del blueprint, en el mismo proceso (como el ProcessPoolExecutor)
+#   celery    -> process_video_task con Celery en modo eager y broker/backend en memoria (sin Redis)
+# Cada caso corre en un proceso Python nuevo para que CPU y RSS máximo no se mezclen entre casos.
+# El resultado es un JSON; con --baseline se compara contra una ejecución anterior y se marcan regresiones.
+#
+# Uso:
+#   python benchmark.py --output bench.json
+#   python benchmark.py --resolutions 640x360 --durations 30 --modes copy exact --runners celery
+#   python benchmark.py --modes reencode --profiles ultrafast veryfast quality
+#   python benchmark.py --output nuevo.json --baseline bench.json --tolerance 0.15
+
+BENCHMARK_VERSION = 1
+DEFAULT_RESOLUTIONS = ['640x360', '1280x720', '1920x1080']
+DEFAULT_DURATIONS = [30, 120]
+DEFAULT_FPS = 30
+DEFAULT_CHUNK_DURATION = 10
+RUNNERS = ('inprocess', 'celery')
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _ffmpeg_binary():
+    import ffmpeg_tools
+    return ffmpeg_tools.get_ffmpeg_binary()
+
+
+def _ffmpeg_version():
+    try:
+        output = subprocess.run([_ffmpeg_binary(), '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        return output.splitlines()[0] if output else None
+    except OSError:
+        return None
+
+
+def generate_video(media_dir, resolution, duration, fps=DEFAULT_FPS):
+    """
+    Crea (o reutiliza) un MP4 H.264/AAC sintético. Mismos parámetros -> mismo archivo:
+    fuentes lavfi deterministas, GOP fijo de 2 s y un solo hilo de codificación.
+    """
+    path = os.path.join(media_dir, f"synthetic_{resolution}_{duration}s_{fps}fps.mp4")
+    if os.path.exists(path):
+        return path
+    tmp_path = path + '.tmp.mp4'
+    subprocess.run([
+        _ffmpeg_binary(), '-hide_banner', '-nostdin', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size={resolution}:rate={fps}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        '-map', '0:v', '-map', '1:a',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-g', str(fps * 2), '-threads', '1',
+        '-c:a', 'aac', '-b:a', '128k', '-fflags', '+bitexact', '-movflags', '+faststart',
+        tmp_path
+    ], check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _peak_rss_bytes(ru_maxrss):
+    # Linux da ru_maxrss en KB; macOS en bytes
+    return ru_maxrss if sys.platform == 'darwin' else ru_maxrss * 1024
+
+
+def _run_inprocess(video_path, chunk_duration, split_mode, speed_profile, output_dir):
+    from blueprints.video_splitter import split_video_worker
+    import cpu_budget
+    import ffmpeg_tools
+
+    progress_queue = queue.Queue()
+    final_fragments_queue = queue.Queue()
+    encoding = ffmpeg_tools.encoding_options(speed_profile, cpu_budget.threads_per_encode()) if speed_profile else None
+    split_video_worker(video_path, chunk_duration, progress_queue, final_fragments_queue, output_dir, split_mode, encoding)
+    fragments = final_fragments_queue.get_nowait()
+    errors = []
+    while not progress_queue.empty():
+        message = progress_queue.get_nowait()
+        if message.startswith('error:'):
+            errors.append(message[len('error:'):].strip())
+    if errors or not fragments:
+        raise RuntimeError(errors[0] if errors else 'No fragments produced')
+    return len(fragments)
+
+
+def _run_celery(video_path, chunk_duration, split_mode, speed_profile, output_dir):
+    # Broker y backend en memoria: hay que fijarlos antes de importar app (se leen al crear celery_app)
+    os.environ['CELERY_BROKER_URL'] = 'memory://'
+    os.environ['CELERY_RESULT_BACKEND'] = 'cache+memory://'
+    import app as app_module
+
+    app_module.celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+    app_module.FRAGMENT_FOLDER = output_dir
+    session_id = 'benchmark'
+    result = app_module.process_video_task.apply(args=(video_path, chunk_duration, session_id, split_mode),
+                                                   kwargs={'speed_profile': speed_profile} if speed_profile else {}).get()
+    if result.get('status') != 'success':
+        raise RuntimeError(result.get('message', 'Task failed'))
+    # Los fragmentos quedan en FRAGMENT_FOLDER/<session_id>; se mueven al directorio medido
+    session_dir = os.path.join(output_dir, session_id)
+    for name in os.listdir(session_dir):
+        os.replace(os.path.join(session_dir, name), os.path.join(output_dir, name))
+    os.rmdir(session_dir)
+    return len(result.get('fragments', []))
+
+
+def run_case(case):
+    """Ejecuta un caso en el proceso actual y devuelve sus métricas."""
+    from result_cache import directory_size
+    import media_probe
+
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    output_dir = os.path.join(work_dir, 'fragments')
+    os.makedirs(output_dir)
+    # Copia de trabajo (process_video_task borra el video al terminar). El probing de cabeceras se hace fuera del
+    # tiempo medido, igual que en producción, donde ocurre al recibir la subida; el índice de keyframes (copy y
+    # exact) lo genera el worker, así que queda dentro.
+    video_path = os.path.join(work_dir, 'source' + os.path.splitext(case['video_path'])[1])
+    shutil.copyfile(case['video_path'], video_path)
+    media_duration = media_probe.get_media_info(video_path)['duration']
+
+    runner = _run_inprocess if case['runner'] == 'inprocess' else _run_celery
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    error = None
+    fragments = 0
+    try:
+        fragments = runner(video_path, case['chunk_duration'], case['split_mode'], case['speed_profile'], output_dir)
+    except Exception as e:
+        error = str(e)
+    wall_seconds = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_seconds = ((self_after.ru_utime - self_before.ru_utime) + (self_after.ru_stime - self_before.ru_stime)
+                   + (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime))
+    bytes_written = directory_size(output_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return dict(
+        case,
+        status='error' if error else 'success',
+        error=error,
+        fragments=fragments,
+        media_seconds=round(media_duration, 3),
+        wall_seconds=round(wall_seconds, 3),
+        realtime_factor=round(media_duration / wall_seconds, 2) if wall_seconds > 0 else None,
+        cpu_seconds=round(cpu_seconds, 3),
+        # El proceso Python y el mayor de sus hijos (ffmpeg) por separado: RUSAGE_CHILDREN da el máximo, no la suma
+        peak_rss_bytes=_peak_rss_bytes(self_after.ru_maxrss),
+        peak_child_rss_bytes=_peak_rss_bytes(children_after.ru_maxrss),
+        bytes_written=bytes_written,
+    )
+
+
+def run_case_isolated(case):
+    """Lanza el caso en un intérprete nuevo (este mismo script con --case) y lee su JSON."""
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+        cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    lines = [line for line in process.stdout.splitlines() if line.startswith('{')]
+    if process.returncode != 0 or not lines:
+        return dict(case, status='error', error=process.stderr.strip()[-2000:] or f'exit code {process.returncode}')
+    return json.loads(lines[-1])
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Devuelve los casos cuyo wall time empeoró más que `tolerance` (fracción) respecto al baseline."""
+    fields = ('runner', 'split_mode', 'speed_profile', 'resolution', 'duration', 'chunk_duration')
+
+    def key(result):
+        return tuple(result.get(field) for field in fields)
+
+    previous = {key(r): r for r in baseline.get('results', []) if r.get('status') == 'success'}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before is None or result.get('status') != 'success':
+            continue
+        change = (result['wall_seconds'] - before['wall_seconds']) / before['wall_seconds']
+        if change > tolerance:
+            regressions.append({'case': dict(zip(fields, key(result))),
+                                'baseline_wall_seconds': before['wall_seconds'],
+                                'wall_seconds': result['wall_seconds'],
+                                'change': round(change, 3)})
+    return regressions
+
+
+def main():
+    import cpu_budget
+    import ffmpeg_tools
+
+    parser = argparse.ArgumentParser(description='Benchmark del pipeline de división de video')
+    parser.add_argument('--resolutions', nargs='+', default=DEFAULT_RESOLUTIONS)
+    parser.add_argument('--durations', nargs='+', type=int, default=DEFAULT_DURATIONS)
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS)
+    parser.add_argument('--chunk-duration', type=int, default=DEFAULT_CHUNK_DURATION)
+    parser.add_argument('--modes', nargs='+', choices=ffmpeg_tools.SPLIT_MODES, default=list(ffmpeg_tools.SPLIT_MODES))
+    parser.add_argument('--profiles', nargs='+', choices=list(ffmpeg_tools.SPEED_PROFILES),
+                        default=[ffmpeg_tools.DEFAULT_SPEED_PROFILE], help='Perfiles de velocidad de codificación')
+    parser.add_argument('--runners', nargs='+', choices=RUNNERS, default=list(RUNNERS))
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), 'video_splitter_benchmark'),
+                        help='Dónde se guardan (y reutilizan) los videos sintéticos')
+    parser.add_argument('--output', default='-', help='Archivo JSON de salida (- para stdout)')
+    parser.add_argument('--baseline', help='JSON de una ejecución anterior para detectar regresiones')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Empeoramiento de wall time tolerado (0.10 = 10%%)')
+    parser.add_argument('--case', help=argparse.SUPPRESS) # uso interno: ejecuta un solo caso
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    os.makedirs(args.media_dir, exist_ok=True)
+    results = []
+    for resolution in args.resolutions:
+        for duration in args.durations:
+            video_path = generate_video(args.media_dir, resolution, duration, args.fps)
+            for runner in args.runners:
+                for split_mode in args.modes:
+                    # La copia no codifica: el perfil no cambia nada y se mide una sola vez
+                    profiles = [None] if split_mode == 'copy' else args.profiles
+                    for speed_profile in profiles:
+                        case = {'runner': runner, 'split_mode': split_mode, 'speed_profile': speed_profile,
+                                'resolution': resolution, 'duration': duration, 'fps': args.fps,
+                                'chunk_duration': args.chunk_duration, 'video_path': video_path}
+                        print(f"Benchmark: {runner} / {split_mode} / {speed_profile or '-'} / {resolution} / {duration}s...",
+                              file=sys.stderr)
+                        result = run_case_isolated(case)
+                        print(f"  -> {result.get('status')} wall={result.get('wall_seconds')}s "
+                              f"x{result.get('realtime_factor')} realtime", file=sys.stderr)
+                        results.append(result)
+
+    report = {
+        'benchmark_version': BENCHMARK_VERSION,
+        'generated_at': datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'available_cpus': cpu_budget.available_cpus(),
+            'ffmpeg': _ffmpeg_version(),
+        },
+        'results': results,
+    }
+    exit_code = 1 if any(r.get('status') != 'success' for r in results) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare_with_baseline(results, json.load(f), args.tolerance)
+        for regression in report['regressions']:
+            print(f"Regresión: {regression['case']} {regression['baseline_wall_seconds']}s -> "
+                  f"{regression['wall_seconds']}s (+{regression['change'] * 100:.1f}%)", file=sys.stderr)
+        if report['regressions']:
+            exit_code = 1
+
+    payload = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(payload)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
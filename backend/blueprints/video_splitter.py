@@ -1,15 +1,20 @@
 import os
 import time
-import zipfile
-import threading
 import queue
 import sys 
 import json 
 
-from flask import Blueprint, request, jsonify, Response, send_from_directory, url_for, current_app, Flask # Importa Flask explícitamente
-from moviepy.editor import VideoFileClip
+from flask import Blueprint, request, jsonify, Response, url_for, current_app, Flask # Importa Flask explícitamente
 from werkzeug.utils import secure_filename
 
+import ffmpeg_tools
+import media_probe
+import metrics
+import cpu_budget
+from job_scheduler import get_scheduler
+from zip_stream import stream_zip, record_crc
+from fragment_delivery import send_fragment
+
 # --- Define un Blueprint para el módulo de división de video ---
 splitter_bp = Blueprint('splitter', __name__)
 
@@ -17,50 +22,74 @@ splitter_bp = Blueprint('splitter', __name__)
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
-# --- Lógica principal de división de video (ejecutada en un hilo separado) ---
-def split_video_worker(video_path, segment_duration, progress_queue, final_fragments_queue, output_folder):
+# --- División con ffmpeg sin recodificar (modos 'copy' y 'exact') ---
+def split_without_reencode(video_path, segment_duration, progress_queue, output_folder, split_mode, encoding=None):
+    # Las cabeceras ya se leyeron al recibir la subida (ver upload_and_split); los keyframes se leen aquí, en el pool
+    media_info = media_probe.get_media_info(video_path, with_keyframes=True)
+    duration = media_info['duration']
+    keyframes = media_info['keyframes']
+    cuts = media_probe.plan_cuts(media_info, segment_duration, split_mode)
+
+    if split_mode == 'copy':
+        progress_queue.put(f"message: Duración total del video: {duration:.2f} segundos. Copiando {len(cuts)} fragmentos sin recodificar.")
+        with metrics.stage('copy_split', split_mode, video=os.path.basename(video_path), fragments=len(cuts)):
+            ffmpeg_tools.copy_split(video_path, cuts, os.path.join(output_folder, "parte_%d.mp4"), start_number=1)
+        progress_queue.put("overall_progress: 100.00")
+        return [f"parte_{i + 1}.mp4" for i in range(len(cuts))]
+
+    video_stream = media_info['video']
+    progress_queue.put(f"message: Duración total del video: {duration:.2f} segundos. Se crearán {len(cuts)} fragmentos.")
+    fragment_filenames = []
+    for fragment_index, (start_time, end_time) in enumerate(cuts, start=1):
+        fragment_filename = f"parte_{fragment_index}.mp4"
+        progress_queue.put(f"message: Procesando fragmento {fragment_index} de {len(cuts)}...")
+        with metrics.stage('exact_segment', split_mode, fragment=fragment_filename):
+            ffmpeg_tools.exact_segment(video_path, start_time, end_time, os.path.join(output_folder, fragment_filename), keyframes, video_stream, encoding)
+        fragment_filenames.append(fragment_filename)
+        progress_queue.put(f"overall_progress: {end_time / duration * 100:.2f}")
+    return fragment_filenames
+
+# --- Modo reencode: una sola pasada de decodificación para todos los fragmentos ---
+def split_with_reencode(video_path, segment_duration, progress_queue, output_folder, encoding=None):
+    media_info = media_probe.get_media_info(video_path)
+    duration = media_info['duration']
+    cuts = media_probe.plan_cuts(media_info, segment_duration, 'reencode')
+    progress_queue.put(f"message: Duración total del video: {duration:.2f} segundos. Se crearán {len(cuts)} fragmentos.")
+    progress_queue.put(f"message: Procesando fragmento 1 de {len(cuts)}...")
+
+    fragment_filenames = []
+    last_done = [time.perf_counter()]
+
+    def on_segment(fragment_filename):
+        # ffmpeg avisa al cerrar cada fragmento, mientras sigue decodificando el siguiente
+        fragment_index = len(fragment_filenames) + 1
+        start_time, end_time = cuts[fragment_index - 1]
+        now = time.perf_counter()
+        metrics.fragment_encoded('reencode', end_time - start_time, now - last_done[0], (media_info['video'] or {}).get('fps'),
+                                 fragment=fragment_filename)
+        last_done[0] = now
+        fragment_filenames.append(fragment_filename)
+        progress_queue.put(f"overall_progress: {end_time / duration * 100:.2f}")
+        if fragment_index < len(cuts):
+            progress_queue.put(f"message: Procesando fragmento {fragment_index + 1} de {len(cuts)}...")
+
+    with metrics.stage('encode_split', 'reencode', video=os.path.basename(video_path), fragments=len(cuts)):
+        ffmpeg_tools.encode_split(video_path, cuts, os.path.join(output_folder, "parte_%d.mp4"), start_number=1, on_segment=on_segment, encoding=encoding)
+    return fragment_filenames
+
+# --- Lógica principal de división de video (ejecutada en un proceso del JobScheduler) ---
+def split_video_worker(video_path, segment_duration, progress_queue, final_fragments_queue, output_folder, split_mode=ffmpeg_tools.DEFAULT_SPLIT_MODE,
+                       encoding=None):
+    # encoding: perfil de velocidad e hilos (ffmpeg_tools.encoding_options), calculados por quien encola el trabajo
     fragment_filenames = []
-    clip = None
     try:
-        clip = VideoFileClip(video_path)
-        duration = clip.duration
-        
-        num_segments = int(duration / segment_duration)
-        if duration % segment_duration != 0:
-            num_segments += 1
-
-        progress_queue.put(f"message: Duración total del video: {duration:.2f} segundos. Se crearán aproximadamente {num_segments} fragmentos.")
-
-        start_time = 0
-        fragment_index = 1
-
-        while start_time < duration:
-            end_time = min(start_time + segment_duration, duration)
-            
-            fragment_filename = f"parte_{fragment_index}.mp4" 
-            fragment_path = os.path.join(output_folder, fragment_filename) 
-            
-            subclip = clip.subclip(start_time, end_time)
-
-            print(f"Moviepy - Construyendo video {fragment_path} (segmento {fragment_index}/{num_segments}).")
-            progress_queue.put(f"message: Procesando fragmento {fragment_index} de {num_segments}...")
-            
-            subclip.write_videofile(
-                fragment_path,
-                codec="libx264",
-                audio_codec="aac",
-                logger='bar', 
-            )
-            
-            fragment_filenames.append(fragment_filename)
-            start_time += segment_duration
-            fragment_index += 1
-
-            overall_percentage = (min(start_time, duration) / duration) * 100
-            progress_queue.put(f"overall_progress: {overall_percentage:.2f}")
-            print(f"Moviepy - Fragmento {fragment_index-1} de {num_segments} terminado.")
-            
-        clip.close()
+        if split_mode == 'reencode':
+            fragment_filenames = split_with_reencode(video_path, segment_duration, progress_queue, output_folder, encoding)
+        else:
+            fragment_filenames = split_without_reencode(video_path, segment_duration, progress_queue, output_folder, split_mode, encoding)
+        # CRC de cada parte mientras sigue en la caché de páginas: /api/download_all no tiene que leerlas dos veces
+        for fragment_filename in fragment_filenames:
+            record_crc(os.path.join(output_folder, fragment_filename))
         progress_queue.put("message: Todos los fragmentos creados.")
 
     except Exception as e:
@@ -68,8 +97,6 @@ def split_video_worker(video_path, segment_duration, progress_queue, final_fragm
         print(f"Error al procesar el video: {e}")
         fragment_filenames = [] 
     finally:
-        if clip:
-            clip.close()
         final_fragments_queue.put(fragment_filenames) 
 
 # --- Rutas API para el Módulo de División de Video ---
@@ -96,22 +123,70 @@ def upload_and_split():
             os.remove(video_path)
         return jsonify({"error": "Duración del segmento inválida."}), 400
 
-    progress_queue = queue.Queue()
-    final_fragments_queue = queue.Queue() 
+    split_mode = request.form.get('split_mode', ffmpeg_tools.DEFAULT_SPLIT_MODE)
+    if split_mode not in ffmpeg_tools.SPLIT_MODES:
+        if os.path.exists(video_path):
+            os.remove(video_path)
+        return jsonify({"error": "Modo de división inválido."}), 400
+
+    speed_profile = request.form.get('speed_profile', ffmpeg_tools.DEFAULT_SPEED_PROFILE)
+    if speed_profile not in ffmpeg_tools.SPEED_PROFILES:
+        if os.path.exists(video_path):
+            os.remove(video_path)
+        return jsonify({"error": "Perfil de velocidad inválido."}), 400
+
+    # Probing al recibir la subida (solo cabeceras): valida el archivo antes de ocupar un puesto en la cola
+    try:
+        media_error = media_probe.validate_media(media_probe.get_media_info(video_path))
+    except Exception as e:
+        media_error = str(e)
+    if media_error:
+        media_probe.remove_with_sidecar(video_path)
+        return jsonify({"error": f"No se pudo leer el video: {media_error}"}), 400
 
     # *** Importante: Capturar la instancia de la aplicación actual ***
     # Esto es más seguro para usar test_request_context() en el generador.
     app_instance = current_app._get_current_object()
 
-    threading.Thread(
-        target=split_video_worker,
-        args=(video_path, segment_duration, progress_queue, final_fragments_queue, app_instance.config['OUTPUT_FOLDER'])
-    ).start()
+    # El trabajo corre en el pool de procesos del planificador; las colas deben poder compartirse entre procesos
+    scheduler = get_scheduler(app_instance.config)
+    progress_queue = scheduler.make_queue()
+    final_fragments_queue = scheduler.make_queue()
+
+    # Los núcleos se reparten entre los trabajos que el planificador ejecuta a la vez
+    encoding = ffmpeg_tools.encoding_options(speed_profile, cpu_budget.threads_per_encode(scheduler.max_workers))
+    job = scheduler.submit(
+        split_video_worker,
+        video_path, segment_duration, progress_queue, final_fragments_queue, app_instance.config['OUTPUT_FOLDER'], split_mode, encoding
+    )
+    if job is None:
+        # Back-pressure: la cola de espera está llena
+        media_probe.remove_with_sidecar(video_path)
+        return jsonify({"error": "El servidor está ocupado. Inténtalo de nuevo en unos minutos."}), 429
 
     # Función generadora para Server-Sent Events (SSE)
     # *** Ahora acepta la instancia de la aplicación como argumento ***
     def generate(app_instance_for_context):
         fragments_generated_successfully = False
+
+        # Mientras el trabajo espera su turno, informamos la posición en la cola
+        last_position = None
+        try:
+            while True:
+                position = scheduler.position(job)
+                if position == 0:
+                    break
+                if position != last_position:
+                    yield f"data: queue_position: {position}\n\n"
+                    yield f"data: message: En cola, posición {position}...\n\n"
+                    last_position = position
+                time.sleep(0.5)
+        except GeneratorExit:
+            # El cliente cerró la conexión antes de empezar: no tiene sentido procesar el video
+            if scheduler.cancel(job):
+                media_probe.remove_with_sidecar(video_path)
+            raise
+
         while True:
             try:
                 msg = progress_queue.get(timeout=0.1) 
@@ -125,6 +200,10 @@ def upload_and_split():
                         fragments_generated_successfully = True
 
             except queue.Empty:
+                if job.state == 'done' and job.error is not None:
+                    # El proceso del pool murió sin poder reportar el error por la cola
+                    yield f"data: error: Error al procesar el video: {str(job.error)}\n\n"
+                    break
                 if fragments_generated_successfully:
                     try:
                         fragment_filenames = final_fragments_queue.get(timeout=5) 
@@ -167,7 +246,7 @@ def upload_and_split():
         time.sleep(1) 
         try:
             if os.path.exists(video_path):
-                os.remove(video_path)
+                media_probe.remove_with_sidecar(video_path)
                 print(f"Archivo original '{os.path.basename(video_path)}' eliminado después del procesamiento.")
             else:
                 print(f"Archivo original '{os.path.basename(video_path)}' ya no existe al intentar eliminarlo.")
@@ -181,7 +260,7 @@ def upload_and_split():
 
 @splitter_bp.route('/download_fragment/<filename>')
 def download_fragment(filename):
-    return send_from_directory(current_app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
+    return send_fragment(current_app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
 
 @splitter_bp.route('/api/download_all', methods=['POST'])
 def download_all_fragments():
@@ -189,13 +268,16 @@ def download_all_fragments():
     if not data or 'filenames' not in data or not isinstance(data['filenames'], list):
         return jsonify({'error': 'Lista de nombres de archivo no válida'}), 400
 
-    filenames = data['filenames']
-    zip_path = 'fragmentos.zip'
-    zipf = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
-    for filename in filenames:
-        filepath = os.path.join(current_app.config['OUTPUT_FOLDER'], filename)
-        if os.path.exists(filepath):
-            zipf.write(filepath, filename)
-    zipf.close()
+    output_folder = current_app.config['OUTPUT_FOLDER']
+    files = []
+    for filename in data['filenames']:
+        filepath = os.path.join(output_folder, secure_filename(filename))
+        if os.path.isfile(filepath):
+            files.append((os.path.basename(filepath), filepath))
 
-    return send_from_directory(os.getcwd(), 'fragmentos.zip', as_attachment=True)
\ No newline at end of file
+    # El ZIP se genera mientras se envía: sin archivo compartido en disco ni espera inicial
+    return Response(
+        stream_zip(files),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=fragmentos.zip'}
+    )
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+
+# --- Subidas por partes (reanudables) ---
+# Cada subida vive en uploads/<session_id>/ con el archivo de video y un upload.json con su estado.
+# El offset de la subida es siempre el tamaño real del archivo en disco, así que para reanudar
+# basta con preguntar el offset y seguir enviando desde ahí. Las partes se escriben directamente
+# al archivo por bloques, con memoria constante sin importar el tamaño total.
+
+STATE_FILENAME = 'upload.json'
+WRITE_BLOCK_SIZE = 1024 * 1024 # 1 MB
+
+# Contenedores que ffmpeg puede leer mientras el archivo todavía está creciendo.
+# Con ellos la división empieza antes de que termine la subida.
+STREAMABLE_EXTENSIONS = {'.ts', '.mts', '.m2ts', '.mkv', '.webm', '.flv'}
+
+
+class UploadTooLarge(Exception):
+    """La parte se sale del tamaño declarado al crear la subida (lo que se reservó en el índice de sesiones)."""
+
+
+def is_streamable(filename):
+    return os.path.splitext(filename)[1].lower() in STREAMABLE_EXTENSIONS
+
+
+def state_path(session_upload_dir):
+    return os.path.join(session_upload_dir, STATE_FILENAME)
+
+
+def write_state(session_upload_dir, state):
+    # Escribe a un temporal y renombra: los lectores nunca ven un JSON a medias
+    tmp_path = state_path(session_upload_dir) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path(session_upload_dir))
+
+
+def read_state(session_upload_dir):
+    try:
+        with open(state_path(session_upload_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def update_state(session_upload_dir, **changes):
+    state = read_state(session_upload_dir)
+    state.update(changes)
+    state['updated_at'] = time.time()
+    write_state(session_upload_dir, state)
+    return state
+
+
+def create_upload(session_upload_dir, filename, total_size, chunk_duration, split_mode, speed_profile=None, renditions=None,
+                  client_id=None):
+    os.makedirs(session_upload_dir, exist_ok=True)
+    video_path = os.path.join(session_upload_dir, filename)
+    open(video_path, 'wb').close()
+    state = {
+        'filename': filename,
+        'video_path': video_path,
+        'total_size': total_size,
+        'chunk_duration': chunk_duration,
+        'split_mode': split_mode,
+        'speed_profile': speed_profile,
+        'renditions': renditions,
+        'client_id': client_id,
+        # La división mientras se sube corta fragmento a fragmento; las renditions esperan al commit (una sola decodificación)
+        'streaming': is_streamable(filename) and not renditions,
+        'committed': False,
+        'task_id': None,
+        'cache_key': None,
+        'created_at': time.time(),
+        'updated_at': time.time(),
+    }
+    write_state(session_upload_dir, state)
+    return state
+
+
+def current_offset(video_path):
+    return os.path.getsize(video_path)
+
+
+def append_chunk(video_path, offset, stream, max_size):
+    """
+    Añade los bytes de `stream` al final del archivo si `offset` coincide con su tamaño actual.
+    Devuelve (ok, nuevo_offset); si el offset no coincide no escribe nada y devuelve el offset real.
+    El límite se aplica a los bytes que llegan de verdad (no a Content-Length, que puede faltar o mentir):
+    si el archivo fuera a pasar de max_size se deshace la parte y se lanza UploadTooLarge.
+    """
+    with open(video_path, 'ab') as f:
+        # Bloqueo exclusivo: dos PATCH simultáneos a la misma subida no pueden intercalar bytes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if offset != size:
+                return False, size
+            remaining = max_size - size
+            while True:
+                block = stream.read(WRITE_BLOCK_SIZE)
+                if not block:
+                    break
+                remaining -= len(block)
+                if remaining < 0:
+                    f.flush()
+                    f.truncate(offset)
+                    raise UploadTooLarge(f"Upload would exceed its declared size of {max_size} bytes")
+                f.write(block)
+            f.flush()
+            return True, os.fstat(f.fileno()).st_size
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(WRITE_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,62 @@
+import os
+
+from celery import signals
+
+# --- Reparto de núcleos entre codificaciones simultáneas ---
+# Sin límite, cada ffmpeg/libx264 lanza tantos hilos como núcleos tiene la máquina; con varios procesos
+# de Celery codificando a la vez la CPU queda sobresuscrita (cambios de contexto y caché desperdiciada).
+# Cada codificación recibe núcleos_disponibles // codificaciones_simultáneas hilos (mínimo 1).
+#   ENCODER_THREADS     -> fija los hilos por codificación (0 = automático)
+#   ENCODE_CONCURRENCY  -> codificaciones simultáneas en toda la máquina (0 = la concurrencia de este worker)
+# Con un worker por carril en la misma máquina (ver job_lanes.py) cada uno solo conoce su propio -c, y
+# repartir todos los núcleos entre él solo sobresuscribe la CPU (4 + 2 + 1 + 8 procesos creyendo que tienen
+# la máquina para ellos). En ese caso ENCODE_CONCURRENCY debe ser la suma de -c de todos los workers de la
+# máquina, igual en todos ellos:
+#   ENCODE_CONCURRENCY=15 celery -A app.celery_app worker -Q split.interactive -c 4
+#   ENCODE_CONCURRENCY=15 celery -A app.celery_app worker -Q split.standard -c 2   (etc.)
+# El valor automático solo es correcto con un único worker por máquina; si el worker atiende solo algunos
+# carriles y no hay ENCODE_CONCURRENCY, se avisa al arrancar.
+
+ENCODER_THREADS = int(os.environ.get('ENCODER_THREADS', '0'))
+ENCODE_CONCURRENCY = int(os.environ.get('ENCODE_CONCURRENCY', '0'))
+
+_worker_concurrency = None
+
+
+def available_cpus():
+    """Núcleos que este proceso puede usar (respeta taskset/cpusets, a diferencia de os.cpu_count())."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def threads_per_encode(concurrency=None):
+    """Hilos para una codificación cuando `concurrency` codificaciones comparten la máquina."""
+    if ENCODER_THREADS:
+        return ENCODER_THREADS
+    concurrency = concurrency or ENCODE_CONCURRENCY or _worker_concurrency or 1
+    return max(1, available_cpus() // concurrency)
+
+
+def _consumes_all_queues(instance):
+    # Un worker con -Q atiende solo parte de las colas: probablemente comparte la máquina con los de otros carriles
+    try:
+        return set(instance.app.amqp.queues.consume_from) >= set(instance.app.amqp.queues)
+    except AttributeError:
+        return True
+
+
+def _on_worker_setup(sender=None, instance=None, **kwargs):
+    # Se ejecuta en el proceso principal del worker antes de crear el pool; los hijos heredan el valor
+    global _worker_concurrency
+    _worker_concurrency = getattr(instance, 'concurrency', None)
+    if not ENCODER_THREADS and not ENCODE_CONCURRENCY and not _consumes_all_queues(instance):
+        print("Aviso: este worker atiende solo algunos carriles y ENCODE_CONCURRENCY no está definido; si comparte "
+              "la máquina con otros workers, definir ENCODE_CONCURRENCY con la suma de sus -c (ver cpu_budget.py)")
+    print(f"Presupuesto de CPU: {available_cpus()} núcleos, concurrencia {ENCODE_CONCURRENCY or _worker_concurrency}"
+          f"{' (toda la máquina)' if ENCODE_CONCURRENCY else ''}, {threads_per_encode()} hilos por codificación")
+
+
+def connect_celery_signals():
+    signals.celeryd_after_setup.connect(_on_worker_setup, weak=False)
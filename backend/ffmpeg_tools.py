@@ -0,0 +1,523 @@
+import os
+import re
+import json
+import shutil
+import subprocess
+import tempfile
+
+# --- Utilidades de ffmpeg/ffprobe para dividir videos sin pasar por moviepy ---
+# ffmpeg se toma de FFMPEG_BINARY (misma variable que usa moviepy) o del binario que trae imageio-ffmpeg.
+# ffprobe no viene con imageio-ffmpeg, así que debe estar instalado en el servidor (apt install ffmpeg).
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+
+# Modos de división disponibles:
+#   reencode -> decodifica y vuelve a codificar cada fragmento (comportamiento original)
+#   copy     -> corta en los keyframes más cercanos y copia los streams sin recodificar
+#   exact    -> corta en el segundo exacto; solo recodifica el GOP que queda partido en cada borde
+SPLIT_MODES = ('reencode', 'copy', 'exact')
+DEFAULT_SPLIT_MODE = 'reencode'
+
+# Perfiles de velocidad de libx264 (parámetro speedProfile): más rápido = archivos más grandes o de menor calidad
+SPEED_PROFILES = {
+    'ultrafast': {'preset': 'ultrafast', 'crf': 26},
+    'veryfast': {'preset': 'veryfast', 'crf': 23},
+    'quality': {'preset': 'slow', 'crf': 20},
+}
+DEFAULT_SPEED_PROFILE = os.environ.get('DEFAULT_SPEED_PROFILE', 'veryfast')
+
+# Margen para comparar timestamps impresos por ffprobe (6 decimales)
+TIMESTAMP_EPSILON = 0.001
+
+# Modo exact: perfiles H.264 (nombres de ffprobe) que libx264 puede reproducir en los bordes recodificados.
+# Con otros perfiles (High 10, 4:2:2, 4:4:4...) el fragmento se recodifica entero.
+SMART_CUT_PROFILES = {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high'}
+
+# Renditions: varias salidas (resolución, recorte de aspecto, bitrate, duración de fragmento) de una sola decodificación
+MAX_RENDITIONS = int(os.environ.get('MAX_RENDITIONS', '5'))
+RENDITION_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+ASPECT_PATTERN = re.compile(r'^([1-9][0-9]{0,2}):([1-9][0-9]{0,2})$')
+BITRATE_PATTERN = re.compile(r'^([0-9]+(?:\.[0-9]+)?)([kKmM]?)$')
+MAX_RENDITION_SIZE = 4096
+
+# Previsualizaciones de cada fragmento: poster y sprite sheet (columnas × filas miniaturas a intervalos regulares)
+POSTER_WIDTH = int(os.environ.get('POSTER_WIDTH', '320'))
+SPRITE_TILE_WIDTH = int(os.environ.get('SPRITE_TILE_WIDTH', '160'))
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 2
+# Intervalo de keyframes por defecto de libx264 (frames)
+X264_DEFAULT_KEYINT = 250
+
+
+_ffmpeg_binary = None
+
+
+def get_ffmpeg_binary():
+    # imageio_ffmpeg se importa aquí y no arriba: el proceso web nunca ejecuta ffmpeg y no debe cargarlo.
+    # La ruta se resuelve una sola vez por proceso (los workers la precargan, ver worker_warmup.py).
+    global _ffmpeg_binary
+    if _ffmpeg_binary is None:
+        binary = os.environ.get('FFMPEG_BINARY')
+        if not binary or binary == 'ffmpeg-imageio':
+            import imageio_ffmpeg
+            binary = imageio_ffmpeg.get_ffmpeg_exe()
+        _ffmpeg_binary = binary
+    return _ffmpeg_binary
+
+
+def _run(cmd):
+    """Ejecuta un comando y lanza RuntimeError con el final de stderr si falla."""
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        stderr_tail = result.stderr.strip()[-2000:]
+        raise RuntimeError(f"{os.path.basename(cmd[0])} failed ({result.returncode}): {stderr_tail}")
+    return result.stdout
+
+
+def _ffmpeg(*args):
+    return _run([get_ffmpeg_binary(), '-hide_banner', '-nostdin', '-y', '-v', 'error', *args])
+
+
+def _ffmpeg_streaming(args, on_line):
+    """
+    Como _ffmpeg, pero entrega cada línea de stdout a on_line mientras ffmpeg sigue trabajando.
+    stderr va a un archivo temporal para que un pipe lleno no bloquee el proceso.
+    """
+    cmd = [get_ffmpeg_binary(), '-hide_banner', '-nostdin', '-y', '-v', 'error', *args]
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+        try:
+            for line in process.stdout:
+                if line.strip():
+                    on_line(line.strip())
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr_tail = stderr_file.read().strip()[-2000:]
+            raise RuntimeError(f"{os.path.basename(cmd[0])} failed ({returncode}): {stderr_tail}")
+
+
+def ffprobe(*args):
+    """Ejecuta ffprobe (solo errores en stderr) y devuelve su salida estándar."""
+    return _run([FFPROBE_BINARY, '-v', 'error', *args])
+
+
+def _ts(value):
+    return f"{value:.6f}"
+
+
+def encoding_options(speed_profile=DEFAULT_SPEED_PROFILE, threads=None, keyint=None):
+    """
+    Ajustes de codificación para un perfil: {'preset', 'crf', 'threads', 'keyint'} (threads None = lo que decida
+    ffmpeg; keyint None = intervalo de keyframes por defecto de libx264, ver preview_keyint).
+    """
+    return dict(SPEED_PROFILES[speed_profile], threads=threads, keyint=keyint)
+
+
+def preview_keyint(fps, fragment_duration):
+    """
+    Intervalo de keyframes (en frames) para fragmentos recodificados con previsualizaciones: fragment_previews solo
+    decodifica keyframes, y con los 250 frames por defecto de libx264 (8-10 s) varias miniaturas seguidas del sprite
+    repetirían la misma imagen. Con un keyframe cada fragment_duration / (SPRITE_COLUMNS × SPRITE_ROWS) segundos
+    cada miniatura tiene el suyo. Nunca más largo que el de libx264; None si no se conocen los fps.
+    """
+    if not fps or not fragment_duration:
+        return None
+    return max(1, min(X264_DEFAULT_KEYINT, int(fps * fragment_duration / (SPRITE_COLUMNS * SPRITE_ROWS))))
+
+
+def _input_args(encoding):
+    # Hilos del decodificador: mismo presupuesto que el codificador
+    if encoding and encoding.get('threads'):
+        return ['-threads', str(encoding['threads'])]
+    return []
+
+
+def _video_encode_args(encoding, video_bitrate=None):
+    encoding = encoding or encoding_options()
+    args = ['-c:v', 'libx264', '-preset', encoding['preset'], '-pix_fmt', 'yuv420p']
+    if video_bitrate:
+        # Bitrate fijo (p. ej. para una plataforma con límite): VBV con el doble de buffer en lugar de CRF
+        args += ['-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2)]
+    else:
+        args += ['-crf', str(encoding['crf'])]
+    if encoding.get('threads'):
+        args += ['-threads', str(encoding['threads'])]
+    if encoding.get('keyint'):
+        args += ['-g', str(encoding['keyint'])]
+    return args
+
+
+# --- Probing ---
+
+def probe_duration(video_path):
+    output = ffprobe('-show_entries', 'format=duration', '-of', 'json', video_path)
+    return float(json.loads(output)['format']['duration'])
+
+
+def probe_video_stream(video_path):
+    """
+    Códec, formato de píxel, perfil y nivel del primer stream de video (lo que necesita exact_segment) y sus fps
+    (avg_frame_rate, como fracción), o None.
+    """
+    output = ffprobe('-select_streams', 'v:0', '-show_entries', 'stream=codec_name,pix_fmt,profile,level,avg_frame_rate', '-of', 'json',
+                     video_path)
+    streams = json.loads(output).get('streams', [])
+    return streams[0] if streams else None
+
+
+def probe_keyframes(video_path, start_time=None):
+    """
+    Devuelve los tiempos (en segundos) de los keyframes del primer stream de video.
+    Solo lee los paquetes (demux), no decodifica ningún frame, así que es rápido incluso en videos largos.
+    Con start_time solo se leen los paquetes desde ese punto (útil para archivos que siguen creciendo).
+    """
+    args = ['-select_streams', 'v:0']
+    if start_time:
+        args += ['-read_intervals', f"{_ts(start_time)}%"]
+    output = ffprobe(*args, '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path)
+    keyframes = []
+    for line in output.splitlines():
+        parts = line.strip().split(',')
+        if len(parts) < 2 or 'K' not in parts[1]:
+            continue
+        try:
+            keyframes.append(float(parts[0]))
+        except ValueError:
+            continue # pts_time puede venir como N/A
+    return sorted(set(keyframes))
+
+
+# --- Planificación de cortes ---
+
+def plan_cuts(duration, chunk_duration, keyframes=None):
+    """
+    Calcula la lista de cortes [(inicio, fin), ...] para un video.
+    Sin keyframes los cortes caen en múltiplos exactos de chunk_duration (modos reencode/exact).
+    Con keyframes cada borde se mueve al keyframe más cercano, para poder copiar sin recodificar (modo copy).
+    """
+    boundaries = [0.0]
+    target = float(chunk_duration)
+    while target < duration - TIMESTAMP_EPSILON:
+        boundary = target
+        if keyframes:
+            boundary = min(keyframes, key=lambda k: abs(k - target))
+        if boundaries[-1] + TIMESTAMP_EPSILON < boundary < duration - TIMESTAMP_EPSILON:
+            boundaries.append(boundary)
+        target += chunk_duration
+    boundaries.append(duration)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def next_cut(start, chunk_duration, keyframes, split_mode, total_duration=None):
+    """
+    Calcula el final del fragmento que empieza en `start` para un archivo que todavía puede estar creciendo.
+    total_duration es None mientras el archivo no está completo; en ese caso devuelve None si aún no llegó
+    ningún keyframe posterior al borde (faltan datos para cerrar el fragmento).
+    """
+    target = start + chunk_duration
+    if total_duration is not None and target >= total_duration - TIMESTAMP_EPSILON:
+        return total_duration
+    if total_duration is None and not any(k > target + TIMESTAMP_EPSILON for k in keyframes):
+        return None
+    if split_mode != 'copy':
+        return target
+    limit = total_duration if total_duration is not None else float('inf')
+    candidates = [k for k in keyframes if start + TIMESTAMP_EPSILON < k < limit - TIMESTAMP_EPSILON]
+    if not candidates:
+        return total_duration
+    return min(candidates, key=lambda k: abs(k - target))
+
+
+# --- Modo copy ---
+
+def copy_split(video_path, cuts, output_pattern, start_number=1):
+    """
+    Divide el video en una sola pasada con el muxer 'segment' de ffmpeg copiando los streams.
+    Los bordes de `cuts` deben caer en keyframes (ver plan_cuts con keyframes).
+    output_pattern usa la sintaxis de ffmpeg, p. ej. '/ruta/fragment_%d.mp4'.
+    """
+    # El muxer corta en el primer keyframe >= a cada tiempo; restamos un margen para no saltarnos el keyframe exacto
+    segment_times = ','.join(_ts(max(start - TIMESTAMP_EPSILON, 0)) for start, _ in cuts[1:])
+    args = ['-i', video_path, '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+            '-f', 'segment', '-reset_timestamps', '1',
+            '-segment_start_number', str(start_number),
+            '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart']
+    if segment_times:
+        args += ['-segment_times', segment_times]
+    _ffmpeg(*args, output_pattern)
+
+
+def copy_segment(video_path, start, end, output_path):
+    """Copia un solo fragmento [start, end) sin recodificar; start debe caer en un keyframe."""
+    # Con -c copy ffmpeg busca el keyframe <= al tiempo pedido; sumamos el margen para caer en `start`
+    _ffmpeg('-ss', _ts(start + TIMESTAMP_EPSILON), '-i', video_path, '-t', _ts(end - start),
+            '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+            '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', output_path)
+
+
+# --- Modos reencode y exact ---
+
+def encode_split(video_path, cuts, output_pattern, start_number=1, on_segment=None, encoding=None):
+    """
+    Recodifica fragmentos consecutivos en una sola pasada: ffmpeg decodifica el rango [primer inicio, último fin)
+    una vez y en orden, fuerza un keyframe en cada borde y el muxer 'segment' pasa a un archivo nuevo en cada uno.
+    El trabajo de decodificación es proporcional a la duración del rango, no al número de fragmentos, y los
+    frames nunca salen de ffmpeg (sus colas de frames son acotadas y reutilizadas).
+    on_segment(nombre_de_archivo) se llama cada vez que se cierra un fragmento.
+    encoding: ajustes de encoding_options (perfil de velocidad e hilos).
+    """
+    start, end = cuts[0][0], cuts[-1][1]
+    args = [*_input_args(encoding), '-ss', _ts(start), '-i', video_path, '-t', _ts(end - start),
+            '-map', '0:v:0', '-map', '0:a:0?', *_video_encode_args(encoding), '-c:a', 'aac',
+            *_segment_output_args(cuts, start, start_number), output_pattern]
+
+    def on_line(line):
+        if on_segment:
+            on_segment(os.path.basename(line.split(',')[0]))
+
+    _ffmpeg_streaming(args, on_line)
+
+
+def _segment_output_args(cuts, start, start_number, list_entry_prefix=None):
+    # Tiempos relativos al inicio del rango: con -ss antes de -i la salida empieza en 0
+    boundaries = [cut_start - start for cut_start, _ in cuts[1:]]
+    args = []
+    if boundaries:
+        # El muxer corta en el primer keyframe >= a cada tiempo; restamos el margen para no saltarnos el forzado
+        args += ['-force_key_frames', ','.join(_ts(b) for b in boundaries),
+                 '-segment_times', ','.join(_ts(max(b - TIMESTAMP_EPSILON, 0)) for b in boundaries)]
+    args += ['-f', 'segment', '-reset_timestamps', '1',
+             '-segment_start_number', str(start_number),
+             '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart',
+             # La lista de segmentos va a stdout: una línea "archivo,inicio,fin" al cerrar cada fragmento
+             '-segment_list', 'pipe:1', '-segment_list_type', 'csv']
+    if list_entry_prefix:
+        args += ['-segment_list_entry_prefix', list_entry_prefix]
+    return args
+
+
+# --- Renditions ---
+
+def _parse_bitrate(value):
+    match = BITRATE_PATTERN.match(str(value).strip())
+    if not match:
+        raise ValueError(f"Invalid video_bitrate {value!r}. Use bits per second, e.g. 800k or 2M")
+    multiplier = {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()]
+    bitrate = int(float(match.group(1)) * multiplier)
+    if bitrate < 100000:
+        raise ValueError("video_bitrate must be at least 100k")
+    return bitrate
+
+
+def normalize_renditions(specs, chunk_duration):
+    """
+    Valida una lista de renditions [{name, width, height, aspect, video_bitrate, chunk_duration}, ...]
+    y la devuelve con todas las claves presentes. Lanza ValueError con un mensaje para el cliente.
+    width/height: tamaño de salida (si falta uno se calcula manteniendo la proporción).
+    aspect: 'W:H', recorte centrado antes de escalar (p. ej. '9:16' para vertical).
+    video_bitrate: bitrate fijo ('800k', '2M'); sin él se usa el CRF del perfil de velocidad.
+    chunk_duration: duración de los fragmentos de esta rendition (por defecto, la del trabajo).
+    """
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("renditions must be a non-empty list")
+    if len(specs) > MAX_RENDITIONS:
+        raise ValueError(f"At most {MAX_RENDITIONS} renditions per job")
+
+    renditions = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise ValueError("Each rendition must be an object")
+        name = str(spec.get('name', ''))
+        if not RENDITION_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid rendition name {name!r}. Use 1-32 letters, digits, '-' or '_'")
+        if any(r['name'] == name for r in renditions):
+            raise ValueError(f"Duplicate rendition name {name!r}")
+
+        size = {}
+        for key in ('width', 'height', 'chunk_duration'):
+            value = spec.get(key)
+            if value in (None, ''):
+                size[key] = None
+                continue
+            try:
+                size[key] = int(value)
+            except (ValueError, TypeError):
+                raise ValueError(f"Invalid {key} for rendition {name!r}. Must be an integer")
+            if size[key] <= 0 or (key != 'chunk_duration' and size[key] > MAX_RENDITION_SIZE):
+                raise ValueError(f"Invalid {key} for rendition {name!r}")
+            if key != 'chunk_duration' and size[key] % 2:
+                raise ValueError(f"{key} for rendition {name!r} must be even (required by yuv420p)")
+
+        aspect = spec.get('aspect') or None
+        if aspect is not None and not ASPECT_PATTERN.match(str(aspect)):
+            raise ValueError(f"Invalid aspect for rendition {name!r}. Use W:H, e.g. 9:16")
+
+        video_bitrate = spec.get('video_bitrate')
+        renditions.append({
+            'name': name,
+            'width': size['width'],
+            'height': size['height'],
+            'aspect': str(aspect) if aspect else None,
+            'video_bitrate': _parse_bitrate(video_bitrate) if video_bitrate not in (None, '') else None,
+            'chunk_duration': size['chunk_duration'] or chunk_duration,
+        })
+    return renditions
+
+
+def rendition_filter(rendition):
+    """Cadena de filtros de video de una rendition: recorte centrado al aspecto y escalado."""
+    filters = []
+    if rendition['aspect']:
+        aspect_w, aspect_h = ASPECT_PATTERN.match(rendition['aspect']).groups()
+        # Dimensiones pares para yuv420p; crop centra el recorte por defecto
+        filters.append(f"crop=w='trunc(min(iw,ih*{aspect_w}/{aspect_h})/2)*2':h='trunc(min(ih,iw*{aspect_h}/{aspect_w})/2)*2'")
+    if rendition['width'] or rendition['height']:
+        filters.append(f"scale={rendition['width'] or -2}:{rendition['height'] or -2}")
+    filters.append('setsar=1')
+    return ','.join(filters)
+
+
+def encode_renditions(video_path, start, end, outputs, on_segment=None, encoding=None):
+    """
+    Como encode_split, pero con varias salidas de la misma decodificación: el rango [start, end) se decodifica
+    una vez y filter_complex 'split' reparte cada frame a la cadena de filtros y al libx264 de cada rendition.
+    Cada salida tiene su propio muxer 'segment', así que cada rendition puede cortar en bordes distintos.
+    outputs: [{'rendition': ..., 'cuts': [(inicio, fin), ...], 'output_pattern': ..., 'start_number': n, 'keyint': k}, ...]
+    ('keyint' es opcional: intervalo de keyframes de esa rendition, ver preview_keyint).
+    on_segment(nombre_de_rendition, nombre_de_archivo) se llama cada vez que se cierra un fragmento.
+    """
+    graph = [f"[0:v:0]split={len(outputs)}" + ''.join(f"[s{i}]" for i in range(len(outputs)))]
+    graph += [f"[s{i}]{rendition_filter(output['rendition'])}[v{i}]" for i, output in enumerate(outputs)]
+    # -t va antes de -i: como opción de salida solo afectaría a la primera
+    args = [*_input_args(encoding), '-ss', _ts(start), '-t', _ts(end - start), '-i', video_path,
+            '-filter_complex', ';'.join(graph)]
+
+    # Los libx264 de todas las renditions comparten el presupuesto de hilos del proceso
+    output_encoding = encoding
+    if encoding and encoding.get('threads'):
+        output_encoding = dict(encoding, threads=max(1, encoding['threads'] // len(outputs)))
+    for i, output in enumerate(outputs):
+        rendition = output['rendition']
+        rendition_encoding = output_encoding
+        if output.get('keyint'):
+            rendition_encoding = dict(output_encoding or encoding_options(), keyint=output['keyint'])
+        args += ['-map', f"[v{i}]", '-map', '0:a:0?', *_video_encode_args(rendition_encoding, rendition['video_bitrate']),
+                 '-c:a', 'aac',
+                 # Todas las listas de segmentos van al mismo stdout: el prefijo indica de qué rendition es cada línea
+                 *_segment_output_args(output['cuts'], start, output['start_number'], f"{rendition['name']}/"),
+                 output['output_pattern']]
+
+    def on_line(line):
+        if on_segment:
+            rendition_name, _, filename = line.split(',')[0].partition('/')
+            on_segment(rendition_name, os.path.basename(filename))
+
+    _ffmpeg_streaming(args, on_line)
+
+
+def encode_segment(video_path, start, end, output_path, encoding=None):
+    """Recodifica el fragmento [start, end) completo con libx264/aac."""
+    _ffmpeg(*_input_args(encoding), '-ss', _ts(start), '-i', video_path, '-t', _ts(end - start),
+            '-map', '0:v:0', '-map', '0:a:0?', *_video_encode_args(encoding),
+            '-c:a', 'aac', '-movflags', '+faststart', output_path)
+
+
+def _smart_cut_args(video_stream):
+    """
+    Opciones de libx264 para que los bordes recodificados tengan el mismo perfil y nivel que los GOPs copiados,
+    o None si el video no se puede cortar así (no es H.264 en yuv420p o su perfil no lo reproduce libx264).
+    """
+    video_stream = video_stream or {}
+    profile = SMART_CUT_PROFILES.get(video_stream.get('profile'))
+    if video_stream.get('codec_name') != 'h264' or video_stream.get('pix_fmt') != 'yuv420p' or profile is None:
+        return None
+    args = ['-profile:v', profile]
+    level = video_stream.get('level')
+    if isinstance(level, int) and level > 0:
+        # ffprobe da el nivel multiplicado por 10 (p. ej. 41 = 4.1)
+        args += ['-level:v', f"{level / 10:.1f}"]
+    return args
+
+
+def _encode_video_part(video_path, start, end, output_path, encoding=None, profile_args=()):
+    # -ss antes de -i con recodificación es preciso al frame
+    _ffmpeg(*_input_args(encoding), '-ss', _ts(start), '-i', video_path, '-t', _ts(end - start),
+            '-map', '0:v:0', '-an', *_video_encode_args(encoding), *profile_args,
+            '-f', 'mpegts', output_path)
+
+
+def _copy_video_part(video_path, start, end, output_path):
+    # Con -c copy ffmpeg busca el keyframe <= al tiempo pedido; sumamos el margen para caer en `start`
+    _ffmpeg('-ss', _ts(start + TIMESTAMP_EPSILON), '-i', video_path, '-t', _ts(end - start),
+            '-map', '0:v:0', '-an', '-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb',
+            '-f', 'mpegts', output_path)
+
+
+def exact_segment(video_path, start, end, output_path, keyframes, video_stream=None, encoding=None):
+    """
+    Crea el fragmento [start, end) cortado en el segundo exacto.
+    Solo se recodifican los trozos entre el borde y el keyframe más cercano (el GOP partido);
+    el resto del video se copia tal cual. El audio se recodifica entero porque es barato.
+    video_stream: {'codec_name', 'pix_fmt', 'profile', 'level'} del video (ver probe_video_stream). Los bordes se
+    codifican con el mismo perfil y nivel para que el track no mezcle SPS incompatibles; si el video no es H.264
+    8 bits 4:2:0 (ver _smart_cut_args) o el fragmento no contiene un GOP completo, se recodifica todo el fragmento.
+    """
+    inner = [k for k in keyframes if start - TIMESTAMP_EPSILON <= k <= end + TIMESTAMP_EPSILON]
+    first_key = inner[0] if inner else None
+    last_key = inner[-1] if inner else None
+    profile_args = _smart_cut_args(video_stream)
+
+    if profile_args is None or first_key is None or last_key - first_key < TIMESTAMP_EPSILON:
+        encode_segment(video_path, start, end, output_path, encoding)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='exact_', dir=os.path.dirname(output_path))
+    try:
+        parts = []
+        if first_key - start > TIMESTAMP_EPSILON:
+            parts.append(os.path.join(work_dir, 'head.ts'))
+            _encode_video_part(video_path, start, first_key, parts[-1], encoding, profile_args)
+
+        parts.append(os.path.join(work_dir, 'middle.ts'))
+        _copy_video_part(video_path, first_key, last_key, parts[-1])
+
+        if end - last_key > TIMESTAMP_EPSILON:
+            parts.append(os.path.join(work_dir, 'tail.ts'))
+            _encode_video_part(video_path, last_key, end, parts[-1], encoding, profile_args)
+
+        concat_list = os.path.join(work_dir, 'parts.txt')
+        with open(concat_list, 'w') as f:
+            for part in parts:
+                f.write(f"file '{part}'\n")
+
+        _ffmpeg('-f', 'concat', '-safe', '0', '-i', concat_list,
+                '-ss', _ts(start), '-t', _ts(end - start), '-i', video_path,
+                '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', 'aac',
+                '-movflags', '+faststart', output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# --- Previsualizaciones ---
+
+def fragment_previews(fragment_path, poster_path, sprite_path, duration):
+    """
+    Crea el poster (primer frame, que siempre es keyframe) y el sprite sheet de previsualización de un fragmento
+    ya escrito, en una sola pasada. Con -skip_frame nokey el decodificador solo decodifica los keyframes y descarta
+    el resto de paquetes sin decodificarlos, así que cuesta una fracción de decodificar el fragmento completo.
+    Cada miniatura del sprite muestra el último keyframe anterior a su instante, igual que al saltar en un reproductor:
+    tpad alarga el último keyframe hasta el final y fps reparte SPRITE_COLUMNS × SPRITE_ROWS instantes en la duración.
+    Los fragmentos recodificados llevan un keyframe por miniatura (preview_keyint); en modo copy se ven los del original.
+    Devuelve los datos que necesita el cliente para recortar cada miniatura del sprite.
+    """
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    graph = (f"[0:v:0]split=2[p][s];"
+             f"[p]scale={POSTER_WIDTH}:-2[poster];"
+             f"[s]tpad=stop_mode=clone:stop_duration={_ts(duration)},fps={tiles}/{_ts(duration)},"
+             f"scale={SPRITE_TILE_WIDTH}:-2,tile={SPRITE_COLUMNS}x{SPRITE_ROWS}[sprite]")
+    _ffmpeg('-skip_frame', 'nokey', '-i', fragment_path, '-filter_complex', graph,
+            '-map', '[poster]', '-frames:v', '1', '-q:v', '4', poster_path,
+            '-map', '[sprite]', '-frames:v', '1', '-q:v', '5', sprite_path)
+    return {'columns': SPRITE_COLUMNS, 'rows': SPRITE_ROWS, 'interval': round(duration / tiles, 3)}
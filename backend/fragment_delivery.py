@@ -0,0 +1,76 @@
+import os
+import mimetypes
+
+from flask import request, jsonify, current_app
+from werkzeug.utils import send_file
+from werkzeug.security import safe_join
+
+# --- Entrega eficiente de fragmentos ---
+# Los fragmentos se sirven con:
+#   - peticiones Range (206) para que el <video> del navegador pueda saltar a cualquier punto,
+#   - ETag fuerte + Last-Modified y respuestas 304 condicionales,
+#   - con immutable=True, Cache-Control largo e "immutable" (solo para rutas cuyo contenido nunca se reescribe,
+#     como /fragments/<session_id>/...); si no, "no-cache": el navegador revalida con el ETag en cada uso.
+# Con FRAGMENT_SENDFILE_MODE el proxy (Nginx/Apache) envía los bytes y el worker de gunicorn solo pone cabeceras:
+#   x-accel    -> cabecera X-Accel-Redirect (Nginx). Requiere algo como:
+#                   location /protected-fragments/ { internal; alias /ruta/a/backend/fragments/; }
+#   x-sendfile -> cabecera X-Sendfile (Apache mod_xsendfile, lighttpd)
+#   (vacío)    -> Flask envía el archivo (desarrollo o sin proxy delante)
+FRAGMENT_SENDFILE_MODE = os.environ.get('FRAGMENT_SENDFILE_MODE', '').lower()
+FRAGMENT_ACCEL_PREFIX = os.environ.get('FRAGMENT_ACCEL_PREFIX', '/protected-fragments').rstrip('/')
+FRAGMENT_MAX_AGE = 365 * 24 * 3600 # 1 año, para los fragmentos inmutables
+
+
+def _etag(stat_result):
+    # Tamaño + mtime en nanosegundos: cambia si el archivo se reescribe
+    return f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+
+def send_fragment(root_folder, relative_path, as_attachment=False, immutable=False):
+    """
+    Sirve root_folder/relative_path con soporte de Range y ETag/304.
+    immutable=True solo si esa ruta nunca se reescribe con otro contenido: se cachea un año sin revalidar.
+    relative_path se valida con safe_join, así que no puede salir de root_folder.
+    """
+    full_path = safe_join(root_folder, relative_path)
+    if full_path is None:
+        return jsonify({"error": "Invalid filename"}), 400
+
+    try:
+        # Un solo stat por petición (antes: os.path.exists + el stat de send_from_directory)
+        stat_result = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return jsonify({"error": "Session or fragment not found"}), 404
+
+    if FRAGMENT_SENDFILE_MODE == 'x-accel':
+        response = current_app.response_class(
+            status=200,
+            mimetype=mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        )
+        response.headers['X-Accel-Redirect'] = f"{FRAGMENT_ACCEL_PREFIX}/{relative_path}"
+        response.set_etag(_etag(stat_result))
+        response.last_modified = stat_result.st_mtime
+        if as_attachment:
+            response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(full_path)}"'
+        # Responde 304 aquí mismo si el cliente ya tiene esta versión; los Range los resuelve Nginx
+        response.make_conditional(request.environ)
+    else:
+        response = send_file(
+            full_path,
+            request.environ,
+            as_attachment=as_attachment,
+            conditional=True,
+            etag=_etag(stat_result),
+            last_modified=stat_result.st_mtime,
+            max_age=FRAGMENT_MAX_AGE if immutable else None,
+            use_x_sendfile=FRAGMENT_SENDFILE_MODE == 'x-sendfile',
+            response_class=current_app.response_class,
+        )
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = FRAGMENT_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
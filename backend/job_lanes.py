@@ -0,0 +1,203 @@
+import os
+import json
+
+import redis
+from kombu import Queue
+
+# --- Carriles de prioridad y reparto justo entre clientes ---
+# Cada trabajo de división va a una cola de Celery (un "carril") según su coste estimado: segundos de video
+# × número de renditions × factor del modo (copiar es casi gratis comparado con recodificar). Cada carril
+# tiene sus propios workers, así que un video de 2 horas nunca ocupa el worker que espera un clip de 30 s:
+#   celery -A app.celery_app worker -Q split.interactive -c 4
+#   celery -A app.celery_app worker -Q split.standard -c 2
+#   celery -A app.celery_app worker -Q split.bulk -c 1
+#   celery -A app.celery_app worker -Q split.streaming -c 8
+# El carril 'streaming' es para las subidas que se dividen mientras llegan (process_growing_upload_task): su duración
+# no se conoce al empezar y pasan la mayor parte del tiempo esperando datos, así que tienen sus propios workers.
+# Un worker sin -Q atiende todos los carriles (instalaciones pequeñas, como hasta ahora).
+# Si varios workers de carril comparten máquina, ENCODE_CONCURRENCY debe ser la suma de sus -c (ver cpu_budget.py).
+# Las subtareas del chord van al mismo carril que su trabajo.
+#
+# Reparto justo: dentro de un carril cada cliente tiene como mucho LANE_CLIENT_MAX_INFLIGHT trabajos en la cola
+# de Celery. El resto espera en una lista de Redis por cliente y entra cuando termina uno de los suyos, así que
+# un cliente que envía 100 videos de golpe no deja detrás a todos los demás: cada cliente nuevo espera como
+# mucho LANE_CLIENT_MAX_INFLIGHT trabajos por cliente activo.
+#   LANE_INTERACTIVE_MAX_COST / LANE_STANDARD_MAX_COST -> coste máximo (segundos de video recodificado) de cada carril
+#   LANE_CLIENT_MAX_INFLIGHT                            -> trabajos por cliente y carril en la cola de Celery (0 = sin límite)
+#   LANE_HELD_JOB_TTL                                   -> segundos que una lista de espera sobrevive sin movimiento
+# La lista de espera de un cliente se renueva cada vez que entra o sale un trabajo. Si un trabajo termina sin
+# liberar su plaza (worker caído, chord que nunca llega a collect_fragments_task), el contador caduca a las
+# INFLIGHT_TTL y el barrido periódico (claim_orphaned) lanza los trabajos retenidos de ese cliente.
+# Cada trabajo retenido deja además una marca lanes:held:<task_id> (is_held) para que quien vigila sus tareas
+# (deduplicación, barrido de sesiones) no confunda "retenido" con "perdido".
+
+LANES = ('interactive', 'standard', 'bulk', 'streaming')
+DEFAULT_LANE = 'standard'
+STREAMING_LANE = 'streaming'
+LANE_MAX_COST = {
+    'interactive': float(os.environ.get('LANE_INTERACTIVE_MAX_COST', 10 * 60)),
+    'standard': float(os.environ.get('LANE_STANDARD_MAX_COST', 2 * 3600)),
+}
+SPLIT_MODE_COST_FACTOR = {'reencode': 1.0, 'exact': 0.2, 'copy': 0.02}
+LANE_CLIENT_MAX_INFLIGHT = int(os.environ.get('LANE_CLIENT_MAX_INFLIGHT', '2'))
+LANES_REDIS_URL = os.environ.get('LANES_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'))
+# Si un worker muere sin liberar su plaza, el contador caduca solo
+INFLIGHT_TTL = 6 * 3600
+# Mucho más largo que INFLIGHT_TTL: un trabajo retenido puede esperar a varios trabajos largos del mismo cliente.
+# Mientras tanto el barrido de sesiones no lo da por perdido (is_held); QUEUED_JOB_TIMEOUT en app.py cuenta desde que sale.
+HELD_JOB_TTL = int(os.environ.get('LANE_HELD_JOB_TTL', 7 * 24 * 3600))
+
+# Toma una plaza del cliente en el carril o, si no quedan, deja el trabajo en su lista de espera.
+# Devuelve 0 si hay que lanzarlo ya, o su posición en la lista de espera.
+_ACQUIRE_SCRIPT = """
+local inflight = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) <= 0 or inflight < tonumber(ARGV[1]) then
+    redis.call('INCR', KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 0
+end
+local position = redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('SET', KEYS[3], '1', 'EX', ARGV[4])
+return position
+"""
+
+# Al terminar un trabajo: si el cliente tiene otro esperando, hereda la plaza; si no, se libera
+_RELEASE_SCRIPT = """
+local job = redis.call('LPOP', KEYS[2])
+if job then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return job
+end
+if tonumber(redis.call('GET', KEYS[1]) or '0') > 1 then
+    redis.call('DECR', KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+return false
+"""
+
+# Para el barrido: si el cliente tiene plaza libre (su contador caducó) pero trabajos retenidos, toma la plaza
+# y devuelve el siguiente
+_CLAIM_SCRIPT = """
+local inflight = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > 0 and inflight >= tonumber(ARGV[1]) then
+    return false
+end
+local job = redis.call('LPOP', KEYS[2])
+if not job then
+    return false
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return job
+"""
+
+_client = None
+_scripts = {}
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(LANES_REDIS_URL)
+        _scripts['acquire'] = _client.register_script(_ACQUIRE_SCRIPT)
+        _scripts['release'] = _client.register_script(_RELEASE_SCRIPT)
+        _scripts['claim'] = _client.register_script(_CLAIM_SCRIPT)
+    return _client
+
+
+def queue_name(lane):
+    return f"split.{lane}"
+
+
+def celery_queues():
+    return [Queue(queue_name(lane)) for lane in LANES]
+
+
+def task_options(lane):
+    """Opciones de apply_async/.set() para mandar una tarea a la cola de su carril."""
+    return {'queue': queue_name(lane)} if lane else {}
+
+
+def estimate_cost(duration, split_mode, renditions=None):
+    return duration * SPLIT_MODE_COST_FACTOR.get(split_mode, 1.0) * max(len(renditions or []), 1)
+
+
+def lane_for_cost(cost):
+    for lane in ('interactive', 'standard'):
+        if cost <= LANE_MAX_COST[lane]:
+            return lane
+    return 'bulk'
+
+
+def _keys(lane, client_id):
+    client_id = str(client_id or 'anonymous')[:128]
+    return [f"lanes:{lane}:inflight:{client_id}", f"lanes:{lane}:waiting:{client_id}"]
+
+
+def _held_key(task_id):
+    return f"lanes:held:{task_id}"
+
+
+def _unhold(client, job):
+    job = json.loads(job)
+    client.delete(_held_key(job['task_id']))
+    return job
+
+
+def acquire(lane, client_id, job):
+    """
+    Pide plaza para `job` ({'task_id', 'args', 'kwargs'}) en el carril. Devuelve 0 si se puede lanzar ya
+    o su posición entre los trabajos retenidos del cliente (los lanza release()). Si Redis no responde
+    no se retiene nada: mejor perder el reparto justo que los trabajos.
+    """
+    try:
+        get_client()
+        return _scripts['acquire'](keys=_keys(lane, client_id) + [_held_key(job['task_id'])],
+                                   args=[LANE_CLIENT_MAX_INFLIGHT, json.dumps(job), INFLIGHT_TTL, HELD_JOB_TTL])
+    except Exception as e:
+        print(f"No se pudo reservar plaza en el carril {lane}: {e}")
+        return 0
+
+
+def release(lane, client_id):
+    """Libera la plaza de un trabajo terminado. Devuelve el siguiente trabajo retenido del cliente (para lanzarlo) o None."""
+    try:
+        client = get_client()
+        job = _scripts['release'](keys=_keys(lane, client_id), args=[INFLIGHT_TTL, HELD_JOB_TTL])
+        return _unhold(client, job) if job else None
+    except Exception as e:
+        print(f"No se pudo liberar la plaza del carril {lane}: {e}")
+        return None
+
+
+def is_held(task_id):
+    """True si el trabajo sigue en la lista de espera de su cliente (todavía no se envió a Celery)."""
+    try:
+        return bool(get_client().exists(_held_key(task_id)))
+    except Exception as e:
+        print(f"No se pudo consultar si el trabajo {task_id} está retenido: {e}")
+        return False
+
+
+def claim_orphaned():
+    """
+    Trabajos retenidos de clientes que ya no tienen ninguno en curso en su carril (la plaza se perdió sin release()).
+    Les asigna plaza y los devuelve para que el llamador los lance. Lo usa el barrido periódico.
+    """
+    jobs = []
+    try:
+        client = get_client()
+        for key in client.scan_iter(match='lanes:*:waiting:*'):
+            # El id de cliente puede contener ':' (p. ej. una IPv6)
+            _, lane, _, client_id = key.decode('utf-8').split(':', 3)
+            while True:
+                job = _scripts['claim'](keys=_keys(lane, client_id), args=[LANE_CLIENT_MAX_INFLIGHT, INFLIGHT_TTL])
+                if not job:
+                    break
+                jobs.append(_unhold(client, job))
+    except Exception as e:
+        print(f"No se pudieron recuperar los trabajos retenidos: {e}")
+    return jobs
@@ -0,0 +1,125 @@
+import collections
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# --- Planificador acotado de trabajos de división (ruta SSE del blueprint) ---
+# En lugar de un hilo por petición, los trabajos corren en un pool de procesos con un límite de concurrencia
+# y una cola FIFO de admisión acotada. Al ser procesos, cada codificación usa su propio núcleo sin pelear por el GIL.
+
+# 'spawn' para no heredar los hilos/sockets del worker de gunicorn con fork
+_mp_context = multiprocessing.get_context('spawn')
+
+
+class Job:
+    def __init__(self, job_id, fn, args):
+        self.id = job_id
+        self.fn = fn
+        self.args = args
+        self.state = 'queued' # queued -> running -> done (o cancelled)
+        self.error = None
+
+
+class JobScheduler:
+    def __init__(self, max_workers, max_queued):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._waiting = collections.deque()
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._executor = None
+        self._manager = None
+
+    def make_queue(self):
+        """Cola compartida entre procesos para pasar mensajes de progreso al generador SSE."""
+        with self._lock:
+            if self._manager is None:
+                self._manager = _mp_context.Manager()
+            return self._manager.Queue()
+
+    def submit(self, fn, *args):
+        """
+        Encola fn(*args). Devuelve el Job, o None si la cola de espera está llena (el llamador responde 429).
+        """
+        future = None
+        with self._lock:
+            job = Job(next(self._ids), fn, args)
+            if self._running < self.max_workers:
+                future = self._start(job)
+            elif len(self._waiting) < self.max_queued:
+                self._waiting.append(job)
+            else:
+                return None
+        if future is not None:
+            self._watch([(job, future)])
+        return job
+
+    def position(self, job):
+        """0 si el trabajo ya empezó (o terminó), 1..N si sigue esperando en la cola."""
+        with self._lock:
+            if job.state != 'queued':
+                return 0
+            return self._waiting.index(job) + 1
+
+    def cancel(self, job):
+        """Saca de la cola un trabajo que aún no empezó (p. ej. el cliente cerró la conexión SSE)."""
+        with self._lock:
+            if job.state != 'queued':
+                return False
+            self._waiting.remove(job)
+            job.state = 'cancelled'
+            return True
+
+    def _start(self, job):
+        # Se llama con self._lock tomado. Devuelve el futuro: el llamador lo vigila con _watch al soltar el lock
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_mp_context)
+        try:
+            future = self._executor.submit(job.fn, *job.args)
+        except BrokenProcessPool:
+            # Si un proceso del pool murió (p. ej. OOM), el pool queda inutilizable: se crea uno nuevo
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_mp_context)
+            future = self._executor.submit(job.fn, *job.args)
+        job.state = 'running'
+        self._running += 1
+        return future
+
+    def _watch(self, started):
+        # Fuera de self._lock: si el futuro ya terminó (fallo inmediato, pool roto), add_done_callback llama a
+        # _on_done en este mismo hilo, y _on_done necesita el lock
+        for job, future in started:
+            future.add_done_callback(lambda f, job=job: self._on_done(job, f))
+
+    def _on_done(self, job, future):
+        error = future.exception()
+        if error is not None:
+            print(f"Error en el trabajo {job.id} del planificador: {error}")
+        started = []
+        with self._lock:
+            job.error = error
+            job.state = 'done'
+            self._running -= 1
+            while self._waiting and self._running < self.max_workers:
+                next_job = self._waiting.popleft()
+                started.append((next_job, self._start(next_job)))
+        self._watch(started)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config):
+    """Planificador único por proceso, configurado con SPLITTER_MAX_WORKERS y SPLITTER_MAX_QUEUED."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(
+                max_workers=int(config.get('SPLITTER_MAX_WORKERS') or os.cpu_count() or 1),
+                max_queued=int(config.get('SPLITTER_MAX_QUEUED', 20)),
+            )
+        return _scheduler
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+from fractions import Fraction
+
+import ffmpeg_tools
+
+# --- Índice de probing por subida ---
+# Duración, streams, fps e índice de keyframes se extraen una sola vez con ffprobe (sin decodificar frames)
+# y se guardan en un JSON junto al video (<video>.probe.json). La validación al recibir la subida,
+# la estimación de fragmentos y el plan de cortes de todas las etapas posteriores leen ese archivo
+# en lugar de abrir un VideoFileClip.
+# Al recibir la subida solo se leen las cabeceras (milisegundos). El índice de keyframes obliga a leer todos
+# los paquetes del archivo, así que se genera en el worker la primera vez que se pide (modos copy y exact)
+# y se añade al mismo sidecar; en modo reencode nunca se lee.
+
+PROBE_VERSION = 2 # 2: pix_fmt, perfil y nivel del video (modo exact)
+SIDECAR_SUFFIX = '.probe.json'
+
+
+def sidecar_path(video_path):
+    return video_path + SIDECAR_SUFFIX
+
+
+def parse_rate(rate):
+    # ffprobe da los fps como fracción, p. ej. "30000/1001"
+    try:
+        value = Fraction(rate)
+    except (ValueError, ZeroDivisionError, TypeError):
+        return None
+    return float(value) if value > 0 else None
+
+
+def probe_media(video_path):
+    """Ejecuta ffprobe y devuelve el índice del video, sin keyframes (None) y sin guardarlo."""
+    output = ffmpeg_tools.ffprobe('-show_format', '-show_streams', '-of', 'json', video_path)
+    data = json.loads(output)
+    fmt = data.get('format', {})
+
+    streams = []
+    for stream in data.get('streams', []):
+        streams.append({
+            'index': stream.get('index'),
+            'codec_type': stream.get('codec_type'),
+            'codec_name': stream.get('codec_name'),
+            'pix_fmt': stream.get('pix_fmt'),
+            'profile': stream.get('profile'),
+            'level': stream.get('level'),
+            'width': stream.get('width'),
+            'height': stream.get('height'),
+            'fps': parse_rate(stream.get('avg_frame_rate')) or parse_rate(stream.get('r_frame_rate')),
+            'sample_rate': int(stream['sample_rate']) if stream.get('sample_rate') else None,
+            'channels': stream.get('channels'),
+        })
+
+    video = next((s for s in streams if s['codec_type'] == 'video'), None)
+    duration = fmt.get('duration') or (data.get('streams') or [{}])[0].get('duration')
+    stat_result = os.stat(video_path)
+    return {
+        'version': PROBE_VERSION,
+        'size': stat_result.st_size,
+        'mtime_ns': stat_result.st_mtime_ns,
+        'probed_at': time.time(),
+        'format_name': fmt.get('format_name'),
+        'duration': float(duration) if duration else None,
+        'streams': streams,
+        'video': video,
+        'has_audio': any(s['codec_type'] == 'audio' for s in streams),
+        'keyframes': None,
+    }
+
+
+def _read_sidecar(video_path):
+    stat_result = os.stat(video_path)
+    try:
+        with open(sidecar_path(video_path)) as f:
+            info = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (info.get('version') == PROBE_VERSION and info.get('size') == stat_result.st_size
+            and info.get('mtime_ns') == stat_result.st_mtime_ns):
+        return info
+    return None
+
+
+def _write_sidecar(video_path, info):
+    tmp_path = f"{sidecar_path(video_path)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_path, sidecar_path(video_path))
+
+
+def get_media_info(video_path, with_keyframes=False):
+    """
+    Devuelve el índice del video, leyéndolo del sidecar si sigue siendo válido
+    (mismo tamaño y mtime) o generándolo y guardándolo si no.
+    with_keyframes: incluir también el índice de keyframes; si el sidecar aún no lo tiene se genera
+    (lee todo el archivo) y se guarda. Sin él info['keyframes'] puede ser None.
+    """
+    info = _read_sidecar(video_path)
+    if info is None:
+        info = probe_media(video_path)
+        if not with_keyframes:
+            _write_sidecar(video_path, info)
+    if with_keyframes and info.get('keyframes') is None:
+        info['keyframes'] = ffmpeg_tools.probe_keyframes(video_path) if info['video'] else []
+        _write_sidecar(video_path, info)
+    return info
+
+
+def validate_media(info):
+    """Devuelve un mensaje de error si el archivo no se puede dividir, o None si está bien."""
+    if info.get('video') is None:
+        return "The uploaded file has no video stream"
+    if not info.get('duration') or info['duration'] <= 0:
+        return "Could not determine the video duration"
+    return None
+
+
+def plan_cuts(info, chunk_duration, split_mode):
+    """
+    Plan de cortes a partir del índice: en modo 'copy' los bordes caen en keyframes, así que el índice
+    debe incluirlos (get_media_info(..., with_keyframes=True)).
+    """
+    keyframes = None
+    if split_mode == 'copy':
+        keyframes = info.get('keyframes')
+        if keyframes is None:
+            raise ValueError("The keyframe index is required to plan 'copy' cuts")
+    return ffmpeg_tools.plan_cuts(info['duration'], chunk_duration, keyframes)
+
+
+def remove_with_sidecar(video_path):
+    for path in (video_path, sidecar_path(video_path)):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import redis
+from celery import signals
+
+# --- Métricas del pipeline (formato Prometheus) y logs estructurados ---
+# Los workers de Celery y los procesos de gunicorn son procesos (y máquinas) distintos, así que los contadores
+# se agregan en Redis: cada proceso acumula sus observaciones en memoria y las vuelca con un solo pipeline
+# al terminar cada tarea (o al momento, fuera de una tarea). GET /metrics lee esos hashes y los
+# devuelve en el formato de texto de Prometheus.
+# El coste en el camino caliente es un perf_counter() y una suma en un diccionario por observación.
+#
+# Métricas:
+#   video_splitter_stage_seconds{stage,split_mode}        histograma de cada etapa (upload_save, probe, open, decode, ...)
+#   video_splitter_fragment_encode_fps{split_mode}        fps de codificación de cada fragmento
+#   video_splitter_queue_wait_seconds{task,queue}         desde que se publica la tarea hasta que empieza a ejecutarse (por carril)
+#   video_splitter_task_seconds{task}                     duración de cada tarea de Celery
+#   video_splitter_redis_roundtrip_seconds{role}          PING a Redis desde los workers (por tarea) y desde /metrics
+#   video_splitter_tasks_total{task,outcome}              tareas terminadas por resultado
+#   video_splitter_fragments_total{split_mode}            fragmentos generados
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') not in ('0', 'false', 'no')
+METRICS_REDIS_URL = os.environ.get('METRICS_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'))
+METRIC_PREFIX = 'video_splitter_'
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+FPS_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+# nombre -> (tipo, ayuda, buckets)
+METRICS = {
+    'stage_seconds': ('histogram', 'Time spent in each pipeline stage', DURATION_BUCKETS),
+    'fragment_encode_fps': ('histogram', 'Encode speed of each fragment in frames per second', FPS_BUCKETS),
+    'queue_wait_seconds': ('histogram', 'Time from task publish to task start', DURATION_BUCKETS),
+    'task_seconds': ('histogram', 'Celery task run time', DURATION_BUCKETS),
+    'redis_roundtrip_seconds': ('histogram', 'Redis PING round-trip latency', LATENCY_BUCKETS),
+    'tasks_total': ('counter', 'Finished Celery tasks by outcome', None),
+    'fragments_total': ('counter', 'Fragments written', None),
+}
+
+logger = logging.getLogger('video_splitter')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+_client = None
+_lock = threading.Lock()
+_pending = {} # (clave de Redis, campo) -> incremento pendiente de volcar
+_local = threading.local() # tarea de Celery en curso en este hilo
+_task_started = {}
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(METRICS_REDIS_URL)
+    return _client
+
+
+def _redis_key(name):
+    return f"metrics:{name}"
+
+
+def _label_string(labels):
+    return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()) if value is not None)
+
+
+def _add(name, field, amount):
+    with _lock:
+        key = (_redis_key(name), field)
+        _pending[key] = _pending.get(key, 0) + amount
+
+
+def _flush_if_idle():
+    # Dentro de una tarea se vuelca en task_postrun; fuera (p. ej. en el proceso web) se vuelca ya
+    if getattr(_local, 'task_id', None) is None:
+        flush()
+
+
+def observe(name, value, **labels):
+    """Registra una observación en el histograma `name`."""
+    if not METRICS_ENABLED:
+        return
+    labels_str = _label_string(labels)
+    for bucket in METRICS[name][2]:
+        if value <= bucket:
+            _add(name, f"{labels_str}|{bucket}", 1)
+    _add(name, f"{labels_str}|sum", value)
+    _add(name, f"{labels_str}|count", 1)
+    _flush_if_idle()
+
+
+def inc(name, amount=1, **labels):
+    """Incrementa el contador `name`."""
+    if not METRICS_ENABLED:
+        return
+    _add(name, f"{_label_string(labels)}|value", amount)
+    _flush_if_idle()
+
+
+def flush():
+    """Vuelca las observaciones pendientes a Redis en un solo pipeline. Nunca lanza excepciones."""
+    with _lock:
+        if not _pending:
+            return
+        pending = dict(_pending)
+        _pending.clear()
+    try:
+        pipe = get_client().pipeline(transaction=False)
+        for (key, field), amount in pending.items():
+            if isinstance(amount, float):
+                pipe.hincrbyfloat(key, field, amount)
+            else:
+                pipe.hincrby(key, field, amount)
+        pipe.execute()
+    except Exception as e:
+        print(f"No se pudieron guardar las métricas: {e}")
+
+
+def log_event(event, **fields):
+    """Log estructurado: una línea JSON por evento."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({'event': event, 'ts': round(time.time(), 3), **fields}, default=str))
+
+
+@contextmanager
+def stage(name, split_mode=None, **log_fields):
+    """
+    Mide una etapa del pipeline: la registra en stage_seconds y escribe un log estructurado.
+    log_fields (task_id, session_id, fragmento...) solo van al log, no a las etiquetas de la métrica.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('stage_seconds', elapsed, stage=name, split_mode=split_mode)
+        log_event('stage', stage=name, split_mode=split_mode, seconds=round(elapsed, 4), **log_fields)
+
+
+def fragment_encoded(split_mode, media_seconds, encode_seconds, fps=None, **log_fields):
+    """Registra un fragmento terminado y sus fps de codificación."""
+    inc('fragments_total', split_mode=split_mode)
+    encode_fps = media_seconds * fps / encode_seconds if fps and encode_seconds > 0 else None
+    if encode_fps is not None:
+        observe('fragment_encode_fps', encode_fps, split_mode=split_mode)
+    log_event('fragment_encoded', split_mode=split_mode, media_seconds=round(media_seconds, 3),
+              encode_seconds=round(encode_seconds, 3), encode_fps=round(encode_fps, 1) if encode_fps else None, **log_fields)
+
+
+def redis_roundtrip(role):
+    """Mide un PING a Redis y lo registra; devuelve los segundos o None si Redis no responde."""
+    try:
+        started = time.perf_counter()
+        get_client().ping()
+        elapsed = time.perf_counter() - started
+    except Exception as e:
+        print(f"Redis no responde al PING: {e}")
+        return None
+    observe('redis_roundtrip_seconds', elapsed, role=role)
+    return elapsed
+
+
+# --- Hooks de Celery ---
+
+def _on_before_task_publish(headers=None, **kwargs):
+    # Marca de tiempo de publicación; el worker la lee como self.request.enqueued_at
+    # (web y workers deben tener el reloj sincronizado, p. ej. con NTP)
+    if headers is not None:
+        headers['enqueued_at'] = time.time()
+
+
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    _local.task_id = task_id
+    _task_started[task_id] = time.perf_counter()
+    enqueued_at = getattr(task.request, 'enqueued_at', None)
+    if enqueued_at and not task.request.is_eager:
+        wait = max(time.time() - enqueued_at, 0.0)
+        queue = (task.request.delivery_info or {}).get('routing_key')
+        observe('queue_wait_seconds', wait, task=task.name, queue=queue)
+        log_event('task_started', task=task.name, task_id=task_id, queue=queue, queue_wait_seconds=round(wait, 3))
+    if not task.request.is_eager:
+        redis_roundtrip('worker')
+
+
+def _on_task_postrun(task_id=None, task=None, retval=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    # Las tareas devuelven {"status": "error"} en lugar de lanzar excepciones
+    outcome = 'error' if isinstance(retval, dict) and retval.get('status') == 'error' else (state or 'unknown').lower()
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        observe('task_seconds', elapsed, task=task.name)
+        log_event('task_finished', task=task.name, task_id=task_id, outcome=outcome, seconds=round(elapsed, 3))
+    inc('tasks_total', task=task.name, outcome=outcome)
+    _local.task_id = None
+    flush()
+
+
+def connect_celery_signals():
+    if not METRICS_ENABLED:
+        return
+    signals.before_task_publish.connect(_on_before_task_publish, weak=False)
+    signals.task_prerun.connect(_on_task_prerun, weak=False)
+    signals.task_postrun.connect(_on_task_postrun, weak=False)
+
+
+# --- Exposición ---
+
+def _format_number(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render():
+    """Devuelve todas las métricas en el formato de texto de Prometheus."""
+    client = get_client()
+    pipe = client.pipeline(transaction=False)
+    for name in METRICS:
+        pipe.hgetall(_redis_key(name))
+    stored = dict(zip(METRICS, pipe.execute()))
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        full_name = METRIC_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        series = {}
+        for field, value in stored[name].items():
+            labels_str, _, suffix = field.decode('utf-8').rpartition('|')
+            series.setdefault(labels_str, {})[suffix] = value.decode('utf-8')
+
+        for labels_str, values in sorted(series.items()):
+            if metric_type == 'counter':
+                lines.append(f"{full_name}{{{labels_str}}} {_format_number(values.get('value', 0))}")
+                continue
+            separator = ',' if labels_str else ''
+            for bucket in buckets:
+                count = values.get(str(bucket), 0)
+                lines.append(f'{full_name}_bucket{{{labels_str}{separator}le="{bucket}"}} {_format_number(count)}')
+            lines.append(f'{full_name}_bucket{{{labels_str}{separator}le="+Inf"}} {_format_number(values.get("count", 0))}')
+            lines.append(f"{full_name}_sum{{{labels_str}}} {_format_number(values.get('sum', 0))}")
+            lines.append(f"{full_name}_count{{{labels_str}}} {_format_number(values.get('count', 0))}")
+    return '\n'.join(lines) + '\n'
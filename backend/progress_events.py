@@ -0,0 +1,105 @@
+import os
+import json
+import time
+
+import redis
+
+# --- Eventos de progreso por Redis pub/sub ---
+# Las tareas publican cada avance (fragmento terminado, fps de codificación, ETA) en el canal
+# task_progress:<task_id>; el endpoint SSE /api/task_events/<task_id> los reenvía a los navegadores.
+# Además se guarda una "foto" del último estado en task_progress:<task_id>:state, para que quien
+# se conecte tarde (o el endpoint de estado) lo lea sin consultar cada subtarea de Celery.
+# Publicar nunca debe romper una tarea: cualquier error de Redis solo se registra.
+
+PROGRESS_REDIS_URL = os.environ.get('PROGRESS_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'))
+EVENT_TTL = int(os.environ.get('PROGRESS_EVENT_TTL', 3600)) # igual que result_expires de Celery
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(PROGRESS_REDIS_URL)
+    return _client
+
+
+def channel_name(task_id):
+    return f"task_progress:{task_id}"
+
+
+def _state_key(task_id):
+    return f"task_progress:{task_id}:state"
+
+
+def publish(task_id, event):
+    """Guarda el evento como último estado conocido y lo publica en el canal de la tarea."""
+    try:
+        payload = json.dumps(event)
+        pipe = get_client().pipeline()
+        pipe.hset(_state_key(task_id), 'last_event', payload)
+        pipe.expire(_state_key(task_id), EVENT_TTL)
+        pipe.publish(channel_name(task_id), payload)
+        pipe.execute()
+    except Exception as e:
+        print(f"No se pudo publicar el progreso de la tarea {task_id}: {e}")
+
+
+def job_started(task_id, session_id, total_fragments, status):
+    try:
+        pipe = get_client().pipeline()
+        pipe.hset(_state_key(task_id), mapping={'total': total_fragments, 'done': 0, 'started_at': time.time()})
+        pipe.expire(_state_key(task_id), EVENT_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"No se pudo registrar el inicio de la tarea {task_id}: {e}")
+    publish(task_id, {'state': 'PROGRESS', 'status': status, 'progress': '0.00%', 'session_id': session_id,
+                      'done': 0, 'total': total_fragments})
+
+
+def fragment_done(task_id, session_id, fragment_name, media_seconds, encode_seconds, fps=None):
+    """
+    Registra un fragmento terminado y publica el avance, los fps de codificación y la ETA.
+    La ETA se calcula con el ritmo medio desde el inicio del trabajo (sirve con varias subtareas en paralelo).
+    """
+    try:
+        client = get_client()
+        done = client.hincrby(_state_key(task_id), 'done', 1)
+        total, started_at = client.hmget(_state_key(task_id), 'total', 'started_at')
+        total = int(total) if total else None
+        started_at = float(started_at) if started_at else None
+    except Exception as e:
+        print(f"No se pudo actualizar el progreso de la tarea {task_id}: {e}")
+        return
+
+    event = {
+        'state': 'PROGRESS',
+        'status': f'Fragment {fragment_name} ready ({done} of {total})' if total else f'Fragment {fragment_name} ready',
+        'session_id': session_id,
+        'fragment': fragment_name,
+        'done': done,
+        'total': total,
+        'encode_seconds': round(encode_seconds, 3),
+        'realtime_factor': round(media_seconds / encode_seconds, 2) if encode_seconds > 0 else None,
+        'encode_fps': round(media_seconds * fps / encode_seconds, 1) if fps and encode_seconds > 0 else None,
+    }
+    if total:
+        event['progress'] = f'{done / total * 100:.2f}%'
+        if started_at and done:
+            elapsed = time.time() - started_at
+            event['eta_seconds'] = round(elapsed / done * (total - done), 1)
+    publish(task_id, event)
+
+
+def job_finished(task_id, status_response):
+    """Publica el estado final (mismo formato que /api/task_status) para cerrar los streams abiertos."""
+    publish(task_id, dict(status_response, final=True))
+
+
+def last_event(task_id):
+    try:
+        payload = get_client().hget(_state_key(task_id), 'last_event')
+    except Exception as e:
+        print(f"No se pudo leer el progreso de la tarea {task_id}: {e}")
+        return None
+    return json.loads(payload) if payload else None
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import contextlib
+
+# --- Caché de resultados direccionada por contenido ---
+# La clave es (hash del video, duración de fragmento, modo y ajustes de codificación).
+# Un acierto devuelve la lista de fragmentos ya generada; un envío idéntico a un trabajo en curso
+# se engancha a ese trabajo en lugar de lanzar otro: recibe su propia sesión y un task_id "seguidor",
+# y al terminar el trabajo los fragmentos se enlazan también en su sesión. El índice vive en SQLite
+# dentro de fragments/ para que lo compartan los workers de gunicorn y de Celery.
+
+HASH_CHUNK_SIZE = 1024 * 1024 # 1 MB
+
+
+def make_cache_key(content_hash, chunk_duration, split_mode, codec_settings):
+    payload = json.dumps({
+        'content_hash': content_hash,
+        'chunk_duration': chunk_duration,
+        'split_mode': split_mode,
+        'codec_settings': codec_settings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def save_and_hash(file_storage, destination_path):
+    """Guarda el archivo subido en disco por bloques calculando su SHA-256 al mismo tiempo."""
+    digest = hashlib.sha256()
+    with open(destination_path, 'wb') as f:
+        while True:
+            chunk = file_storage.stream.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def link_tree(source_dir, destination_dir):
+    """
+    Replica un directorio de fragmentos con enlaces duros (copia si el sistema de archivos no los admite).
+    Los enlaces no ocupan espacio extra y cada directorio se puede borrar sin afectar al otro.
+    Devuelve los bytes que sí ocupan espacio nuevo (los de las copias; 0 si todo fueron enlaces).
+    """
+    copied_bytes = 0
+    for root, _, files in os.walk(source_dir):
+        target_root = os.path.join(destination_dir, os.path.relpath(root, source_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target_root, name))
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(target_root, name))
+                copied_bytes += os.path.getsize(os.path.join(target_root, name))
+    return copied_bytes
+
+
+def rebase_result(result, session_id, from_session_id=None):
+    """
+    Copia de un resultado (o de un estado de tarea) con las URLs de sus fragmentos apuntando a otra sesión.
+    from_session_id es la sesión original, si el resultado no la trae (p. ej. un estado PENDING).
+    """
+    from_session_id = from_session_id or result['session_id']
+    payload = json.dumps(result).replace(f"/fragments/{from_session_id}/", f"/fragments/{session_id}/")
+    return dict(json.loads(payload), session_id=session_id)
+
+
+class ResultCache:
+    def __init__(self, fragment_folder, max_bytes):
+        self.fragment_folder = fragment_folder
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(fragment_folder, '.result_cache.sqlite3')
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                cache_key TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL)''')
+            db.execute('''CREATE TABLE IF NOT EXISTS inflight (
+                cache_key TEXT PRIMARY KEY,
+                task_id TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                created_at REAL NOT NULL)''')
+            db.execute('''CREATE TABLE IF NOT EXISTS followers (
+                task_id TEXT PRIMARY KEY,
+                cache_key TEXT NOT NULL,
+                owner_task_id TEXT NOT NULL,
+                owner_session_id TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                created_at REAL NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS followers_owner ON followers (owner_task_id)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Una conexión por operación: es seguro entre hilos y procesos, y SQLite serializa las escrituras
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # --- Resultados terminados ---
+
+    def lookup(self, cache_key):
+        """Devuelve el resultado guardado (y lo marca como usado) o None si no hay o ya no existe en disco."""
+        with self._connect() as db:
+            row = db.execute('SELECT session_id, result FROM results WHERE cache_key = ?', (cache_key,)).fetchone()
+            if row is None:
+                return None
+            session_id, result = row
+            if not os.path.isdir(os.path.join(self.fragment_folder, session_id)):
+                # Los fragmentos se borraron por otra vía (p. ej. /api/cleanup)
+                db.execute('DELETE FROM results WHERE cache_key = ?', (cache_key,))
+                return None
+            db.execute('UPDATE results SET last_access = ? WHERE cache_key = ?', (time.time(), cache_key))
+            return json.loads(result)
+
+    def store(self, cache_key, result):
+        """
+        Guarda el resultado y lo entrega en las sesiones de los envíos enganchados al trabajo que lo produjo.
+        Devuelve {session_id: bytes_nuevos} de esas sesiones (0 si sus fragmentos son enlaces duros).
+        """
+        session_id = result['session_id']
+        size_bytes = directory_size(os.path.join(self.fragment_folder, session_id))
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                       (cache_key, session_id, json.dumps(result), size_bytes, now, now))
+            # Mismo paso que borrar la entrada en curso: add_follower ya no puede engancharse a este trabajo
+            followers = db.execute('''SELECT session_id FROM followers
+                                      WHERE owner_task_id IN (SELECT task_id FROM inflight WHERE cache_key = ?)''',
+                                   (cache_key,)).fetchall()
+            db.execute('DELETE FROM inflight WHERE cache_key = ?', (cache_key,))
+        delivered = {}
+        for (follower_session_id,) in followers:
+            _, new_bytes = self.clone_into(result, follower_session_id)
+            delivered[follower_session_id] = new_bytes
+        self.evict()
+        return delivered
+
+    def clone_into(self, cached_result, session_id):
+        """
+        Entrega un resultado de la caché en una sesión propia del cliente: enlaza los fragmentos de la sesión
+        guardada en fragments/<session_id>/ y devuelve (resultado con las URLs de la nueva sesión, bytes nuevos).
+        Así /api/cleanup de un cliente solo borra sus enlaces, nunca los fragmentos que comparte la caché.
+        Devuelve (None, 0) si los fragmentos guardados desaparecieron entretanto (se trata como un fallo de caché).
+        """
+        source_dir = os.path.join(self.fragment_folder, cached_result['session_id'])
+        destination_dir = os.path.join(self.fragment_folder, session_id)
+        try:
+            new_bytes = link_tree(source_dir, destination_dir)
+        except FileNotFoundError:
+            shutil.rmtree(destination_dir, ignore_errors=True)
+            return None, 0
+        if not os.path.isdir(destination_dir):
+            return None, 0
+        return rebase_result(cached_result, session_id), new_bytes
+
+    def forget_session(self, session_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM results WHERE session_id = ?', (session_id,))
+            db.execute('DELETE FROM inflight WHERE session_id = ?', (session_id,))
+            db.execute('DELETE FROM followers WHERE session_id = ?', (session_id,))
+
+    def evict(self):
+        """Borra los resultados menos usados recientemente hasta quedar por debajo de max_bytes."""
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM results').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = db.execute('SELECT cache_key, session_id, size_bytes FROM results ORDER BY last_access').fetchall()
+            for cache_key, session_id, size_bytes in rows:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.fragment_folder, session_id), ignore_errors=True)
+                db.execute('DELETE FROM results WHERE cache_key = ?', (cache_key,))
+                total -= size_bytes
+                print(f"Caché de resultados: sesión {session_id} eliminada ({size_bytes} bytes)")
+
+    # --- Trabajos en curso ---
+
+    def claim_inflight(self, cache_key, task_id, session_id):
+        """
+        Registra task_id como el trabajo que produce cache_key.
+        Devuelve (task_id, session_id, created_at) del trabajo que quedó registrado:
+        el nuestro o uno que ya estaba en curso.
+        """
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO inflight VALUES (?, ?, ?, ?)', (cache_key, task_id, session_id, time.time()))
+            return db.execute('SELECT task_id, session_id, created_at FROM inflight WHERE cache_key = ?', (cache_key,)).fetchone()
+
+    def add_follower(self, cache_key, owner_task_id, task_id, session_id):
+        """
+        Engancha un envío idéntico (con su propio task_id y sesión) al trabajo owner_task_id.
+        Devuelve False si ese trabajo ya no está en curso (acaba de guardar su resultado o se reemplazó).
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT session_id FROM inflight WHERE cache_key = ? AND task_id = ?',
+                             (cache_key, owner_task_id)).fetchone()
+            if row is None:
+                return False
+            db.execute('INSERT INTO followers VALUES (?, ?, ?, ?, ?, ?)',
+                       (task_id, cache_key, owner_task_id, row[0], session_id, time.time()))
+            return True
+
+    def follower(self, task_id):
+        """El envío enganchado con ese task_id ({'owner_task_id', 'owner_session_id', 'session_id'}) o None."""
+        with self._connect() as db:
+            row = db.execute('SELECT owner_task_id, owner_session_id, session_id FROM followers WHERE task_id = ?',
+                             (task_id,)).fetchone()
+        if row is None:
+            return None
+        return {'owner_task_id': row[0], 'owner_session_id': row[1], 'session_id': row[2]}
+
+    def release_inflight(self, cache_key, task_id=None):
+        with self._connect() as db:
+            if task_id is None:
+                db.execute('DELETE FROM inflight WHERE cache_key = ?', (cache_key,))
+            else:
+                db.execute('DELETE FROM inflight WHERE cache_key = ? AND task_id = ?', (cache_key, task_id))
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+
+# --- Arranque en frío y memoria de los procesos web y worker ---
+# Cada medición lanza un intérprete nuevo que importa app.py como lo haría cada proceso:
+#   web    -> import app (lo que carga cada worker de gunicorn)
+#   worker -> import app + worker_warmup.preload() (lo que hace cada proceso del pool de Celery al arrancar)
+# y devuelve el tiempo de importación, el tiempo total del proceso (incluido el arranque del intérprete),
+# la RSS al terminar y qué módulos pesados (numpy, moviepy, imageio, ...) llegó a cargar.
+# Termina con código 1 si el proceso web carga alguno: así se puede usar como comprobación en CI.
+#
+# Uso:
+#   python startup_profile.py
+#   python startup_profile.py --targets web --repeat 10 --output startup.json
+
+PROFILE_VERSION = 1
+TARGETS = ('web', 'worker')
+DEFAULT_REPEAT = 5
+# Bibliotecas del motor de medios que el proceso web no debe importar
+HEAVY_MODULES = ('numpy', 'scipy', 'moviepy', 'imageio', 'imageio_ffmpeg', 'cv2', 'PIL', 'pydub', 'soundfile', 'audiofile')
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Se ejecuta en el intérprete nuevo; imprime una línea JSON
+_MEASURE_CODE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+if {preload!r}:
+    import worker_warmup
+    worker_warmup.preload()
+import_seconds = time.perf_counter() - started
+import worker_warmup
+print(json.dumps({{
+    'import_seconds': import_seconds,
+    'rss_bytes': worker_warmup._rss_bytes(),
+    'modules': len(sys.modules),
+    'heavy_modules': sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r})),
+}}))
+"""
+
+
+def measure_once(target):
+    """Un arranque en frío de `target` en un proceso nuevo."""
+    code = _MEASURE_CODE.format(preload=target == 'worker', heavy=HEAVY_MODULES)
+    env = dict(os.environ, METRICS_ENABLED=os.environ.get('METRICS_ENABLED', '0'))
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], cwd=BACKEND_DIR, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    process_seconds = time.perf_counter() - started
+    lines = [line for line in process.stdout.splitlines() if line.startswith('{')]
+    if process.returncode != 0 or not lines:
+        raise RuntimeError(process.stderr.strip()[-2000:] or f'exit code {process.returncode}')
+    return dict(json.loads(lines[-1]), process_seconds=process_seconds)
+
+
+def profile_target(target, repeat):
+    """Mediana de `repeat` arranques en frío."""
+    runs = [measure_once(target) for _ in range(repeat)]
+    return {
+        'target': target,
+        'repeat': repeat,
+        'import_seconds': round(statistics.median(r['import_seconds'] for r in runs), 4),
+        'process_seconds': round(statistics.median(r['process_seconds'] for r in runs), 4),
+        'rss_bytes': int(statistics.median(r['rss_bytes'] for r in runs)),
+        'modules': runs[-1]['modules'],
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Arranque en frío y RSS de los procesos web y worker')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--output', default='-', help='Archivo JSON de salida (- para stdout)')
+    args = parser.parse_args()
+
+    results = []
+    for target in args.targets:
+        print(f"Arranque: {target} x{args.repeat}...", file=sys.stderr)
+        result = profile_target(target, args.repeat)
+        print(f"  -> import={result['import_seconds']}s proceso={result['process_seconds']}s "
+              f"rss={result['rss_bytes'] / 1024 / 1024:.1f} MB pesados={result['heavy_modules'] or '-'}", file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'profile_version': PROFILE_VERSION,
+        'generated_at': datetime.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    payload = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(payload)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+    # El proceso web no debe cargar el motor de medios
+    return 1 if any(r['target'] == 'web' and r['heavy_modules'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
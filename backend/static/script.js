@@ -1,11 +1,18 @@
 // script.js
 const API_BASE_URL = window.location.origin; // Esto detecta automáticamente "http://tu_ip" o "https://tu_dominio"
+const CHUNKED_UPLOAD_THRESHOLD = 50 * 1024 * 1024; // A partir de 50 MB se sube por partes
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024; // 8 MB por parte
+const UPLOAD_MAX_RETRIES = 5;
 
 document.getElementById('uploadForm').addEventListener('submit', async function(event) {
     event.preventDefault(); // Evita el envío del formulario tradicional
 
     const videoInput = document.getElementById('videoFile');
     const chunkDurationInput = document.getElementById('chunkDuration');
+    const splitModeInput = document.getElementById('splitMode');
+    const speedProfileInput = document.getElementById('speedProfile');
+    // Cada casilla marcada es una rendition de la misma decodificación; con alguna marcada, solo se generan las marcadas
+    const renditions = Array.from(document.querySelectorAll('input[name="rendition"]:checked'), input => JSON.parse(input.value));
     const statusDiv = document.getElementById('status');
     const resultsDiv = document.getElementById('results');
     const progressBar = document.getElementById('progressBar');
@@ -21,29 +28,51 @@ document.getElementById('uploadForm').addEventListener('submit', async function(
         return;
     }
 
+    const videoFile = videoInput.files[0];
     const formData = new FormData();
-    formData.append('video', videoInput.files[0]);
+    formData.append('video', videoFile);
     formData.append('chunkDuration', chunkDurationInput.value);
+    formData.append('splitMode', splitModeInput.value);
+    formData.append('speedProfile', speedProfileInput.value);
+    if (renditions.length > 0) {
+        formData.append('renditions', JSON.stringify(renditions));
+    }
 
     try {
         statusDiv.textContent = 'Uploading video...';
-        const response = await fetch(`${API_BASE_URL}/api/split_video`, {
-            method: 'POST',
-            body: formData
-        });
+        let data;
+        if (videoFile.size > CHUNKED_UPLOAD_THRESHOLD) {
+            // Archivos grandes: subida por partes, reanudable y sin el límite de 500 MB
+            data = await uploadInChunks(videoFile, chunkDurationInput.value, splitModeInput.value, speedProfileInput.value, renditions);
+        } else {
+            const response = await fetch(`${API_BASE_URL}/api/split_video`, {
+                method: 'POST',
+                body: formData
+            });
 
-        if (!response.ok) {
-            const errorData = await response.json();
-            throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+            }
+
+            data = await response.json();
+        }
+
+        // El mismo video con los mismos ajustes ya se procesó: el backend devuelve los fragmentos directamente
+        if (data.cached) {
+            statusDiv.textContent = `Status: ${data.message}`;
+            progressBar.style.width = '100%';
+            progressBar.textContent = '100%';
+            displayDownloadLinks(data.fragments, data.session_id);
+            return;
         }
 
-        const data = await response.json();
         const taskId = data.task_id;
         const sessionId = data.session_id; // Recibimos el session_id desde el inicio
-        statusDiv.textContent = `Video uploaded. Processing started (Task ID: ${taskId}). Polling status...`;
+        statusDiv.textContent = `Video uploaded. Processing started (Task ID: ${taskId}). Waiting for progress...`;
         
-        // Iniciar el sondeo para el estado de la tarea
-        pollTaskStatus(taskId, sessionId);
+        // Seguir el progreso por eventos del servidor (con sondeo como respaldo)
+        watchTaskProgress(taskId, sessionId);
 
     } catch (error) {
         console.error('Error:', error);
@@ -55,6 +84,134 @@ document.getElementById('uploadForm').addEventListener('submit', async function(
 });
 
 
+async function uploadInChunks(file, chunkDuration, splitMode, speedProfile, renditions) {
+    const statusDiv = document.getElementById('status');
+    const progressBar = document.getElementById('progressBar');
+
+    const initResponse = await fetch(`${API_BASE_URL}/api/uploads`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            filename: file.name, size: file.size, chunkDuration: chunkDuration, splitMode: splitMode, speedProfile: speedProfile,
+            renditions: renditions.length > 0 ? renditions : undefined
+        })
+    });
+    if (!initResponse.ok) {
+        const errorData = await initResponse.json();
+        throw new Error(errorData.error || `HTTP error! status: ${initResponse.status}`);
+    }
+    const upload = await initResponse.json();
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        try {
+            const response = await fetch(`${API_BASE_URL}${upload.upload_url}`, {
+                method: 'PATCH',
+                headers: { 'Upload-Offset': String(offset) },
+                body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE)
+            });
+            if (!response.ok && response.status !== 409) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            // En un 409 el servidor nos dice desde dónde seguir
+            offset = (await response.json()).offset;
+            retries = 0;
+        } catch (error) {
+            if (++retries > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            // Tras un corte de red preguntamos al servidor cuántos bytes recibió y reanudamos desde ahí
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            const headResponse = await fetch(`${API_BASE_URL}${upload.upload_url}`, { method: 'HEAD' });
+            if (headResponse.ok) {
+                offset = parseInt(headResponse.headers.get('Upload-Offset'), 10);
+            }
+        }
+        const uploadPercent = `${(offset / file.size * 100).toFixed(2)}%`;
+        statusDiv.textContent = `Uploading video... ${uploadPercent}`;
+        progressBar.style.width = uploadPercent;
+        progressBar.textContent = `Upload ${uploadPercent}`;
+    }
+
+    const commitResponse = await fetch(`${API_BASE_URL}${upload.upload_url}/commit`, { method: 'POST' });
+    if (!commitResponse.ok) {
+        const errorData = await commitResponse.json();
+        throw new Error(errorData.error || `HTTP error! status: ${commitResponse.status}`);
+    }
+    return commitResponse.json();
+}
+
+
+// Muestra un estado de tarea (mismo formato en /api/task_status y en /api/task_events).
+// Devuelve true si la tarea ya terminó.
+function showTaskStatus(data) {
+    const statusDiv = document.getElementById('status');
+    const progressBar = document.getElementById('progressBar');
+
+    let statusText = `Status: ${data.status}`;
+    if (data.eta_seconds !== undefined && data.eta_seconds !== null) {
+        statusText += ` · ETA ${Math.round(data.eta_seconds)}s`;
+    }
+    if (data.encode_fps) {
+        statusText += ` · ${data.encode_fps} fps`;
+    }
+    statusDiv.textContent = statusText;
+
+    if (data.progress) {
+        progressBar.style.width = data.progress;
+        progressBar.textContent = data.progress;
+    }
+
+    if (data.state === 'SUCCESS') {
+        statusDiv.textContent = `Status: ${data.status}`;
+        progressBar.style.width = '100%';
+        progressBar.textContent = '100%';
+        progressBar.style.backgroundColor = '#4CAF50'; // Green for success
+        displayDownloadLinks(data.fragments, data.session_id); // Usamos data.session_id
+        // Opcional: Limpiar archivos después de un tiempo o con un botón
+        // setTimeout(() => cleanupSession(sessionId), 300000); // Limpiar después de 5 minutos
+        return true;
+    } else if (data.state === 'FAILURE') {
+        statusDiv.textContent = `Error: ${data.status}. Check server logs for details.`;
+        progressBar.style.width = '0%'; // Reset progress bar on error
+        progressBar.textContent = 'Error';
+        progressBar.style.backgroundColor = '#f44336'; // Red for error
+        return true;
+    }
+    return false;
+}
+
+
+// Recibe el progreso por Server-Sent Events: cada fragmento terminado llega en cuanto el worker lo publica.
+// Si el navegador no soporta EventSource o la conexión falla, se vuelve al sondeo cada 2 segundos.
+function watchTaskProgress(taskId, sessionId) {
+    if (!window.EventSource) {
+        pollTaskStatus(taskId, sessionId);
+        return;
+    }
+
+    const source = new EventSource(`${API_BASE_URL}/api/task_events/${taskId}`);
+    let finished = false;
+
+    source.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (showTaskStatus(data)) {
+            finished = true;
+            source.close();
+        }
+    };
+
+    source.onerror = () => {
+        source.close();
+        if (!finished) {
+            console.warn('Progress stream closed, falling back to polling');
+            pollTaskStatus(taskId, sessionId);
+        }
+    };
+}
+
+
 function pollTaskStatus(taskId, sessionId) {
     const statusDiv = document.getElementById('status');
     const progressBar = document.getElementById('progressBar');
@@ -69,28 +226,8 @@ function pollTaskStatus(taskId, sessionId) {
             }
 
             const data = await response.json();
-            statusDiv.textContent = `Status: ${data.status}`;
-            
-            if (data.progress) {
-                progressBar.style.width = data.progress;
-                progressBar.textContent = data.progress;
-            }
-
-            if (data.state === 'SUCCESS') {
+            if (showTaskStatus(data)) {
                 clearInterval(pollInterval);
-                statusDiv.textContent = `Status: ${data.status}`;
-                progressBar.style.width = '100%';
-                progressBar.textContent = '100%';
-                progressBar.style.backgroundColor = '#4CAF50'; // Green for success
-                displayDownloadLinks(data.fragments, data.session_id); // Usamos data.session_id
-                // Opcional: Limpiar archivos después de un tiempo o con un botón
-                // setTimeout(() => cleanupSession(sessionId), 300000); // Limpiar después de 5 minutos
-            } else if (data.state === 'FAILURE') {
-                clearInterval(pollInterval);
-                statusDiv.textContent = `Error: ${data.status}. Check server logs for details.`;
-                progressBar.style.width = '0%'; // Reset progress bar on error
-                progressBar.textContent = 'Error';
-                progressBar.style.backgroundColor = '#f44336'; // Red for error
             }
 
         } catch (error) {
@@ -114,51 +251,42 @@ function displayDownloadLinks(fragments, sessionId) {
         return;
     }
 
+    let currentRendition = null;
     fragments.forEach(fragment => {
+        // Con renditions los fragmentos llegan agrupados por rendition: un título antes de cada grupo
+        if (fragment.rendition && fragment.rendition !== currentRendition) {
+            currentRendition = fragment.rendition;
+            const renditionTitle = document.createElement('h4');
+            renditionTitle.textContent = `Rendition: ${currentRendition}`;
+            resultsDiv.appendChild(renditionTitle);
+        }
+
         const fragmentDiv = document.createElement('div');
         fragmentDiv.className = 'fragment-item';
 
-        // 1. Elemento de video para previsualización
-        const videoElement = document.createElement('video');
-        videoElement.src = fragment.url; // Usa la URL proporcionada por el backend
-        videoElement.controls = true; // Permite controles de reproducción
-        videoElement.loop = true; // Bucle para previsualización
-        videoElement.preload = 'metadata'; // Carga solo metadatos inicialmente
-        videoElement.style.maxWidth = '100%';
-        videoElement.style.height = 'auto';
-        videoElement.style.display = 'block'; // Asegura que ocupe su propia línea
-        videoElement.style.marginBottom = '10px';
-        videoElement.title = `Preview of ${fragment.name}`;
-
-        // Añadir manejo de error para el video
-        videoElement.addEventListener('error', (e) => {
-            console.error(`Error loading video ${fragment.url}:`, e);
-            // Muestra un mensaje amigable o una imagen de placeholder
-            const errorMsg = document.createElement('p');
-            errorMsg.style.color = 'red';
-            errorMsg.textContent = `Could not load preview for ${fragment.name}. It might require HTTPS or the file could not be found.`;
-            fragmentDiv.insertBefore(errorMsg, videoElement.nextSibling);
-            // Si el error es por HTTPS, el navegador lo mostrará en la consola.
-            // Aquí podemos dar una pista al usuario.
-            if (window.location.protocol === 'http:' && fragment.url.startsWith('http:')) {
-                errorMsg.textContent += " (Consider loading your site over HTTPS for video playback)";
-            }
-        });
-
+        // 1. Previsualización: el poster (unos KB) si el backend lo generó; el <video> solo se crea al hacer clic
+        const previewElement = fragment.poster_url ? createPosterPreview(fragment) : createVideoPreview(fragment, fragmentDiv);
 
         // 2. Enlace de descarga
         const downloadLink = document.createElement('a');
         downloadLink.href = fragment.url; // Usa la URL proporcionada por el backend
         downloadLink.textContent = `Download ${fragment.name}`;
-        downloadLink.download = fragment.name; // Sugiere el nombre del archivo al descargar
+        downloadLink.download = fragment.name.replace('/', '_'); // Sugiere el nombre del archivo al descargar
         downloadLink.className = 'download-link';
 
 
-        fragmentDiv.appendChild(videoElement);
+        fragmentDiv.appendChild(previewElement);
         fragmentDiv.appendChild(downloadLink);
         resultsDiv.appendChild(fragmentDiv);
     });
 
+    // Enlace para descargar todos los fragmentos en un ZIP (se genera al vuelo en el servidor)
+    const downloadAllLink = document.createElement('a');
+    downloadAllLink.href = `${API_BASE_URL}/api/download_all/${sessionId}`;
+    downloadAllLink.textContent = 'Download All (ZIP)';
+    downloadAllLink.className = 'download-link';
+    resultsDiv.appendChild(downloadAllLink);
+
     // Añadir botón de limpieza
     const cleanupBtn = document.createElement('button');
     cleanupBtn.textContent = 'Clean Up Session Files';
@@ -168,6 +296,77 @@ function displayDownloadLinks(fragments, sessionId) {
 }
 
 
+// Reproductor completo (fragmentos sin poster, p. ej. de resultados anteriores a las previsualizaciones)
+function createVideoPreview(fragment, fragmentDiv) {
+    const videoElement = document.createElement('video');
+    videoElement.src = fragment.url; // Usa la URL proporcionada por el backend
+    videoElement.controls = true; // Permite controles de reproducción
+    videoElement.loop = true; // Bucle para previsualización
+    videoElement.preload = 'metadata'; // Carga solo metadatos inicialmente
+    videoElement.style.maxWidth = '100%';
+    videoElement.style.height = 'auto';
+    videoElement.style.display = 'block'; // Asegura que ocupe su propia línea
+    videoElement.style.marginBottom = '10px';
+    videoElement.title = `Preview of ${fragment.name}`;
+
+    // Añadir manejo de error para el video
+    videoElement.addEventListener('error', (e) => {
+        console.error(`Error loading video ${fragment.url}:`, e);
+        // Muestra un mensaje amigable o una imagen de placeholder
+        const errorMsg = document.createElement('p');
+        errorMsg.style.color = 'red';
+        errorMsg.textContent = `Could not load preview for ${fragment.name}. It might require HTTPS or the file could not be found.`;
+        fragmentDiv.insertBefore(errorMsg, videoElement.nextSibling);
+        // Si el error es por HTTPS, el navegador lo mostrará en la consola.
+        // Aquí podemos dar una pista al usuario.
+        if (window.location.protocol === 'http:' && fragment.url.startsWith('http:')) {
+            errorMsg.textContent += " (Consider loading your site over HTTPS for video playback)";
+        }
+    });
+    return videoElement;
+}
+
+
+// Poster del fragmento; al pasar el ratón recorre el sprite sheet y al hacer clic se cambia por el reproductor
+function createPosterPreview(fragment) {
+    const previewDiv = document.createElement('div');
+    previewDiv.className = 'fragment-preview';
+    previewDiv.title = `Preview of ${fragment.name} (click to play)`;
+
+    const posterImage = document.createElement('img');
+    posterImage.src = fragment.poster_url;
+    posterImage.alt = `Preview of ${fragment.name}`;
+    posterImage.loading = 'lazy';
+    previewDiv.appendChild(posterImage);
+
+    const sprite = fragment.sprite;
+    if (sprite) {
+        // Cada miniatura del sprite ocupa 1/columns × 1/rows de la imagen: se elige según la posición del ratón
+        previewDiv.addEventListener('mousemove', (event) => {
+            const rect = previewDiv.getBoundingClientRect();
+            const tiles = sprite.columns * sprite.rows;
+            const tile = Math.min(tiles - 1, Math.floor((event.clientX - rect.left) / rect.width * tiles));
+            const column = tile % sprite.columns;
+            const row = Math.floor(tile / sprite.columns);
+            previewDiv.style.backgroundImage = `url(${sprite.url})`;
+            previewDiv.style.backgroundSize = `${sprite.columns * 100}% ${sprite.rows * 100}%`;
+            previewDiv.style.backgroundPosition = `${sprite.columns > 1 ? column / (sprite.columns - 1) * 100 : 0}% ${sprite.rows > 1 ? row / (sprite.rows - 1) * 100 : 0}%`;
+            posterImage.style.visibility = 'hidden';
+        });
+        previewDiv.addEventListener('mouseleave', () => {
+            posterImage.style.visibility = 'visible';
+        });
+    }
+
+    previewDiv.addEventListener('click', () => {
+        const videoElement = createVideoPreview(fragment, previewDiv.parentNode);
+        videoElement.autoplay = true;
+        previewDiv.replaceWith(videoElement);
+    }, { once: true });
+    return previewDiv;
+}
+
+
 async function cleanupSession(sessionId) {
     const statusDiv = document.getElementById('status');
     try {
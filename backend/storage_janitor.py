@@ -0,0 +1,240 @@
+import os
+import time
+import shutil
+import sqlite3
+import contextlib
+
+from result_cache import directory_size
+
+# --- Índice de sesiones y limpieza de uploads/ y fragments/ ---
+# Cada sesión (subida + fragmentos) tiene una fila con su estado, tamaño en bytes y último acceso, así que
+# un barrido no necesita recorrer los directorios con os.walk: basta con una consulta.
+#   - TTL: las sesiones terminadas, fallidas o huérfanas sin accesos durante `ttl` segundos se borran
+#     (igual que result_expires de Celery: pasado ese tiempo el cliente ya no puede consultar la tarea).
+#   - Subidas por partes sin actividad durante `stall_timeout` se borran.
+#   - Presupuesto: si el total supera max_bytes se borran las sesiones menos usadas recientemente (LRU).
+#   - Admisión: antes de aceptar una subida se reserva su tamaño; si no cabe ni liberando sesiones
+#     evictables, se rechaza (el endpoint responde 507).
+# Las sesiones en curso ('uploading', 'processing') nunca se desalojan por presupuesto.
+# De cada sesión 'processing' se guarda cuándo se encoló su tarea (queued_at) y cuándo la empezó un worker
+# (started_at): una tarea que sigue PENDING puede estar esperando su turno, no perdida.
+
+STATES = ('uploading', 'processing', 'done', 'failed', 'orphan')
+EVICTABLE_STATES = ('done', 'failed', 'orphan')
+TOUCH_INTERVAL = 60 # segundos: no reescribir last_access en cada petición de un mismo fragmento
+
+
+class SessionIndex:
+    def __init__(self, upload_folder, fragment_folder, max_bytes, min_free_bytes=0, on_remove=None):
+        """
+        on_remove(session_id) se llama al borrar una sesión (p. ej. para olvidarla en la caché de resultados).
+        """
+        self.upload_folder = upload_folder
+        self.fragment_folder = fragment_folder
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.on_remove = on_remove
+        self.db_path = os.path.join(fragment_folder, '.session_index.sqlite3')
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                task_id TEXT,
+                upload_bytes INTEGER NOT NULL DEFAULT 0,
+                fragment_bytes INTEGER NOT NULL DEFAULT 0,
+                reserved_bytes INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                queued_at REAL,
+                started_at REAL)''')
+            # Índices creados antes de registrar queued_at/started_at
+            columns = {row[1] for row in db.execute('PRAGMA table_info(sessions)')}
+            for column in ('queued_at', 'started_at'):
+                if column not in columns:
+                    db.execute(f'ALTER TABLE sessions ADD COLUMN {column} REAL')
+            db.execute('CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Una conexión por operación, igual que ResultCache
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # --- Registro ---
+
+    def register(self, session_id, state, task_id=None, upload_bytes=0, reserved_bytes=0):
+        now = time.time()
+        with self._connect() as db:
+            db.execute('''INSERT INTO sessions (session_id, state, task_id, upload_bytes, reserved_bytes, created_at, last_access)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT(session_id) DO UPDATE SET state = excluded.state,
+                              task_id = COALESCE(excluded.task_id, task_id), upload_bytes = excluded.upload_bytes,
+                              reserved_bytes = MAX(reserved_bytes, excluded.reserved_bytes), last_access = excluded.last_access''',
+                       (session_id, state, task_id, upload_bytes, reserved_bytes, now, now))
+
+    def update(self, session_id, **fields):
+        """
+        Actualiza columnas de la sesión (state, task_id, upload_bytes, fragment_bytes, reserved_bytes, queued_at,
+        started_at) y su último acceso.
+        """
+        fields['last_access'] = time.time()
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        with self._connect() as db:
+            db.execute(f'UPDATE sessions SET {assignments} WHERE session_id = ?', (*fields.values(), session_id))
+
+    def mark_queued(self, session_id, task_id, upload_bytes=0):
+        """La tarea de la sesión se encoló (o quedó retenida en su carril): todavía no la empezó ningún worker."""
+        self.update(session_id, state='processing', task_id=task_id, upload_bytes=upload_bytes, queued_at=time.time(), started_at=None)
+
+    def mark_started(self, session_id):
+        """Un worker empezó la tarea de la sesión (se vuelve a marcar si Celery la reentrega)."""
+        self.update(session_id, started_at=time.time())
+
+    def mark_done(self, session_id, fragment_bytes, upload_bytes=0):
+        """La división terminó: se cuentan los fragmentos reales y se libera la reserva de admisión."""
+        self.update(session_id, state='done', fragment_bytes=fragment_bytes, upload_bytes=upload_bytes, reserved_bytes=0)
+
+    def get(self, session_id):
+        """La fila de la sesión como diccionario, o None si no está en el índice."""
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute('SELECT * FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def touch(self, session_id):
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE sessions SET last_access = ? WHERE session_id = ? AND last_access < ?',
+                       (now, session_id, now - TOUCH_INTERVAL))
+
+    def forget(self, session_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def usage(self):
+        with self._connect() as db:
+            return self._usage(db)
+
+    @staticmethod
+    def _usage(db):
+        # Mientras una sesión no termina cuenta lo que reservó al admitirla (o lo que ya ocupa, si es más)
+        return db.execute('SELECT COALESCE(SUM(MAX(upload_bytes + fragment_bytes, reserved_bytes)), 0) FROM sessions').fetchone()[0]
+
+    # --- Borrado ---
+
+    def _remove(self, db, session_id):
+        for folder in (self.upload_folder, self.fragment_folder):
+            shutil.rmtree(os.path.join(folder, session_id), ignore_errors=True)
+        db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        if self.on_remove:
+            self.on_remove(session_id)
+
+    @staticmethod
+    def _evictable_bytes(db, exclude=None):
+        placeholders = ','.join('?' for _ in EVICTABLE_STATES)
+        return db.execute(f'''SELECT COALESCE(SUM(upload_bytes + fragment_bytes), 0) FROM sessions
+                              WHERE state IN ({placeholders}) AND session_id IS NOT ?''', (*EVICTABLE_STATES, exclude)).fetchone()[0]
+
+    def _evict_lru(self, db, bytes_needed, exclude=None):
+        """Borra sesiones evictables, de la menos usada a la más usada, hasta liberar bytes_needed. Devuelve lo liberado."""
+        freed = 0
+        placeholders = ','.join('?' for _ in EVICTABLE_STATES)
+        rows = db.execute(f'''SELECT session_id, upload_bytes + fragment_bytes FROM sessions
+                              WHERE state IN ({placeholders}) ORDER BY last_access''', EVICTABLE_STATES).fetchall()
+        for session_id, size_bytes in rows:
+            if freed >= bytes_needed:
+                break
+            if session_id == exclude:
+                continue
+            self._remove(db, session_id)
+            freed += size_bytes
+            print(f"Limpieza de almacenamiento: sesión {session_id} eliminada por presupuesto ({size_bytes} bytes)")
+        return freed
+
+    # --- Admisión ---
+
+    def admit(self, session_id, need_bytes, state='uploading'):
+        """
+        Reserva need_bytes para una sesión nueva, desalojando sesiones LRU si hace falta.
+        Tiene en cuenta tanto el presupuesto (max_bytes) como el espacio libre real del disco.
+        Devuelve True si la sesión fue admitida (y queda registrada) o False si no hay sitio; en ese caso
+        no se borra nada (si ni desalojando todas las sesiones evictables cabría, no se desaloja ninguna).
+        """
+        with self._connect() as db:
+            # BEGIN IMMEDIATE: dos admisiones simultáneas no pueden reservar el mismo hueco
+            db.execute('BEGIN IMMEDIATE')
+            over_budget = self._usage(db) + need_bytes - self.max_bytes if self.max_bytes else 0
+            free_bytes = shutil.disk_usage(self.fragment_folder).free
+            missing_free = need_bytes + self.min_free_bytes - free_bytes
+            bytes_needed = max(over_budget, missing_free, 0)
+            if bytes_needed:
+                if self._evictable_bytes(db, exclude=session_id) < bytes_needed:
+                    return False
+                if self._evict_lru(db, bytes_needed, exclude=session_id) < bytes_needed:
+                    return False
+            now = time.time()
+            db.execute('''INSERT OR REPLACE INTO sessions (session_id, state, reserved_bytes, created_at, last_access)
+                          VALUES (?, ?, ?, ?, ?)''', (session_id, state, need_bytes, now, now))
+            return True
+
+    # --- Barrido periódico ---
+
+    def _reconcile(self, db):
+        """Registra como huérfanos los directorios que existen en disco pero no en el índice (p. ej. de antes de usarlo)."""
+        known = {row[0] for row in db.execute('SELECT session_id FROM sessions')}
+        for folder, column in ((self.upload_folder, 'upload_bytes'), (self.fragment_folder, 'fragment_bytes')):
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if not entry.is_dir() or entry.name in known:
+                    continue
+                mtime = entry.stat().st_mtime
+                db.execute(f'''INSERT INTO sessions (session_id, state, {column}, created_at, last_access) VALUES (?, 'orphan', ?, ?, ?)
+                               ON CONFLICT(session_id) DO UPDATE SET {column} = excluded.{column}''',
+                           (entry.name, directory_size(entry.path), mtime, mtime))
+                known.add(entry.name)
+
+    def sweep(self, ttl, stall_timeout, is_task_lost=None):
+        """
+        Aplica TTLs y presupuesto. is_task_lost(task_id, queued_at, started_at) indica si una sesión 'processing'
+        ya no tiene una tarea viva (terminó sin actualizar el índice o se perdió); esas pasan a 'failed' y se
+        borran cuando caduquen. started_at es None mientras ningún worker haya empezado la tarea.
+        Devuelve un resumen con las sesiones borradas y los bytes liberados.
+        """
+        now = time.time()
+        removed = []
+        freed = 0
+        with self._connect() as db:
+            self._reconcile(db)
+            rows = db.execute('''SELECT session_id, state, task_id, upload_bytes + fragment_bytes, last_access,
+                                        COALESCE(queued_at, created_at), started_at FROM sessions''').fetchall()
+            for session_id, state, task_id, size_bytes, last_access, queued_at, started_at in rows:
+                if state in EVICTABLE_STATES and not any(os.path.isdir(os.path.join(folder, session_id))
+                                                         for folder in (self.upload_folder, self.fragment_folder)):
+                    # Ya se borró por otra vía (la caché de resultados o /api/cleanup): solo falta olvidarla
+                    db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+                    continue
+                if state == 'processing':
+                    if is_task_lost and is_task_lost(task_id, queued_at, started_at):
+                        db.execute("UPDATE sessions SET state = 'failed', reserved_bytes = 0 WHERE session_id = ?", (session_id,))
+                    continue
+                expired = (state in EVICTABLE_STATES and last_access < now - ttl) or \
+                          (state == 'uploading' and last_access < now - stall_timeout)
+                if expired:
+                    self._remove(db, session_id)
+                    removed.append(session_id)
+                    freed += size_bytes
+                    print(f"Limpieza de almacenamiento: sesión {session_id} ({state}) caducada ({size_bytes} bytes)")
+
+            if self.max_bytes:
+                over_budget = self._usage(db) - self.max_bytes
+                if over_budget > 0:
+                    freed += self._evict_lru(db, over_budget)
+            return {'removed': removed, 'freed_bytes': freed, 'usage_bytes': self._usage(db)}
@@ -0,0 +1,74 @@
+import os
+import time
+import resource
+import subprocess
+
+from celery import signals
+
+import ffmpeg_tools
+import metrics
+
+# --- Separación entre el proceso web y el motor de medios ---
+# El proceso web (gunicorn) solo importa Flask, Celery, redis y módulos de la biblioteca estándar: ffmpeg_tools
+# importa imageio_ffmpeg únicamente al resolver el binario de ffmpeg, y ninguna ruta de la API lo ejecuta.
+# Los workers de Celery sí lo necesitan, así que lo precargan al arrancar en lugar de en la primera tarea:
+#   - worker_init (proceso principal del worker): importa imageio_ffmpeg, resuelve la ruta de ffmpeg y ejecuta
+#     ffmpeg/ffprobe una vez para que sus binarios y librerías queden en la caché de páginas del sistema.
+#     Los procesos del pool se crean después con fork y heredan todo lo cargado.
+#   - worker_process_init (cada proceso del pool): solo hace el trabajo si el proceso no lo heredó
+#     (pool creado con spawn, o pools solo/threads, donde worker_init ya corre en el mismo proceso).
+# startup_profile.py mide el tiempo de arranque y la RSS de ambos tipos de proceso.
+#   WORKER_PRELOAD -> '0' para no precargar nada
+
+WORKER_PRELOAD = os.environ.get('WORKER_PRELOAD', '1') not in ('0', 'false', 'no')
+
+_preloaded = False
+
+
+def _rss_bytes():
+    # RSS actual (no el máximo) en Linux; en otros sistemas, el máximo de getrusage
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def preload():
+    """Carga el motor de medios en este proceso (una sola vez). Nunca lanza excepciones."""
+    global _preloaded
+    if _preloaded:
+        return
+    _preloaded = True
+    started = time.perf_counter()
+    try:
+        binaries = [ffmpeg_tools.get_ffmpeg_binary(), ffmpeg_tools.FFPROBE_BINARY]
+    except Exception as e:
+        print(f"No se pudo resolver el binario de ffmpeg: {e}")
+        return
+    for binary in binaries:
+        try:
+            subprocess.run([binary, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Mejor avisar al arrancar el worker que en la primera tarea
+            print(f"Aviso: {binary} no se puede ejecutar: {e}")
+    metrics.log_event('worker_preload', pid=os.getpid(), seconds=round(time.perf_counter() - started, 3),
+                      ffmpeg=binaries[0], rss_bytes=_rss_bytes())
+
+
+def _on_worker_init(**kwargs):
+    preload()
+
+
+def _on_worker_process_init(**kwargs):
+    preload()
+
+
+def connect_celery_signals():
+    if not WORKER_PRELOAD:
+        return
+    signals.worker_init.connect(_on_worker_init, weak=False)
+    signals.worker_process_init.connect(_on_worker_process_init, weak=False)
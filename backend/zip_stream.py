@@ -0,0 +1,132 @@
+import os
+import time
+import zlib
+import struct
+
+# --- ZIP en streaming para descargar varios fragmentos de una vez ---
+# El archivo ZIP se genera al vuelo mientras se envía: sin archivo temporal en disco, con memoria constante
+# y el primer byte sale de inmediato. Los MP4 ya vienen comprimidos, así que se guardan sin comprimir
+# (ZIP_STORED) y no se gasta CPU en deflate. ZIP64 permite archivos de más de 4 GB.
+# El CRC va en la cabecera local, así que ninguna entrada lleva "data descriptor", que algunos lectores
+# (p. ej. ZipInputStream de Java) no aceptan en entradas STORED. Para no leer cada archivo dos veces al
+# descargar, el CRC se calcula al escribir el fragmento (record_crc, justo después de ffmpeg, con el archivo
+# en la caché de páginas) y se guarda junto a él en <fragmento>.crc32. Si falta o el archivo cambió,
+# se calcula al descargar y se guarda para la próxima vez.
+
+READ_CHUNK_SIZE = 1024 * 1024 # 1 MB
+CRC_SUFFIX = '.crc32'
+
+ZIP64_VERSION = 45
+UTF8_FLAG = 0x800
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+def _file_crc(path):
+    crc = 0
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc, size
+
+
+def record_crc(path):
+    """
+    Calcula el CRC-32 de un archivo recién escrito y lo guarda en <path>.crc32 con el tamaño y la fecha de
+    modificación que tenía, para que stream_zip no tenga que leerlo antes de enviarlo. Devuelve (crc, tamaño).
+    """
+    stat = os.stat(path)
+    crc, size = _file_crc(path)
+    try:
+        tmp_path = path + CRC_SUFFIX + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(f"{crc} {size} {stat.st_mtime_ns}")
+        os.replace(tmp_path, path + CRC_SUFFIX)
+    except OSError as e:
+        print(f"No se pudo guardar el CRC de {path}: {e}")
+    return crc, size
+
+
+def stored_crc(path, stat):
+    """(crc, tamaño) guardados por record_crc, o None si no hay o no corresponden al archivo actual."""
+    try:
+        with open(path + CRC_SUFFIX) as f:
+            crc, size, mtime_ns = (int(value) for value in f.read().split())
+    except (OSError, ValueError):
+        return None
+    if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+        return None
+    return crc, size
+
+
+def _dos_datetime(timestamp):
+    # El formato MS-DOS solo admite fechas desde 1980
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+def _local_header(name, crc, size, dos_time, dos_date):
+    # Siempre ZIP64: los tamaños reales van en el campo extra y los de la cabecera a 0xFFFFFFFF
+    extra = struct.pack('<HHQQ', 0x0001, 16, size, size)
+    header = struct.pack('<4s5H3L2H', b'PK\x03\x04', ZIP64_VERSION, UTF8_FLAG, 0, dos_time, dos_date,
+                         crc, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra))
+    return header + name + extra
+
+
+def _central_header(name, crc, size, dos_time, dos_date, offset):
+    extra = struct.pack('<HHQQQ', 0x0001, 24, size, size, offset)
+    # Creado en Unix (3), con permisos rw-r--r-- en los atributos externos
+    header = struct.pack('<4s6H3L5H2L', b'PK\x01\x02', (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, UTF8_FLAG, 0,
+                         dos_time, dos_date, crc, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra), 0, 0, 0,
+                         0o100644 << 16, ZIP64_LIMIT)
+    return header + name + extra
+
+
+def _end_records(count, directory_offset, directory_size):
+    end_offset = directory_offset + directory_size
+    zip64_end = struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                            count, count, directory_size, directory_offset)
+    locator = struct.pack('<4sLQL', b'PK\x06\x07', 0, end_offset, 1)
+    end = struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                      min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0)
+    return zip64_end + locator + end
+
+
+def stream_zip(files):
+    """
+    Genera los bytes de un ZIP con los archivos indicados, fragmento a fragmento.
+    files: iterable de (nombre_dentro_del_zip, ruta_en_disco).
+    """
+    offset = 0
+    central_directory = []
+    for arcname, path in files:
+        name = arcname.encode('utf-8')
+        stat = os.stat(path)
+        crc, size = stored_crc(path, stat) or record_crc(path)
+        dos_time, dos_date = _dos_datetime(stat.st_mtime)
+        header = _local_header(name, crc, size, dos_time, dos_date)
+        central_directory.append(_central_header(name, crc, size, dos_time, dos_date, offset))
+        yield header
+        offset += len(header)
+
+        written = 0
+        with open(path, 'rb') as src:
+            # Se envían exactamente los bytes declarados en la cabecera, aunque el archivo crezca entretanto
+            while written < size:
+                chunk = src.read(min(READ_CHUNK_SIZE, size - written))
+                if not chunk:
+                    raise RuntimeError(f"{arcname} shrank while it was being zipped")
+                written += len(chunk)
+                yield chunk
+        offset += size
+
+    # Directorio central y registros de fin (ZIP64 y clásico)
+    directory = b''.join(central_directory)
+    yield directory
+    yield _end_records(len(central_directory), offset, len(directory))